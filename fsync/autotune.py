@@ -0,0 +1,82 @@
+import threading
+import time
+
+from fsync.conf import SynConfig
+
+class AdaptiveController:
+    """ AIMD tuning of the number of concurrent transfers and of the slice size.
+
+    Workers call acquire()/release() around every transfer and report it with
+    record(). A failed transfer halves the concurrency limit and the slice
+    size (at most once per `cooldown` seconds, so one burst of errors counts
+    once). After `limit` successful transfers the throughput of that window
+    is compared with the previous one; if it did not drop, one more transfer
+    is allowed. Slices that finish much faster than `target` seconds grow,
+    slices that take much longer shrink.
+    """
+
+    def __init__(self, minworkers=1, maxworkers=16, workers=None, minslice=1024 * 1024, maxslice=256 * 1024 * 1024,
+                 slicesize=4 * 1024 * 1024, target=30, cooldown=5):
+        self.minworkers = minworkers
+        self.maxworkers = maxworkers
+        self.limit = min(max(workers or minworkers, minworkers), maxworkers)
+        self.minslice = minslice
+        self.maxslice = maxslice
+        self.slicesize = min(max(slicesize, minslice), maxslice)
+        self.target = target
+        self.cooldown = cooldown
+        self.__cond = threading.Condition()
+        self.__running = 0
+        self.__lastdecrease = 0
+        self.__window = [0, 0, time.time()]
+        self.__lastrate = 0
+
+    def acquire(self):
+        with self.__cond:
+            while self.__running >= self.limit:
+                self.__cond.wait()
+            self.__running += 1
+
+    def release(self):
+        with self.__cond:
+            self.__running -= 1
+            self.__cond.notify_all()
+
+    def record(self, size, seconds, ok):
+        """Report one transfer of `size` bytes that took `seconds`."""
+        with self.__cond:
+            now = time.time()
+            if not ok:
+                if now - self.__lastdecrease >= self.cooldown:
+                    self.__lastdecrease = now
+                    self.limit = max(self.limit // 2, self.minworkers)
+                    self.slicesize = max(self.slicesize // 2, self.minslice)
+                self.__window = [0, 0, now]
+                return
+            if seconds < self.target / 4 and size >= self.slicesize:
+                self.slicesize = min(self.slicesize * 2, self.maxslice)
+            elif seconds > self.target * 2:
+                self.slicesize = max(self.slicesize // 2, self.minslice)
+            self.__window[0] += 1
+            self.__window[1] += size
+            if self.__window[0] >= self.limit:
+                rate = self.__window[1] / max(now - self.__window[2], 0.001)
+                if rate >= self.__lastrate * 0.95 and self.limit < self.maxworkers:
+                    self.limit += 1
+                    self.__cond.notify_all()
+                self.__lastrate = rate
+                self.__window = [0, 0, now]
+
+_controller = None
+_controller_lock = threading.Lock()
+
+def get_controller():
+    """The process-wide controller, seeded from threadnumber and slicesize."""
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            threadnumber = SynConfig.config['threadnumber']
+            _controller = AdaptiveController(maxworkers=SynConfig.config.get('maxthreadnumber', threadnumber * 4),
+                                             workers=threadnumber,
+                                             slicesize=SynConfig.config.get('slicesize', 4 * 1024 * 1024))
+        return _controller
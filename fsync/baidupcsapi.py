@@ -1,317 +1,1147 @@
+import asyncio
 import json
 import os
+import posixpath
+import queue
 import hashlib
-import binascii
+import threading
 import time
+import traceback
 
+from fsync.autotune import get_controller
+from fsync.checksum import BLOCK_SIZE, get_checksums
 from fsync.common.log import logger
+from fsync.common.threadpool import PriorityExecutor
 from fsync.conf import SynConfig
-from fsync.fcurl import SynCurl
+from fsync.fcurl import SynCurl, AsyncSynCurl
+from fsync.fileio import FileWriter
+from fsync.stages import compressed_size, compression_for, make_cipher_stage, upload_compression
+
+class PcsError(Exception):
+    """ Raised by the iterator APIs, which cannot report failure through a return code. """
+
+    def __init__(self, errno, message):
+        Exception.__init__(self, message)
+        self.errno = errno
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    """The process-wide pool running slice upload and segment download jobs.
+
+    Its workers are shared by every parallel transfer; jobs of smaller files
+    are given priority so they are not queued behind a large file.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            threadnumber = SynConfig.config['threadnumber']
+            _executor = PriorityExecutor(SynConfig.config.get('maxthreadnumber', threadnumber * 4), name='fsync-transfer')
+        return _executor
+
+def run_jobs(jobs, priority=0):
+    """Run job objects on the shared executor and wait for them; returns the number that raised."""
+    futures = [get_executor().submit(job.execute, priority=priority) for job in jobs]
+    failed = 0
+    for future in futures:
+        error = future.exception()
+        if error is not None:
+            logger.error('Job failed: %s.' % (error))
+            failed += 1
+    return failed
+
+def transfer_align():
+    """Granularity of slice and segment boundaries: whole encryption blocks, and at least 64KB.
+
+    Encrypted data is ciphered in blocks counted from the start of the file,
+    so a range may only start on a block boundary.
+    """
+    blocksize = SynConfig.config.get('encryptblocksize', 4096)
+    return blocksize * max(65536 // blocksize, 1)
+
+class SliceUploadJob:
+    def __init__(self, filepath, state, slicesize, controller=None):
+        self.filepath = filepath
+        self.state = state
+        self.slicesize = slicesize
+        self.controller = controller
+
+    def execute(self):
+        while True:
+            if self.controller is not None:
+                self.controller.acquire()
+            try:
+                filerange = self.state.next_range(self.controller.slicesize if self.controller is not None else self.slicesize)
+                if filerange is None:
+                    return
+                starttime = time.time()
+                try:
+                    ret, md5 = BaiduPcsApi.slice_upload_tmpfile(self.filepath, '%d-%d' % filerange)
+                except Exception as e:
+                    logger.error('Upload slice %d-%d of "%s" failed: %s.\n%s' % (filerange[0], filerange[1], self.filepath, e, traceback.format_exc()))
+                    ret, md5 = 1, None
+                if self.controller is not None:
+                    self.controller.record(filerange[1] - filerange[0] + 1, time.time() - starttime, ret == 0)
+                if ret != 0:
+                    self.state.failed = True
+                    return
+                self.state.done(filerange, md5)
+            finally:
+                if self.controller is not None:
+                    self.controller.release()
+
+class SliceUploadState:
+    """ Slices of one parallel upload.
+
+    Ranges are cut on demand, so the slice size may change while the file is
+    uploading. Finished slices are saved after each one, so an interrupted
+    upload resumes with only the ranges it has not sent yet.
+    """
+
+    # PCS accepts at most 1024 slices for one superfile
+    maxslices = 1024
+
+    def __init__(self, filepath, pcspath):
+        st = os.stat(filepath)
+        self.failed = False
+        self.filesize = st.st_size
+        self.key = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'pcspath': pcspath}
+        self.pcspath = pcspath
+        self.statefile = SliceUploadState.statepath('upload', '%s\n%s' % (os.path.abspath(filepath), pcspath))
+        self.slices = {}
+        self.__lock = threading.Lock()
+        self.__claimed = {}
+        self.__nextpos = 0
+        try:
+            with open(self.statefile, 'r') as fh:
+                state = json.load(fh)
+            if state['key'] == self.key:
+                self.slices = dict((startpos, (endpos, md5)) for startpos, endpos, md5 in state['slices'])
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
 
-class BaiduPcsApi:
     @staticmethod
-    def get_pcs_quota():
-        sycurl = SynCurl()
-        url = 'https://pcs.baidu.com/rest/2.0/pcs/quota'
-        querydata = {
-                'method': 'info',
-                'access_token': SynConfig.token['access_token']
-                }
-        retcode, responses = sycurl.request(url, querydata, '', 'GET', SynCurl.Normal)
+    def statepath(kind, key):
+        statedir = SynConfig.config.get('statedir', os.path.join(os.path.expanduser('~'), '.fsync'))
+        return os.path.join(statedir, '%s-%s.json' % (kind, hashlib.md5(key.encode('utf-8')).hexdigest()))
+
+    @staticmethod
+    def load_layout(pcspath):
+        """The (startpos, endpos, md5) slices `pcspath` was last uploaded as from here, or None."""
+        try:
+            with open(SliceUploadState.statepath('blocks', pcspath), 'r') as fh:
+                layout = json.load(fh)
+            if layout['pcspath'] == pcspath:
+                return [tuple(block) for block in layout['slices']]
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+        return None
+
+    def save_layout(self):
+        """Remember the slices of the finished upload, so incremental_upload() can match them later."""
+        layoutfile = SliceUploadState.statepath('blocks', self.pcspath)
+        try:
+            os.makedirs(os.path.dirname(layoutfile), exist_ok=True)
+            with open(layoutfile + '.tmp', 'w') as fh:
+                json.dump({'pcspath': self.pcspath, 'slices': [[startpos, endpos, md5] for startpos, (endpos, md5) in sorted(self.slices.items())]}, fh)
+            os.replace(layoutfile + '.tmp', layoutfile)
+        except OSError as e:
+            logger.warning('Save block layout "%s" failed: %s.' % (layoutfile, e))
+
+    def reuse(self, startpos, endpos, md5):
+        """Count a block the server already holds as an uploaded slice, unless it overlaps one."""
+        with self.__lock:
+            for start, (end, _) in self.slices.items():
+                if start <= endpos and startpos <= end:
+                    return
+            self.slices[startpos] = (endpos, md5)
+
+    def next_range(self, slicesize):
+        """Claim the next range to upload, at most `slicesize` bytes; None when there is none left."""
+        with self.__lock:
+            while self.__nextpos in self.slices:
+                self.__nextpos = self.slices[self.__nextpos][0] + 1
+            if self.failed or self.__nextpos >= self.filesize:
+                return None
+            budget = max(self.maxslices - len(self.slices) - len(self.__claimed), 1)
+            slicesize = max(slicesize, (self.filesize - self.__nextpos + budget - 1) // budget)
+            # the next slice has to start on an encryption block boundary too
+            align = transfer_align()
+            slicesize = (slicesize + align - 1) // align * align
+            endpos = min(self.__nextpos + slicesize, self.filesize) - 1
+            for startpos in self.slices:
+                if self.__nextpos < startpos <= endpos:
+                    endpos = startpos - 1
+            filerange = (self.__nextpos, endpos)
+            self.__claimed[self.__nextpos] = endpos
+            self.__nextpos = endpos + 1
+            return filerange
+
+    def done(self, filerange, md5):
+        with self.__lock:
+            del self.__claimed[filerange[0]]
+            self.slices[filerange[0]] = (filerange[1], md5)
+            try:
+                os.makedirs(os.path.dirname(self.statefile), exist_ok=True)
+                with open(self.statefile + '.tmp', 'w') as fh:
+                    json.dump({'key': self.key, 'slices': [[startpos, endpos, md5] for startpos, (endpos, md5) in sorted(self.slices.items())]}, fh)
+                os.replace(self.statefile + '.tmp', self.statefile)
+            except OSError as e:
+                logger.warning('Save slice upload state "%s" failed: %s.' % (self.statefile, e))
+
+    def block_list(self):
+        """MD5s of the slices covering the whole file in order, or None if some are missing."""
+        with self.__lock:
+            md5s = []
+            pos = 0
+            while pos < self.filesize:
+                if pos not in self.slices:
+                    return None
+                pos, md5 = self.slices[pos][0] + 1, self.slices[pos][1]
+                md5s.append(md5)
+            return md5s
+
+    def remove(self):
+        try:
+            os.remove(self.statefile)
+        except OSError:
+            pass
+
+class SegmentDownloadJob:
+    def __init__(self, download, writer, controller=None):
+        self.download = download
+        self.writer = writer
+        self.controller = controller
+
+    def execute(self):
+        while True:
+            if self.controller is not None:
+                self.controller.acquire()
+            try:
+                sycurl = SynCurl()
+                filerange = self.download.next_range(sycurl)
+                if filerange is None:
+                    return
+                starttime = time.time()
+                startpos = int(filerange.split('-', 1)[0])
+                try:
+                    ret = BaiduPcsApi.download_file(self.download.filepath, self.download.pcspath, filerange, sycurl, self.writer)
+                except Exception as e:
+                    logger.error('Download range %s of "%s" failed: %s.\n%s' % (filerange, self.download.pcspath, e, traceback.format_exc()))
+                    ret = 1
+                if self.controller is not None:
+                    self.controller.record(sycurl.position - startpos, time.time() - starttime, ret == 0)
+                self.download.finish_range(sycurl, ret)
+            finally:
+                if self.controller is not None:
+                    self.controller.release()
+
+class ParallelDownload:
+    """ Ranges of one segmented download.
+
+    Workers take the initial segments first; once those are gone a free worker
+    cuts the tail off the transfer with the most bytes left, so a stalled
+    connection does not hold up the whole file.
+    """
+
+    def __init__(self, filepath, pcspath, filesize, segments):
+        # split points stay on this boundary so encryption blocks are never cut
+        self.align = transfer_align()
+        self.filepath = filepath
+        self.pcspath = pcspath
+        self.failed = False
+        self.__lock = threading.Lock()
+        self.__active = []
+        segsize = max((filesize // segments + self.align - 1) // self.align * self.align, self.align)
+        self.__pending = [(pos, min(pos + segsize, filesize) - 1) for pos in range(0, filesize, segsize)]
+
+    def next_range(self, sycurl):
+        with self.__lock:
+            if self.failed:
+                return None
+            if self.__pending:
+                startpos, endpos = self.__pending.pop(0)
+            else:
+                startpos = endpos = None
+                for victim in sorted([c for c in self.__active if c.endpos is not None], key=lambda c: c.endpos - c.position, reverse=True):
+                    splitpos = (victim.position + victim.endpos + 1) // 2 // self.align * self.align
+                    if splitpos - victim.position < self.align or victim.endpos - splitpos + 1 < self.align:
+                        break
+                    oldendpos = victim.endpos
+                    if victim.shrink(splitpos - 1):
+                        logger.debug('Steal range %d-%d of "%s".', splitpos, oldendpos, self.pcspath)
+                        startpos, endpos = splitpos, oldendpos
+                        break
+                if startpos is None:
+                    return None
+            self.__active.append(sycurl)
+            return '%d-%d' % (startpos, endpos)
+
+    def finish_range(self, sycurl, ret):
+        with self.__lock:
+            self.__active.remove(sycurl)
+            if ret != 0:
+                self.failed = True
+
+# the param list of a meta, delete, move or copy request holds at most this many items
+BATCH_SIZE = 100
+
+def batch_param(method, chunk):
+    """The {"list": [...]} param of one batched request; chunk items are paths, or (from, to) pairs for move/copy."""
+    if method in ('move', 'copy'):
+        return {'list': [{'from': src, 'to': dest} for src, dest in chunk]}
+    return {'list': [{'path': pcspath} for pcspath in chunk]}
+
+def batch_results(method, chunk, retcode, responses):
+    """Per-item results of one batched request.
+
+    Returns a list of (errno, meta) for meta and of 0/1 for the others, or
+    None when the server rejected the batch as a whole because of some of
+    its items (one missing path fails all of them); those items then have to
+    be asked for one at a time to tell which ones failed.
+    """
+    if retcode != 200 or 'error_code' in responses:
+        if 400 <= retcode < 500 and len(chunk) > 1:
+            return None
+        return [(1, {}) if method == 'meta' else 1 for _ in chunk]
+    if method == 'meta':
+        metas = dict((meta['path'], meta) for meta in responses.get('list', []))
+        return [(0, metas[pcspath]) if pcspath in metas else (1, {}) for pcspath in chunk]
+    if method in ('move', 'copy') and 'list' in responses.get('extra', {}):
+        done = set((item['from'], item['to']) for item in responses['extra']['list'])
+        return [0 if tuple(pair) in done else 1 for pair in chunk]
+    return [0 for _ in chunk]
+
+class PcsDirCache:
+    """ Remote directories known to exist, shared by every thread.
+
+    A directory is remembered once we saw or created it, together with its
+    ancestors, and forgotten (with everything below it) when we delete or
+    move it away ourselves. claim() hands each directory to one caller at a
+    time, so concurrent checks of the same directory share one request.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__known = set()
+        self.__inflight = {}
+
+    @staticmethod
+    def normalize(pcspath):
+        return posixpath.normpath('/' + pcspath.strip('/'))
+
+    def known(self, pcspath):
+        with self.__lock:
+            return self.normalize(pcspath) in self.__known
+
+    def add(self, pcspath):
+        pcspath = self.normalize(pcspath)
+        with self.__lock:
+            while pcspath not in self.__known and pcspath != '/':
+                self.__known.add(pcspath)
+                pcspath = posixpath.dirname(pcspath)
+
+    def invalidate(self, pcspath):
+        pcspath = self.normalize(pcspath)
+        prefix = pcspath.rstrip('/') + '/'
+        with self.__lock:
+            self.__known = set(path for path in self.__known if path != pcspath and not path.startswith(prefix))
+
+    def clear(self):
+        with self.__lock:
+            self.__known = set()
+
+    def claim(self, pcspaths):
+        """Split unknown directories into ones the caller must check and events of ones already being checked."""
+        owned, waiting = [], []
+        with self.__lock:
+            for pcspath in pcspaths:
+                if pcspath in self.__known:
+                    continue
+                if pcspath in self.__inflight:
+                    waiting.append(self.__inflight[pcspath])
+                else:
+                    self.__inflight[pcspath] = threading.Event()
+                    owned.append(pcspath)
+        return owned, waiting
+
+    def release(self, pcspaths):
+        with self.__lock:
+            for pcspath in pcspaths:
+                self.__inflight.pop(pcspath).set()
+
+# The PCS calls of BaiduPcsApi and AsyncBaiduPcsApi only differ in how the
+# request is sent: both build it with pcs_request() and read the response
+# with the *_result() function of the call.
+
+def pcs_request(method, params=None, data='', httpmethod='GET', url=None, rtype=SynCurl.Normal):
+    """The (url, querydata, data, method, type) arguments of a SynCurl request to the PCS API."""
+    querydata = {
+            'method': method,
+            'access_token': SynConfig.token['access_token']
+            }
+    querydata.update(params or {})
+    return (url or BaiduPcsApi.pcs_url + '/file'), querydata, data, httpmethod, rtype
+
+def _response(retcode, responses):
+    """The decoded JSON body of a response and whether it reports an error."""
+    responses = json.loads(responses)
+    return responses, retcode != 200 or 'error_code' in responses
+
+def quota_result(retcode, responses):
+    responses, failed = _response(retcode, responses)
+    if failed:
+        logger.error('Errno:%d: Get pcs quota failed: %s.' % (retcode, responses['error_msg']))
+        return 1
+    logger.info(' PCS quota is %dG,used %dG.' % (responses['quota'] / 1024 / 1024 / 1024, responses['used'] / 1024 / 1024 / 1024))
+    return 0
+
+def filelist_request(pcspath, startindex, endindex):
+    return pcs_request('list', {
+            'path'  : pcspath,
+            'by'    : 'name',
+            'order' : 'asc',
+            'limit' : '%d-%d' % (startindex, endindex),
+            })
+
+def filelist_result(retcode, responses, pcspath):
+    try:
+        responses, failed = _response(retcode, responses)
+        if failed:
+            if responses['error_code'] == 31066:
+                return 31066, []
+            logger.error('Errno:%d: Get PCS file list of "%s" failed: %s.' % (retcode, pcspath, responses['error_msg']))
+            return 1, []
+        return 0, responses['list']
+    except Exception as e:
+        logger.error('Get PCS file list of "%s" failed. return code: %d, response body: %s.\n%s\n%s' % (pcspath, retcode, str(responses), e, traceback.format_exc()))
+        return 1, []
+
+def mkdir_result(retcode, responses, pcspath):
+    responses = json.loads(responses)
+    if retcode == 200 and responses['path'] == pcspath:
+        return 0
+    logger.error('Errno:%d: Create PCS directory "%s" failed: %s.' % (retcode, pcspath, responses['error_msg']))
+    return 1
+
+def delete_result(retcode, responses, pcspath, slient=False):
+    responses, failed = _response(retcode, responses)
+    if failed:
+        if not slient:
+            logger.error('Errno:%d: Delete remote file or directory "%s" failed: %s.' % (retcode, pcspath, responses['error_msg']))
+        return 1
+    if not slient:
+        logger.info(' Delete remote file or directory "%s" completed.' % (pcspath))
+    return 0
+
+def move_result(retcode, responses, oldpcspath, newpcspath, slient=False):
+    responses, failed = _response(retcode, responses)
+    if failed:
+        if not slient:
+            logger.error('Errno:%d: Move remote file or directory "%s" to "%s" failed: %s.' % (retcode, oldpcspath, newpcspath, responses['error_msg']))
+        return 1
+    if not slient:
+        logger.info(' Move remote file or directory "%s" to "%s" completed.' % (oldpcspath, newpcspath))
+    return 0
+
+def copy_result(retcode, responses, srcpcspath, destpcspath):
+    responses, failed = _response(retcode, responses)
+    if failed:
+        logger.error('Errno:%d: Copy remote file or directory "%s" to "%s" failed: %s.' % (retcode, srcpcspath, destpcspath, responses['error_msg']))
+        return 1
+    logger.info(' Copy remote file or directory "%s" to "%s" completed.' % (srcpcspath, destpcspath))
+    return 0
+
+def meta_result(retcode, responses, pcspath, slient=False):
+    responses, failed = _response(retcode, responses)
+    if failed:
+        if not slient:
+            logger.error('Errno:%d: Get file\'s meta failed: %s, %s.' % (retcode, pcspath, responses['error_msg']))
+        return 1, {}
+    return 0, responses['list'][0]
+
+def batch_request(method, chunk):
+    return pcs_request(method, data={'param': json.dumps(batch_param(method, chunk))}, httpmethod='POST')
+
+def batch_chunk_result(retcode, responses, method, chunk, slient=False):
+    """batch_results() of a batch request, None when the batch has to be split."""
+    try:
         responses = json.loads(responses)
-        if retcode != 200 or 'error_code' in responses:
-            logger.error('Errno:%d: Get pcs quota failed: %s.' % (retcode, responses['error_msg']))
-            return 1
-        logger.info(' PCS quota is %dG,used %dG.' % (responses['quota'] / 1024 / 1024 / 1024, responses['used'] / 1024 / 1024 / 1024))
+    except ValueError:
+        responses = {'error_code': retcode, 'error_msg': responses}
+    chunkresults = batch_results(method, chunk, retcode, responses)
+    if chunkresults is not None and (retcode != 200 or 'error_code' in responses) and not slient:
+        logger.error('Errno:%d: Batch %s of %d remote files failed: %s.' % (retcode, method, len(chunk), responses['error_msg']))
+    return chunkresults
+
+def upload_request(filepath, pcspath, ondup='newcopy'):
+    return pcs_request('upload', {'path': pcspath, 'ondup': ondup}, '0-%d' % (os.stat(filepath).st_size - 1), 'POST',
+                       BaiduPcsApi.upload_url + '/file', SynCurl.Upload) + (filepath, )
+
+def upload_result(retcode, responses, filepath):
+    responses, failed = _response(retcode, responses)
+    if failed:
+        logger.error('Errno:%d: Upload file to pcs failed: %s, %s.' % (retcode, filepath, responses['error_msg']))
+        return 1
+    logger.info(' Upload file "%s" completed.' % (filepath))
+    return 0
+
+def rapid_upload_refused(filepath, pcspath):
+    """Log and return 1 when `filepath` cannot be rapid uploaded, 0 when it can."""
+    if os.stat(filepath).st_size <= 262144:
+        logger.error('Rapid upload file "%s" failed: flie size must be greater than or equal to 256KB.' % ( filepath))
+        return 1
+    if SynConfig.config['encryption'] != '0':
+        # the MD5s sent are of the plain data, a match would store the file unencrypted
+        logger.info(' File "%s" is stored encrypted, will upload the whole file.' % (filepath))
+        return 1
+    if compression_for(pcspath) is not None:
+        # the server only knows the MD5s of the compressed data
+        logger.info(' File "%s" is stored compressed, will upload the whole file.' % (filepath))
+        return 1
+    return 0
+
+def rapid_upload_request(filepath, pcspath, checkcode, ondup='newcopy'):
+    crc, contentmd5, slicemd5 = checkcode
+    return pcs_request('rapidupload', {
+            'path': pcspath,
+            'content-length': os.stat(filepath).st_size,
+            'content-md5': contentmd5,
+            'slice-md5': slicemd5,
+            'content-crc32': crc,
+            'ondup': ondup
+            }, httpmethod='POST')
+
+def rapid_upload_result(retcode, responses, filepath):
+    responses, failed = _response(retcode, responses)
+    if failed:
+        if responses['error_code'] == 31079:
+            logger.info(' File md5 not found, will upload the whole file "%s".' % (filepath))
+        else:
+            logger.error('Errno:%d: Rapid upload file "%s" failed: %s.' % (retcode, filepath, responses['error_msg']))
+        return 1
+    return 0
+
+def rapid_upload_meta_result(retcode, responses, filepath):
+    responses, failed = _response(retcode, responses)
+    if failed:
+        logger.error('Errno:%d: File "%s" is rapid uploaded, but get remote file\'s mate failed: %s.' % (retcode, filepath, responses['error_msg']))
+        return 1
+    if responses['list'][0]['size'] == os.stat(filepath).st_size:
+        logger.info(' Rapid upload file "%s" completed.' % (filepath))
         return 0
+    logger.error('File "%s" is rapid uploaded, but remote file size not equal to local.' % (filepath))
+    return 1
+
+def tmpfile_request(filepath, filerange):
+    return pcs_request('upload', {'type': 'tmpfile'}, filerange, 'POST', BaiduPcsApi.upload_url + '/file', SynCurl.Upload) + (filepath, )
+
+def tmpfile_result(retcode, responses, filepath):
+    responses = json.loads(responses)
+    if retcode == 200:
+        return 0, responses['md5']
+    logger.error('Errno:%d: Upload file "%s"\'s extra slice failed: %s.' % (retcode, filepath, responses['error_msg']))
+    return 1, None
+
+def superfile_request(pcspath, param, ondup='newcopy'):
+    return pcs_request('createsuperfile', {'path': pcspath, 'ondup': ondup}, {'param': json.dumps(param)}, 'POST')
+
+def superfile_result(retcode, responses, pcspath):
+    responses, failed = _response(retcode, responses)
+    if failed:
+        logger.error('Errno:%d: Create superfile "%s" failed: %s.' % (retcode, pcspath, responses['error_msg']))
+        return 1
+    logger.info(' Slice upload file "%s" completed.' % (pcspath))
+    return 0
+
+def download_request(filepath, pcspath, filerange):
+    return pcs_request('download', {'path': pcspath}, filerange, 'GET', BaiduPcsApi.download_url + '/file', SynCurl.Download) + (filepath, )
+
+def download_result(retcode, responses, filepath, pcspath):
+    if (retcode != 200 and retcode != 206) or responses != '':
+        responses = json.loads(responses)
+        logger.error('Errno:%d: Download file "%s" failed: %s.' % (retcode, pcspath, responses['error_msg']))
+        return 1
+    logger.info(' download file "%s" completed.', filepath)
+    return 0
+
+def deepest_pcsdirs(pcspaths):
+    """The normalized `pcspaths` and the deepest of them, the only ones ensure_pcsdirs() has to check."""
+    pcspaths = set(PcsDirCache.normalize(pcspath) for pcspath in pcspaths)
+    return pcspaths, sorted(pcspath for pcspath in pcspaths
+                            if not any(other.startswith(pcspath.rstrip('/') + '/') for other in pcspaths))
+
+def missing_pcsdirs(pcspaths):
+    """Log the directories of `pcspaths` still not known to exist; returns 1 if there are any."""
+    missing = [pcspath for pcspath in pcspaths if not BaiduPcsApi.dircache.known(pcspath)]
+    if missing:
+        logger.error('Create PCS directories failed: %s.' % (', '.join(missing)))
+        return 1
+    return 0
+
+class BaiduPcsApi:
+    # base URLs of the PCS REST API, shared with AsyncBaiduPcsApi; tests and
+    # benchmarks point them at a local stand-in server
+    pcs_url = 'https://pcs.baidu.com/rest/2.0/pcs'
+    upload_url = 'https://c.pcs.baidu.com/rest/2.0/pcs'
+    download_url = 'https://d.pcs.baidu.com/rest/2.0/pcs'
+
+    # directories known to exist, used by ensure_pcsdirs()
+    dircache = PcsDirCache()
+
+    @staticmethod
+    def get_pcs_quota():
+        retcode, responses = SynCurl().request(*pcs_request('info', url=BaiduPcsApi.pcs_url + '/quota'))
+        return quota_result(retcode, responses)
 
     @staticmethod
     def get_pcs_filelist(pcspath, startindex, endindex):
-        logger.debug('Start get pcs file list(%d-%d) of "%s".' % (startindex, endindex, pcspath))
-        sycurl = SynCurl()
-        url = 'https://pcs.baidu.com/rest/2.0/pcs/file'
-        querydata = {
-                'method'      : 'list',
-                'access_token': SynConfig.token['access_token'],
-                'path'        : pcspath,
-                'by'          : 'name',
-                'order'       : 'asc',
-                'limit'       : '%d-%d' % (startindex, endindex),
-                }
-        retcode, responses = sycurl.request(url, querydata, '', 'GET', SynCurl.Normal)
+        logger.debug('Start get pcs file list(%d-%d) of "%s".', startindex, endindex, pcspath)
+        retcode, responses = SynCurl().request(*filelist_request(pcspath, startindex, endindex))
         try:
-            responses = json.loads(responses)
-            if retcode != 200 or 'error_code' in responses:
-                if responses['error_code'] == 31066:
-                    return 31066, []
-                else:
-                    logger.error('Errno:%d: Get PCS file list of "%s" failed: %s.' % (retcode, pcspath, responses['error_msg']))
-                    return 1, []
-            return 0, responses['list']
-        except Exception as e:
-            logger.error('Get PCS file list of "%s" failed. return code: %d, response body: %s.\n%s\n%s' % (pcspath, retcode, str(responses), e, traceback.format_exc()))
-            return 1, []
+            return filelist_result(retcode, responses, pcspath)
         finally:
             del responses
-            logger.debug('Complete get pcs file list(%d-%d) of "%s".' % (startindex, endindex, pcspath))
+            logger.debug('Complete get pcs file list(%d-%d) of "%s".', startindex, endindex, pcspath)
+
+    @staticmethod
+    def iter_pcs_filelist(pcspath, page_size=1000):
+        """Yield the entries of a remote directory, one page request at a time.
+
+        The next page is fetched by a background thread while the caller works
+        through the current one. A missing directory (31066) yields nothing;
+        other errors raise PcsError.
+        """
+        pages = queue.Queue(maxsize=1)
+        stopped = threading.Event()
+
+        def fetch_pages():
+            startindex = 0
+            while not stopped.is_set():
+                try:
+                    page = BaiduPcsApi.get_pcs_filelist(pcspath, startindex, startindex + page_size)
+                except Exception as e:
+                    logger.error('Get PCS file list of "%s" failed: %s.\n%s' % (pcspath, e, traceback.format_exc()))
+                    page = (1, [])
+                while not stopped.is_set():
+                    try:
+                        pages.put(page, timeout=1)
+                        break
+                    except queue.Full:
+                        pass
+                if page[0] != 0 or len(page[1]) < page_size:
+                    return
+                startindex += page_size
+
+        fetcher = threading.Thread(target=fetch_pages, daemon=True)
+        fetcher.start()
+        try:
+            while True:
+                ret, filelist = pages.get()
+                if ret == 31066:
+                    return
+                if ret != 0:
+                    raise PcsError(ret, 'Get PCS file list of "%s" failed.' % (pcspath))
+                for entry in filelist:
+                    yield entry
+                if len(filelist) < page_size:
+                    return
+        finally:
+            stopped.set()
 
     @staticmethod
     def create_pcsdir(pcspath):
-        sycurl = SynCurl()
-        url = 'https://pcs.baidu.com/rest/2.0/pcs/file'
-        querydata = {
-                'method': 'mkdir',
-                'access_token': SynConfig.token['access_token'],
-                'path': pcspath
-                }
-        retcode, responses = sycurl.request(url, querydata, '', 'POST', SynCurl.Normal)
-        responses = json.loads(responses)
-        if retcode == 200 and responses['path'] == pcspath:
-            return 0
-        logger.error('Errno:%d: Create PCS directory "%s" failed: %s.' % (retcode, pcspath, responses['error_msg']))
-        return 1
+        retcode, responses = SynCurl().request(*pcs_request('mkdir', {'path': pcspath}, httpmethod='POST'))
+        return mkdir_result(retcode, responses, pcspath)
 
     @staticmethod
     def check_create_pcsdir(pcspath):
-        sycurl = SynCurl()
-        url = 'https://pcs.baidu.com/rest/2.0/pcs/file'
-        querydata = {
-                'method': 'meta',
-                'access_token': SynConfig.token['access_token'],
-                'path': pcspath
-                }
-        retcode, responses = sycurl.request(url, querydata, '', 'GET', SynCurl.Normal)
+        return BaiduPcsApi.ensure_pcsdirs([pcspath])
+
+    @staticmethod
+    def ensure_pcsdirs(pcspaths):
+        """Make sure all the remote directories exist; returns 0 when they all do.
+
+        mkdir creates missing parents, so only the deepest of the given paths
+        are checked, all with batched meta requests, and only the missing ones
+        are created. Directories already known to exist cost no request.
+        """
+        cache = BaiduPcsApi.dircache
+        pcspaths, wanted = deepest_pcsdirs(pcspaths)
+        owned, waiting = cache.claim(wanted)
         try:
-            responses = json.loads(responses)
-            if retcode == 200 and responses['list'][0]['isdir'] == 1:
-                return 0
-            elif (retcode != 200 and responses['error_code'] == 31066) or (retcode == 200 and responses['list'][0]['isdir'] == 0):
-                url = 'https://pcs.baidu.com/rest/2.0/pcs/file'
-                querydata = {
-                        'method': 'mkdir',
-                        'access_token': SynConfig.token['access_token'],
-                        'path': pcspath
-                        }
-                retcode, responses = sycurl.request(url, querydata, '', 'POST', SynCurl.Normal)
-                responses = json.loads(responses)
-                if retcode == 200 and responses['path'] == pcspath:
-                    return 0
-            logger.error('Errno:%d: Create PCS directory "%s" failed: %s.' % (retcode, pcspath, responses['error_msg']))
-            return 1
-        except Exception as e:
-            logger.error('Create PCS directory "%s" failed. return code: %d, response body: %s.\n%s\n%s' % (pcspath, retcode, str(responses), e, traceback.format_exc()))
-            return 1
+            if owned:
+                metas = BaiduPcsApi.get_pcs_filemeta_batch(owned, True)
+                for pcspath, (ret, meta) in zip(owned, metas):
+                    if ret == 0 and meta['isdir'] == 1:
+                        cache.add(pcspath)
+                    elif BaiduPcsApi.create_pcsdir(pcspath) == 0:
+                        cache.add(pcspath)
+        finally:
+            cache.release(owned)
+        for event in waiting:
+            event.wait()
+        return missing_pcsdirs(pcspaths)
 
     @staticmethod
     def rm_pcsfile(pcspath, slient=False):
-        sycurl = SynCurl()
-        url = 'https://pcs.baidu.com/rest/2.0/pcs/file'
-        querydata = {
-                'method': 'delete',
-                'access_token': SynConfig.token['access_token'],
-                'path': pcspath
-                }
-        retcode, responses = sycurl.request(url, querydata, '', 'POST', SynCurl.Normal)
-        responses = json.loads(responses)
-        if retcode != 200 or 'error_code' in responses:
-            if not slient:
-                logger.error('Errno:%d: Delete remote file or directory "%s" failed: %s.' % (retcode, pcspath, responses['error_msg']))
-            return 1
-        if not slient:
-            logger.info(' Delete remote file or directory "%s" completed.' % (pcspath))
-        return 0
+        BaiduPcsApi.dircache.invalidate(pcspath)
+        retcode, responses = SynCurl().request(*pcs_request('delete', {'path': pcspath}, httpmethod='POST'))
+        return delete_result(retcode, responses, pcspath, slient)
 
     @staticmethod
     def mv_pcsfile(oldpcspath, newpcspath, slient=False):
-        sycurl = SynCurl()
-        url = 'https://pcs.baidu.com/rest/2.0/pcs/file'
-        querydata = {
-                'method': 'move',
-                'access_token': SynConfig.token['access_token'],
-                'from': oldpcspath,
-                'to': newpcspath
-                }
-        retcode, responses = sycurl.request(url, querydata, '', 'POST', SynCurl.Normal)
-        responses = json.loads(responses)
-        if retcode != 200 or 'error_code' in responses:
-            if not slient:
-                logger.error('Errno:%d: Move remote file or directory "%s" to "%s" failed: %s.' % (retcode, oldpcspath, newpcspath, responses['error_msg']))
-            return 1
-        if not slient:
-            logger.info(' Move remote file or directory "%s" to "%s" completed.' % (oldpcspath, newpcspath))
-        return 0
+        BaiduPcsApi.dircache.invalidate(oldpcspath)
+        retcode, responses = SynCurl().request(*pcs_request('move', {'from': oldpcspath, 'to': newpcspath}, httpmethod='POST'))
+        return move_result(retcode, responses, oldpcspath, newpcspath, slient)
 
     @staticmethod
     def cp_pcsfile(srcpcspath, destpcspath):
-        sycurl = SynCurl()
-        url = 'https://pcs.baidu.com/rest/2.0/pcs/file'
-        querydata = {
-                'method': 'copy',
-                'access_token': SynConfig.token['access_token'],
-                'from': srcpcspath,
-                'to': destpcspath
-                }
-        retcode, responses = sycurl.request(url, querydata, '', 'POST', SynCurl.Normal)
-        responses = json.loads(responses)
-        if retcode != 200 or 'error_code' in responses:
-            logger.error('Errno:%d: Copy remote file or directory "%s" to "%s" failed: %s.' % (retcode, srcpcspath, destpcspath, responses['error_msg']))
-            return 1
-        logger.info(' Copy remote file or directory "%s" to "%s" completed.' % (srcpcspath, destpcspath))
-        return 0
+        retcode, responses = SynCurl().request(*pcs_request('copy', {'from': srcpcspath, 'to': destpcspath}, httpmethod='POST'))
+        return copy_result(retcode, responses, srcpcspath, destpcspath)
+
+    @staticmethod
+    def get_pcs_filemeta(pcspath, slient=False):
+        retcode, responses = SynCurl().request(*pcs_request('meta', {'path': pcspath}))
+        return meta_result(retcode, responses, pcspath, slient)
 
     @staticmethod
-    def get_pcs_filemeta(pcspath):
+    def _batch(method, items, single, slient=False):
+        """Run a batched `method` over `items`, BATCH_SIZE per request.
+
+        A batch the server rejects because of some of its items is split in
+        halves and each half sent again, so the few bad items cost a handful
+        of requests instead of one per item; `single(item)` handles an item
+        left on its own.
+        """
         sycurl = SynCurl()
-        url = 'https://pcs.baidu.com/rest/2.0/pcs/file'
-        querydata = {
-                'method': 'meta',
-                'access_token': SynConfig.token['access_token'],
-                'path': pcspath
-                }
-        retcode, responses = sycurl.request(url, querydata, '', 'GET', SynCurl.Normal)
-        responses = json.loads(responses)
-        if retcode != 200 or 'error_code' in responses:
-            logger.error('Errno:%d: Get file\'s meta failed: %s, %s.' % (retcode, pcspath, responses['error_msg']))
-            return 1, {}
-        return 0, responses['list'][0]
+
+        def run_chunk(chunk, rejected=False):
+            if len(chunk) == 1 and rejected:
+                return [single(chunk[0])]
+            retcode, responses = sycurl.request(*batch_request(method, chunk))
+            chunkresults = batch_chunk_result(retcode, responses, method, chunk, slient)
+            if chunkresults is None:
+                middle = len(chunk) // 2
+                return run_chunk(chunk[:middle], True) + run_chunk(chunk[middle:], True)
+            return chunkresults
+
+        results = []
+        for i in range(0, len(items), BATCH_SIZE):
+            results.extend(run_chunk(items[i:i + BATCH_SIZE]))
+        return results
+
+    @staticmethod
+    def get_pcs_filemeta_batch(pcspaths, slient=False):
+        """The meta of many paths with one request per BATCH_SIZE paths, as get_pcs_filemeta() (errno, meta) tuples in order."""
+        return BaiduPcsApi._batch('meta', list(pcspaths), lambda pcspath: BaiduPcsApi.get_pcs_filemeta(pcspath, slient), slient)
+
+    @staticmethod
+    def rm_pcsfiles(pcspaths, slient=False):
+        """Delete many remote files or directories in batches; returns 0/1 for each path."""
+        for pcspath in pcspaths:
+            BaiduPcsApi.dircache.invalidate(pcspath)
+        results = BaiduPcsApi._batch('delete', list(pcspaths), lambda pcspath: BaiduPcsApi.rm_pcsfile(pcspath, slient), slient)
+        if not slient:
+            logger.info(' Delete %d of %d remote files or directories completed.' % (results.count(0), len(results)))
+        return results
 
     @staticmethod
-    def upload_file(filepath, pcspath):
-        logger.debug('start upload whole file "%s".' % (filepath))
+    def mv_pcsfiles(pairs, slient=False):
+        """Move many (from, to) pairs in batches; returns 0/1 for each pair."""
+        for pair in pairs:
+            BaiduPcsApi.dircache.invalidate(pair[0])
+        results = BaiduPcsApi._batch('move', [tuple(pair) for pair in pairs], lambda pair: BaiduPcsApi.mv_pcsfile(pair[0], pair[1], slient), slient)
+        if not slient:
+            logger.info(' Move %d of %d remote files or directories completed.' % (results.count(0), len(results)))
+        return results
+
+    @staticmethod
+    def cp_pcsfiles(pairs):
+        """Copy many (from, to) pairs in batches; returns 0/1 for each pair."""
+        results = BaiduPcsApi._batch('copy', [tuple(pair) for pair in pairs], lambda pair: BaiduPcsApi.cp_pcsfile(pair[0], pair[1]))
+        logger.info(' Copy %d of %d remote files or directories completed.' % (results.count(0), len(results)))
+        return results
+
+    @staticmethod
+    def upload_file(filepath, pcspath, ondup='newcopy'):
+        logger.debug('start upload whole file "%s".', filepath)
         sycurl = SynCurl()
-        url = 'https://c.pcs.baidu.com/rest/2.0/pcs/file'
-        querydata = {
-                'method': 'upload',
-                'access_token': SynConfig.token['access_token'],
-                'path': pcspath,
-                'ondup': 'newcopy'
-                }
-        retcode, responses = sycurl.request(url, querydata, '0-%d' % (os.stat(filepath).st_size - 1), 'POST', SynCurl.Upload, filepath)
-        responses = json.loads(responses)
-        if retcode != 200 or 'error_code' in responses:
-            logger.error('Errno:%d: Upload file to pcs failed: %s, %s.' % (retcode, filepath, responses['error_msg']))
-            return 1
-        logger.info(' Upload file "%s" completed.' % (filepath))
-        return 0
+        sycurl.compress = compression_for(pcspath)
+        retcode, responses = sycurl.request(*upload_request(filepath, pcspath, ondup))
+        return upload_result(retcode, responses, filepath)
 
     @staticmethod
-    def __rapid_checkcode(filepath):
-        with open(filepath, 'rb') as fh:
-            m = hashlib.md5()
-            fbuffer = fh.read(8192)
-            crc = 0
-            while fbuffer:
-                m.update(fbuffer)
-                crc = binascii.crc32(fbuffer, crc) & 0xffffffff
-                fbuffer = fh.read(8192)
-            cmd5 = m.hexdigest()
-            m = hashlib.md5()
-            fh.seek(0)
-            for i in range(32):
-                fbuffer = fh.read(8192)
-                m.update(fbuffer)
-        return '%x' % crc, cmd5, m.hexdigest()
+    def _rapid_checkcode(filepath):
+        checksums = get_checksums(filepath)
+        return checksums['crc32'], checksums['md5'], checksums['slicemd5']
 
     @staticmethod
-    def rapid_uploadfile(filepath, pcspath):
-        if os.stat(filepath).st_size <= 262144:
-            logger.error('Rapid upload file "%s" failed: flie size must be greater than or equal to 256KB.' % ( filepath))
+    def rapid_uploadfile(filepath, pcspath, ondup='newcopy'):
+        if rapid_upload_refused(filepath, pcspath):
             return 1
 
-        logger.debug('start rapid upload file "%s".' % (filepath))
-        crc, contentmd5, slicemd5 = BaiduPcsApi.__rapid_checkcode(filepath)
+        logger.debug('start rapid upload file "%s".', filepath)
+        checkcode = BaiduPcsApi._rapid_checkcode(filepath)
         sycurl = SynCurl()
-        url = 'https://pcs.baidu.com/rest/2.0/pcs/file'
-        querydata = {
-                'method': 'rapidupload',
-                'access_token': SynConfig.token['access_token'],
-                'path': pcspath,
-                'content-length': os.stat(filepath).st_size,
-                'content-md5': contentmd5,
-                'slice-md5': slicemd5,
-                'content-crc32': crc,
-                'ondup': 'newcopy'
-                }
-        retcode, responses = sycurl.request(url, querydata, '', 'POST', SynCurl.Normal)
-        responses = json.loads(responses)
-        if retcode != 200 or 'error_code' in responses:
-            if responses['error_code'] == 31079:
-                logger.info(' File md5 not found, will upload the whole file "%s".' % (filepath))
-                return 1
-            else:
-                logger.error('Errno:%d: Rapid upload file "%s" failed: %s.' % (retcode, filepath, responses['error_msg']))
-                return 1
-        else:
-            time.sleep(1)
-            url = 'https://pcs.baidu.com/rest/2.0/pcs/file'
-            querydata = {
-                    'method': 'meta',
-                    'access_token': SynConfig.token['access_token'],
-                    'path': pcspath
-                    }
-            retcode, responses = sycurl.request(url, querydata, '', 'GET', SynCurl.Normal)
-            responses = json.loads(responses)
-            if retcode != 200 or 'error_code' in responses:
-                logger.error('Errno:%d: File "%s" is rapid uploaded, but get remote file\'s mate failed: %s.' % (retcode, filepath, responses['error_msg']))
-                return 1
-            responses = responses['list'][0]
-            if responses['size'] == os.stat(filepath).st_size:
-                logger.info(' Rapid upload file "%s" completed.' % (filepath))
-                return 0
-            else:
-                logger.error('File "%s" is rapid uploaded, but remote file size not equal to local.' % (filepath))
-                return 1
+        retcode, responses = sycurl.request(*rapid_upload_request(filepath, pcspath, checkcode, ondup))
+        if rapid_upload_result(retcode, responses, filepath) != 0:
+            return 1
+        time.sleep(1)
+        retcode, responses = sycurl.request(*pcs_request('meta', {'path': pcspath}))
+        return rapid_upload_meta_result(retcode, responses, filepath)
 
     @staticmethod
     def slice_upload_tmpfile(filepath, filerange):
-        logger.debug('start slice upload file "%s".' % (filepath))
-        sycurl = SynCurl()
-        url = 'https://c.pcs.baidu.com/rest/2.0/pcs/file'
-        querydata = {
-                'method': 'upload',
-                'access_token': SynConfig.token['access_token'],
-                'type': 'tmpfile'
-                }
-        retcode, responses = sycurl.request(url, querydata, filerange, 'POST', SynCurl.Upload, filepath)
-        responses = json.loads(responses)
-        if retcode == 200:
-            return 0, responses['md5']
-        else:
-            logger.error('Errno:%d: Upload file "%s"\'s extra slice failed: %s.' % (retcode, filepath, responses['error_msg']))
-            return 1, None
+        logger.debug('start slice upload file "%s".', filepath)
+        retcode, responses = SynCurl().request(*tmpfile_request(filepath, filerange))
+        return tmpfile_result(retcode, responses, filepath)
 
     @staticmethod
-    def slice_upload_createsuperfile(pcspath, param):
-        sycurl = SynCurl()
-        url = 'https://pcs.baidu.com/rest/2.0/pcs/file'
-        querydata = {
-                'method': 'createsuperfile',
-                'access_token': SynConfig.token['access_token'],
-                'path': pcspath,
-                'ondup': 'newcopy'
-                }
-        retcode, responses = sycurl.request(url, querydata, {'param': json.dumps(param)}, 'POST', SynCurl.Normal)
-        responses = json.loads(responses)
-        if retcode != 200 or 'error_code' in responses:
-            logger.error('Errno:%d: Create superfile "%s" failed: %s.' % (retcode, pcspath, responses['error_msg']))
+    def slice_upload_createsuperfile(pcspath, param, ondup='newcopy'):
+        retcode, responses = SynCurl().request(*superfile_request(pcspath, param, ondup))
+        return superfile_result(retcode, responses, pcspath)
+
+    @staticmethod
+    def parallel_upload(filepath, pcspath, slice_size=None, workers=None, ondup='newcopy', reuse=()):
+        """Upload a file as concurrent tmpfile slices and join them with createsuperfile.
+
+        Without `slice_size` and `workers` the shared AdaptiveController
+        decides both as the upload runs. Finished slices are remembered on
+        disk, so calling it again after a failure only uploads the missing ones.
+        `reuse` lists (startpos, endpos, md5) blocks already on the server that
+        are joined in without uploading them again.
+        """
+        if compression_for(pcspath) is not None:
+            # compressed files only go up whole, slices could not be joined
+            return BaiduPcsApi.upload_file(filepath, pcspath, ondup)
+        controller = None
+        if slice_size is None and workers is None:
+            controller = get_controller()
+            slice_size = controller.slicesize
+            workers = controller.maxworkers
+        else:
+            if slice_size is None:
+                slice_size = SynConfig.config.get('slicesize', 4 * 1024 * 1024)
+            if workers is None:
+                workers = SynConfig.config['threadnumber']
+        # every slice has to start on an encryption block boundary
+        align = transfer_align()
+        slice_size = (slice_size + align - 1) // align * align
+        filesize = os.stat(filepath).st_size
+        if filesize <= slice_size:
+            return BaiduPcsApi.upload_file(filepath, pcspath, ondup)
+
+        logger.debug('start parallel upload file "%s".', filepath)
+        state = SliceUploadState(filepath, pcspath)
+        for block in reuse:
+            state.reuse(*block)
+        jobs = [SliceUploadJob(filepath, state, slice_size, controller) for _ in range(min(workers, (filesize + slice_size - 1) // slice_size))]
+        if run_jobs(jobs, filesize) != 0:
+            state.failed = True
+        block_list = state.block_list()
+        if state.failed or block_list is None:
+            logger.error('Parallel upload file "%s" failed: %d slices uploaded.' % (filepath, len(state.slices)))
+            return 1
+        if BaiduPcsApi.slice_upload_createsuperfile(pcspath, {'block_list': block_list}, ondup) != 0:
             return 1
-        logger.info(' Slice upload file "%s" completed.' % (pcspath))
+        state.save_layout()
+        state.remove()
         return 0
 
     @staticmethod
-    def download_file(filepath, pcspath, filerange):
-        logger.debug('start download file "%s" : range %s.' % (filepath, filerange))
-        sycurl = SynCurl()
-        url = 'https://d.pcs.baidu.com/rest/2.0/pcs/file'
-        querydata = {
-                'method': 'download',
-                'access_token': SynConfig.token['access_token'],
-                'path': pcspath
-                }
-        retcode, responses = sycurl.request(url, querydata, filerange, 'GET', SynCurl.Download, filepath)
-        if (retcode != 200 and retcode != 206) or responses != '':
-            responses = json.loads(responses)
-            logger.error('Errno:%d: Download file "%s" failed: %s.' % (retcode, pcspath, responses['error_msg']))
+    def _block_ranges(pcspath, meta, slice_size):
+        """(startpos, endpos, md5) of the blocks of a remote file, None if they can't be worked out."""
+        try:
+            md5s = json.loads(meta['block_list'])
+        except (KeyError, TypeError, ValueError):
+            return None
+        size = meta['size']
+        if not md5s or size == 0:
+            return None
+        layout = SliceUploadState.load_layout(pcspath)
+        if layout and [md5 for _, _, md5 in layout] == md5s and layout[-1][1] == size - 1:
+            return layout
+        # not uploaded from here: try evenly sized blocks
+        for blocksize in (slice_size, BLOCK_SIZE, size):
+            if (size + blocksize - 1) // blocksize == len(md5s):
+                return [(pos, min(pos + blocksize, size) - 1, md5) for pos, md5 in zip(range(0, size, blocksize), md5s)]
+        return None
+
+    @staticmethod
+    def _range_md5(fh, startpos, endpos):
+        """MD5 of a file range as slice_upload_tmpfile() sends it, i.e. encrypted when encryption is on."""
+        stage = make_cipher_stage(True)
+        md5 = hashlib.md5()
+        fh.seek(startpos)
+        remaining = endpos - startpos + 1
+        while remaining > 0:
+            data = fh.read(min(remaining, 1024 * 1024))
+            if not data:
+                return None
+            remaining -= len(data)
+            md5.update(stage.process(data) if stage is not None else data)
+        if stage is not None:
+            md5.update(stage.flush())
+        return md5.hexdigest()
+
+    @staticmethod
+    def unchanged_blocks(filepath, ranges):
+        """The (startpos, endpos, md5) `ranges` whose content in the local file still has that MD5.
+
+        With encryption on, a range is only reused when it starts and ends on
+        cipher block boundaries: the slices uploaded next to it have to start
+        on one, and a range that was uploaded off them would not decrypt.
+        """
+        filesize = os.stat(filepath).st_size
+        cipherblock = SynConfig.config.get('encryptblocksize', 4096) if SynConfig.config['encryption'] != '0' else 1
+        blocks = None
+        unchanged = []
+        with open(filepath, 'rb') as fh:
+            for startpos, endpos, md5 in ranges:
+                # the last block may be short, which is only right at the end of the file
+                if endpos >= filesize or (endpos == ranges[-1][1] and endpos != filesize - 1):
+                    continue
+                if startpos % cipherblock != 0 or ((endpos + 1) % cipherblock != 0 and endpos != filesize - 1):
+                    continue
+                if SynConfig.config['encryption'] == '0' and startpos % BLOCK_SIZE == 0 and endpos == min(startpos + BLOCK_SIZE, filesize) - 1:
+                    # the 4MB block MD5s are in the checksum cache already
+                    if blocks is None:
+                        blocks = get_checksums(filepath)['blocks']
+                    localmd5 = blocks[startpos // BLOCK_SIZE]
+                else:
+                    localmd5 = BaiduPcsApi._range_md5(fh, startpos, endpos)
+                if localmd5 == md5:
+                    unchanged.append((startpos, endpos, md5))
+        return unchanged
+
+    @staticmethod
+    def incremental_upload(filepath, pcspath, slice_size=None, workers=None):
+        """Overwrite `pcspath` with a modified `filepath`, uploading only the blocks that changed.
+
+        The remote block_list is matched with the slices recorded by the last
+        upload of `pcspath` from here, or else with evenly sized blocks. Local
+        ranges that still hash to their remote block are joined into the new
+        superfile as they are; everything else goes through parallel_upload().
+        """
+        if compression_for(pcspath) is not None:
+            return BaiduPcsApi.upload_file(filepath, pcspath, 'overwrite')
+        blocksize = slice_size or SynConfig.config.get('slicesize', 4 * 1024 * 1024)
+        ret, meta = BaiduPcsApi.get_pcs_filemeta(pcspath, True)
+        ranges = BaiduPcsApi._block_ranges(pcspath, meta, blocksize) if ret == 0 and not meta['isdir'] else None
+        reuse = BaiduPcsApi.unchanged_blocks(filepath, ranges) if ranges else []
+        if ranges is not None:
+            logger.info(' Incremental upload file "%s": %d of %d blocks unchanged.' % (filepath, len(reuse), len(ranges)))
+        return BaiduPcsApi.parallel_upload(filepath, pcspath, slice_size, workers, 'overwrite', reuse)
+
+    @staticmethod
+    def parallel_download(filepath, pcspath, segments=None):
+        """Download a remote file over `segments` concurrent range requests.
+
+        The local file is preallocated to the remote size first; idle workers
+        then take over the tail of the slowest remaining range. Without
+        `segments` the shared AdaptiveController decides how many ranges run
+        at once.
+        """
+        controller = None
+        workers = segments
+        if segments is None:
+            controller = get_controller()
+            segments = controller.limit
+            workers = controller.maxworkers
+        ret, meta = BaiduPcsApi.get_pcs_filemeta(pcspath)
+        if ret != 0:
             return 1
-        logger.info(' download file "%s" completed.' % (filepath))
+        filesize = meta['size']
+        if compression_for(pcspath) is not None:
+            # a compressed file can only be decompressed from start to end
+            return BaiduPcsApi.download_file(filepath, pcspath, '0-%d' % (filesize - 1))
+        logger.debug('start parallel download file "%s" in %d segments.', filepath, segments)
+        with open(filepath, 'wb'):
+            pass
+        writer = FileWriter(filepath, filesize)
+        download = ParallelDownload(filepath, pcspath, filesize, segments)
+        if run_jobs([SegmentDownloadJob(download, writer, controller) for _ in range(workers)], filesize) != 0:
+            download.failed = True
+        writer.close(not download.failed)
+        if download.failed:
+            logger.error('Parallel download file "%s" failed.' % (pcspath))
+            return 1
+        logger.info(' Parallel download file "%s" completed.' % (filepath))
         return 0
+
+    @staticmethod
+    def download_file(filepath, pcspath, filerange, sycurl=None, writer=None):
+        logger.debug('start download file "%s" : range %s.', filepath, filerange)
+        if sycurl is None:
+            sycurl = SynCurl()
+        sycurl.compress = compression_for(pcspath)
+        retcode, responses = sycurl.request(*download_request(filepath, pcspath, filerange), writer=writer)
+        return download_result(retcode, responses, filepath, pcspath)
+
+
+class AsyncBaiduPcsApi:
+    """ Awaitable counterparts of the BaiduPcsApi methods.
+
+    All requests of one instance share an AsyncSynCurl, so they run as
+    non-blocking curl transfers on the event loop. Return values are the
+    same as those of BaiduPcsApi.
+    """
+
+    def __init__(self, concurrency=64, loop=None):
+        self.concurrency = concurrency
+        self.__sycurl = AsyncSynCurl(loop)
+
+    def close(self):
+        self.__sycurl.close()
+
+    async def get_pcs_quota(self):
+        retcode, responses = await self.__sycurl.request(*pcs_request('info', url=BaiduPcsApi.pcs_url + '/quota'))
+        return quota_result(retcode, responses)
+
+    async def get_pcs_filelist(self, pcspath, startindex, endindex):
+        logger.debug('Start get pcs file list(%d-%d) of "%s".', startindex, endindex, pcspath)
+        retcode, responses = await self.__sycurl.request(*filelist_request(pcspath, startindex, endindex))
+        try:
+            return filelist_result(retcode, responses, pcspath)
+        finally:
+            logger.debug('Complete get pcs file list(%d-%d) of "%s".', startindex, endindex, pcspath)
+
+    async def create_pcsdir(self, pcspath):
+        retcode, responses = await self.__sycurl.request(*pcs_request('mkdir', {'path': pcspath}, httpmethod='POST'))
+        return mkdir_result(retcode, responses, pcspath)
+
+    async def check_create_pcsdir(self, pcspath):
+        return await self.ensure_pcsdirs([pcspath])
+
+    async def ensure_pcsdirs(self, pcspaths):
+        """BaiduPcsApi.ensure_pcsdirs() on the event loop, sharing its cache and the directories being checked."""
+        cache = BaiduPcsApi.dircache
+        pcspaths, wanted = deepest_pcsdirs(pcspaths)
+        owned, waiting = cache.claim(wanted)
+        try:
+            if owned:
+                metas = await self.get_pcs_filemeta_batch(owned, True)
+                for pcspath, (ret, meta) in zip(owned, metas):
+                    if ret == 0 and meta['isdir'] == 1:
+                        cache.add(pcspath)
+                    elif await self.create_pcsdir(pcspath) == 0:
+                        cache.add(pcspath)
+        finally:
+            cache.release(owned)
+        for event in waiting:
+            # the owner may be another thread, or a coroutine that needs the loop to finish
+            await asyncio.get_running_loop().run_in_executor(None, event.wait)
+        return missing_pcsdirs(pcspaths)
+
+    async def rm_pcsfile(self, pcspath, slient=False):
+        BaiduPcsApi.dircache.invalidate(pcspath)
+        retcode, responses = await self.__sycurl.request(*pcs_request('delete', {'path': pcspath}, httpmethod='POST'))
+        return delete_result(retcode, responses, pcspath, slient)
+
+    async def mv_pcsfile(self, oldpcspath, newpcspath, slient=False):
+        BaiduPcsApi.dircache.invalidate(oldpcspath)
+        retcode, responses = await self.__sycurl.request(*pcs_request('move', {'from': oldpcspath, 'to': newpcspath}, httpmethod='POST'))
+        return move_result(retcode, responses, oldpcspath, newpcspath, slient)
+
+    async def cp_pcsfile(self, srcpcspath, destpcspath):
+        retcode, responses = await self.__sycurl.request(*pcs_request('copy', {'from': srcpcspath, 'to': destpcspath}, httpmethod='POST'))
+        return copy_result(retcode, responses, srcpcspath, destpcspath)
+
+    async def get_pcs_filemeta(self, pcspath, slient=False):
+        retcode, responses = await self.__sycurl.request(*pcs_request('meta', {'path': pcspath}))
+        return meta_result(retcode, responses, pcspath, slient)
+
+    async def gather_meta(self, pcspaths, concurrency=None):
+        """Fetch the meta of every path with at most `concurrency` requests in flight.
+
+        Results are returned in the order of `pcspaths`, as the (errno, meta)
+        tuples of get_pcs_filemeta().
+        """
+        semaphore = asyncio.Semaphore(concurrency or self.concurrency)
+
+        async def get_meta(pcspath):
+            async with semaphore:
+                return await self.get_pcs_filemeta(pcspath)
+
+        return await asyncio.gather(*[get_meta(pcspath) for pcspath in pcspaths])
+
+    async def _batch(self, method, items, single, slient=False):
+        """BaiduPcsApi._batch() with the batches, and the halves of rejected ones, sent concurrently."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run_chunk(chunk, rejected=False):
+            if len(chunk) == 1 and rejected:
+                return [await single(chunk[0])]
+            async with semaphore:
+                retcode, responses = await self.__sycurl.request(*batch_request(method, chunk))
+            chunkresults = batch_chunk_result(retcode, responses, method, chunk, slient)
+            if chunkresults is None:
+                middle = len(chunk) // 2
+                halves = await asyncio.gather(run_chunk(chunk[:middle], True), run_chunk(chunk[middle:], True))
+                return halves[0] + halves[1]
+            return chunkresults
+
+        chunks = await asyncio.gather(*[run_chunk(items[i:i + BATCH_SIZE]) for i in range(0, len(items), BATCH_SIZE)])
+        return [result for chunkresults in chunks for result in chunkresults]
+
+    async def get_pcs_filemeta_batch(self, pcspaths, slient=False):
+        return await self._batch('meta', list(pcspaths), lambda pcspath: self.get_pcs_filemeta(pcspath, slient), slient)
+
+    async def rm_pcsfiles(self, pcspaths, slient=False):
+        for pcspath in pcspaths:
+            BaiduPcsApi.dircache.invalidate(pcspath)
+        results = await self._batch('delete', list(pcspaths), lambda pcspath: self.rm_pcsfile(pcspath, slient), slient)
+        if not slient:
+            logger.info(' Delete %d of %d remote files or directories completed.' % (results.count(0), len(results)))
+        return results
+
+    async def mv_pcsfiles(self, pairs, slient=False):
+        for pair in pairs:
+            BaiduPcsApi.dircache.invalidate(pair[0])
+        results = await self._batch('move', [tuple(pair) for pair in pairs], lambda pair: self.mv_pcsfile(pair[0], pair[1], slient), slient)
+        if not slient:
+            logger.info(' Move %d of %d remote files or directories completed.' % (results.count(0), len(results)))
+        return results
+
+    async def cp_pcsfiles(self, pairs):
+        results = await self._batch('copy', [tuple(pair) for pair in pairs], lambda pair: self.cp_pcsfile(pair[0], pair[1]))
+        logger.info(' Copy %d of %d remote files or directories completed.' % (results.count(0), len(results)))
+        return results
+
+    async def upload_file(self, filepath, pcspath):
+        logger.debug('start upload whole file "%s".', filepath)
+        compress = compression_for(pcspath)
+        if compress is not None:
+            # measure the compressed length off the event loop, the request then finds it cached
+            await asyncio.get_running_loop().run_in_executor(None, compressed_size, filepath, upload_compression(filepath, compress))
+        retcode, responses = await self.__sycurl.request(*upload_request(filepath, pcspath), compress=compress)
+        return upload_result(retcode, responses, filepath)
+
+    async def rapid_uploadfile(self, filepath, pcspath):
+        if rapid_upload_refused(filepath, pcspath):
+            return 1
+
+        logger.debug('start rapid upload file "%s".', filepath)
+        checkcode = await asyncio.get_running_loop().run_in_executor(None, BaiduPcsApi._rapid_checkcode, filepath)
+        retcode, responses = await self.__sycurl.request(*rapid_upload_request(filepath, pcspath, checkcode))
+        if rapid_upload_result(retcode, responses, filepath) != 0:
+            return 1
+        await asyncio.sleep(1)
+        retcode, responses = await self.__sycurl.request(*pcs_request('meta', {'path': pcspath}))
+        return rapid_upload_meta_result(retcode, responses, filepath)
+
+    async def slice_upload_tmpfile(self, filepath, filerange):
+        logger.debug('start slice upload file "%s".', filepath)
+        retcode, responses = await self.__sycurl.request(*tmpfile_request(filepath, filerange))
+        return tmpfile_result(retcode, responses, filepath)
+
+    async def slice_upload_createsuperfile(self, pcspath, param):
+        retcode, responses = await self.__sycurl.request(*superfile_request(pcspath, param))
+        return superfile_result(retcode, responses, pcspath)
+
+    async def download_file(self, filepath, pcspath, filerange):
+        logger.debug('start download file "%s" : range %s.', filepath, filerange)
+        retcode, responses = await self.__sycurl.request(*download_request(filepath, pcspath, filerange), compress=compression_for(pcspath))
+        return download_result(retcode, responses, filepath, pcspath)
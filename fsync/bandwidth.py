@@ -0,0 +1,113 @@
+import threading
+import time
+
+from fsync.conf import SynConfig
+
+class TokenBucket:
+    """ Thread-safe token bucket; `rate` is in bytes per second, 0 means unlimited. """
+
+    def __init__(self, rate=0):
+        self.__lock = threading.Lock()
+        self.__rate = 0
+        self.__tokens = 0.0
+        self.__last = time.time()
+        self.set_rate(rate)
+
+    @property
+    def rate(self):
+        return self.__rate
+
+    def set_rate(self, rate):
+        with self.__lock:
+            if rate != self.__rate:
+                self.__rate = rate
+                self.__tokens = min(self.__tokens, float(rate))
+                self.__last = time.time()
+
+    def consume(self, size):
+        """Take `size` bytes worth of tokens; returns how long the caller should wait."""
+        with self.__lock:
+            if self.__rate <= 0:
+                return 0
+            now = time.time()
+            # at most one second of unused bandwidth is saved up for bursts
+            self.__tokens = min(self.__tokens + (now - self.__last) * self.__rate, float(self.__rate))
+            self.__last = now
+            self.__tokens -= size
+            if self.__tokens >= 0:
+                return 0
+            return -self.__tokens / self.__rate
+
+def parse_schedule(period, sendspeed, recvspeed):
+    """Parse speedlimitperiod into (starthour, endhour, sendspeed, recvspeed) windows.
+
+    The value is a comma separated list of 'start-end' hour windows, each
+    optionally followed by '@send/recv' speeds in bytes per second which
+    override maxsendspeed/maxrecvspeed, e.g. '8-12,13-18@1048576/2097152'.
+    A window whose end is before its start runs over midnight.
+    """
+    windows = []
+    for item in period.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        speeds = None
+        if '@' in item:
+            item, speeds = item.split('@', 1)
+        starthour, endhour = item.split('-', 1)
+        send, recv = sendspeed, recvspeed
+        if speeds is not None:
+            send, recv = speeds.split('/', 1)
+        windows.append((int(starthour), int(endhour), int(send), int(recv)))
+    return windows
+
+class BandwidthLimiter:
+    """ Process-wide send and receive limits shared by every transfer.
+
+    Transfers report the bytes they moved and wait for the returned time, so
+    the limit is split among whichever transfers are active at the moment.
+    The schedule is checked again every second, so running transfers follow
+    a window as it opens or closes.
+    """
+
+    def __init__(self, windows):
+        self.windows = windows
+        self.send = TokenBucket()
+        self.recv = TokenBucket()
+        self.__checked = 0
+        self.refresh()
+
+    @property
+    def configured(self):
+        return any(send > 0 or recv > 0 for _, _, send, recv in self.windows)
+
+    def refresh(self, now=None):
+        if now is None:
+            now = time.time()
+        self.__checked = now
+        curhour = time.localtime(now).tm_hour
+        send = recv = 0
+        for starthour, endhour, wsend, wrecv in self.windows:
+            if (endhour > starthour and starthour <= curhour < endhour) or (endhour < starthour and (curhour < starthour or curhour >= endhour)):
+                send, recv = wsend, wrecv
+                break
+        self.send.set_rate(send)
+        self.recv.set_rate(recv)
+
+    def throttle(self, sent, received):
+        """Account for bytes moved by a transfer; returns the seconds it should pause."""
+        now = time.time()
+        if now - self.__checked >= 1:
+            self.refresh(now)
+        return max(self.send.consume(sent), self.recv.consume(received))
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+def get_limiter():
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = BandwidthLimiter(parse_schedule(SynConfig.config['speedlimitperiod'],
+                                                       SynConfig.config['maxsendspeed'], SynConfig.config['maxrecvspeed']))
+        return _limiter
@@ -0,0 +1,110 @@
+import binascii
+import hashlib
+import json
+import mmap
+import os
+import sqlite3
+import threading
+
+from fsync.common.log import logger
+from fsync.conf import SynConfig
+
+# PCS block_list entries are MD5s of 4MB blocks
+BLOCK_SIZE = 4 * 1024 * 1024
+# rapidupload's slice-md5 covers the first 256KB
+SLICE_SIZE = 262144
+
+def compute_checksums(filepath):
+    """Hash a file in one pass over a read-only memory map.
+
+    Returns a dict with the file size, content MD5, CRC32, slice MD5 and the
+    MD5 of every 4MB block.
+    """
+    md5 = hashlib.md5()
+    crc = 0
+    blocks = []
+    with open(filepath, 'rb') as fh:
+        size = os.fstat(fh.fileno()).st_size
+        if size == 0:
+            return {'size': 0, 'md5': md5.hexdigest(), 'crc32': '0', 'slicemd5': md5.hexdigest(), 'blocks': []}
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if hasattr(mm, 'madvise'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mm)
+            try:
+                slicemd5 = hashlib.md5(view[0:SLICE_SIZE]).hexdigest()
+                for pos in range(0, size, BLOCK_SIZE):
+                    block = view[pos:pos + BLOCK_SIZE]
+                    md5.update(block)
+                    crc = binascii.crc32(block, crc)
+                    blocks.append(hashlib.md5(block).hexdigest())
+                    block.release()
+            finally:
+                view.release()
+        finally:
+            mm.close()
+    return {'size': size, 'md5': md5.hexdigest(), 'crc32': '%x' % (crc & 0xffffffff), 'slicemd5': slicemd5, 'blocks': blocks}
+
+class ChecksumCache:
+    """ On-disk cache of compute_checksums() results.
+
+    Entries are keyed by (device, inode, size, mtime_ns), so a file is only
+    hashed again after it has changed.
+    """
+
+    def __init__(self, dbpath):
+        if os.path.dirname(dbpath):
+            os.makedirs(os.path.dirname(dbpath), exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(dbpath, check_same_thread=False)
+        self.__db.execute('CREATE TABLE IF NOT EXISTS checksums ('
+                          'dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, '
+                          'md5 TEXT, crc32 TEXT, slicemd5 TEXT, blocks TEXT, '
+                          'PRIMARY KEY (dev, ino))')
+        self.__db.commit()
+
+    def get(self, st):
+        with self.__lock:
+            row = self.__db.execute('SELECT md5, crc32, slicemd5, blocks FROM checksums WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?',
+                                    (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)).fetchone()
+        if row is None:
+            return None
+        return {'size': st.st_size, 'md5': row[0], 'crc32': row[1], 'slicemd5': row[2], 'blocks': json.loads(row[3])}
+
+    def put(self, st, checksums):
+        with self.__lock:
+            self.__db.execute('INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                              (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns,
+                               checksums['md5'], checksums['crc32'], checksums['slicemd5'], json.dumps(checksums['blocks'])))
+            self.__db.commit()
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            statedir = SynConfig.config.get('statedir', os.path.join(os.path.expanduser('~'), '.fsync'))
+            _cache = ChecksumCache(SynConfig.config.get('checksumcache', os.path.join(statedir, 'checksum.db')))
+        return _cache
+
+def get_checksums(filepath, cache=None):
+    """compute_checksums() with results reused from the cache while the file is unchanged."""
+    if cache is None:
+        cache = get_cache()
+    st = os.stat(filepath)
+    checksums = cache.get(st)
+    if checksums is not None:
+        return checksums
+    logger.debug('Start hash file "%s".', filepath)
+    checksums = compute_checksums(filepath)
+    after = os.stat(filepath)
+    if (after.st_size, after.st_mtime_ns) == (st.st_size, st.st_mtime_ns):
+        cache.put(st, checksums)
+    return checksums
@@ -1,6 +1,10 @@
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
 import sys
+import threading
 from fsync.conf import SynConfig
 
 class ColouredHandler(logging.StreamHandler):
@@ -36,6 +40,9 @@ class ColouredHandler(logging.StreamHandler):
     #: Color of each column
     _column_color = {}
 
+    #: Flush after every record; off when a LogWriter flushes once per batch
+    autoflush = True
+
     def __init__(
         self, stream=sys.stdout,
         datefmt='%H:%M:%S',
@@ -66,6 +73,9 @@ class ColouredHandler(logging.StreamHandler):
         self._column_color[logging.ERROR]    = color_message_error
         self._column_color[logging.CRITICAL] = color_message_critical
 
+        # colored formatters, built once per level
+        self._formatters = {}
+
     @property
     def is_tty(self):
         """Returns true if the handler's stream is a terminal."""
@@ -95,24 +105,25 @@ class ColouredHandler(logging.StreamHandler):
         """
         Get a special format string with ASCII color codes.
         """
-        color_fmt = self._colorize_fmt(self._fmt, record.levelno)
-        formatter = logging.Formatter(color_fmt, self._datefmt)
+        formatter = self._formatters.get(record.levelno)
+        if formatter is None:
+            color_fmt = self._colorize_fmt(self._fmt, record.levelno)
+            formatter = self._formatters[record.levelno] = logging.Formatter(color_fmt, self._datefmt)
+        exc_text = record.exc_text
         self.colorize_traceback(formatter, record)
         output = formatter.format(record)
-        # Clean cache so the color codes of traceback don't leak to other formatters
-        record.ext_text = None
+        # Restore the plain text so the color codes of traceback don't leak to other handlers
+        record.exc_text = exc_text
         return output
 
     def colorize_traceback(self, formatter, record):
         """
         Turn traceback text to red.
         """
-        if record.exc_info:
-            # Cache the traceback text to avoid converting it multiple times
-            # (it's constant anyway)
+        if record.exc_info or record.exc_text:
             record.exc_text = "".join([
                 self.get_color("red"),
-                formatter.formatException(record.exc_info),
+                record.exc_text or formatter.formatException(record.exc_info),
                 self.reset,
             ])
 
@@ -134,7 +145,8 @@ class ColouredHandler(logging.StreamHandler):
             msg = self.format(record)
             msg = self._encode(msg)
             self.stream.write(msg + getattr(self, 'terminator', '\n'))
-            self.flush()
+            if self.autoflush:
+                self.flush()
         except (KeyboardInterrupt, SystemExit):
             raise
         except:
@@ -144,6 +156,7 @@ class ColouredHandler(logging.StreamHandler):
         # HACK: peeping format string passed by user to `logging.Formatter()`
         if formatter._fmt:
             self._fmt = formatter._fmt
+        self._formatters = {}
         logging.StreamHandler.setFormatter(self, formatter)
 
     def _encode(self, msg):
@@ -162,29 +175,133 @@ class ColouredHandler(logging.StreamHandler):
         fmt = ''.join([self.reset, self.get_color(*color_tup), fmt, self.reset])
         return fmt
 
+class BufferedFileHandler(logging.FileHandler):
+    """ FileHandler that leaves flushing to the LogWriter, once per batch of records. """
+
+    def emit(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """ Hands records to a LogWriter; the logging thread only merges the message arguments.
+
+    The message and traceback text are resolved here, since the arguments
+    may change once the caller goes on, but all formatting and I/O is left
+    to the writer thread.
+    """
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class LogWriter:
+    """ Background thread writing queued records to the real handlers.
+
+    It takes every record already waiting (up to `batchsize`) before
+    flushing the handlers, so a burst of messages costs one flush per
+    handler instead of one per line.
+    """
+
+    def __init__(self, records, handlers, batchsize=512):
+        self.records = records
+        self.handlers = handlers
+        self.batchsize = batchsize
+        self.__thread = None
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run, name='fsync-log', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """Write out what is queued and end the thread."""
+        if self.__thread is not None:
+            self.records.put(None)
+            self.__thread.join()
+            self.__thread = None
+
+    def __handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def __run(self):
+        while True:
+            record = self.records.get()
+            stop = record is None
+            batch = 0
+            while record is not None:
+                self.__handle(record)
+                batch += 1
+                if batch >= self.batchsize:
+                    break
+                try:
+                    record = self.records.get(block=False)
+                except queue.Empty:
+                    break
+                stop = record is None
+            if batch:
+                for handler in self.handlers:
+                    try:
+                        handler.flush()
+                    except (OSError, ValueError):
+                        # e.g. the stream was closed under us at interpreter exit
+                        pass
+            if stop:
+                return
+
+def get_level():
+    """The configured 'loglevel' (a level name or number), DEBUG by default."""
+    level = SynConfig.config.get('loglevel', 'DEBUG')
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+    return level if isinstance(level, int) else logging.DEBUG
+
+# the LogWriter behind the 'log' logger, once get_logger() set it up
+_writer = None
+
 def get_logger():
+    global _writer
     logger = logging.getLogger('log')
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(get_level())
     if not logger.handlers:
         # logging format
         fmt = logging.Formatter("[%(asctime)s] [%(levelname)s] %(filename)s:%(lineno)d %(message)s", "%H:%M:%S")
+        handlers = []
 
         if SynConfig.config['log'] != '':
             # filehandler
-            fh = logging.FileHandler(SynConfig.config['log'])
+            fh = BufferedFileHandler(SynConfig.config['log'])
             fh.setFormatter(fmt)
             fh.setLevel(logging.DEBUG)
-            logger.addHandler(fh)
+            handlers.append(fh)
 
         # streamhandler
         if os.name == 'nt': # Windows
             ch= logging.StreamHandler()
         else:
             ch = ColouredHandler()
+            ch.autoflush = False
         ch.setFormatter(fmt)
         #ch.setLevel(logging.INFO)
         ch.setLevel(logging.DEBUG)
-        logger.addHandler(ch)
+        handlers.append(ch)
+
+        # records are written by a background thread, off the transfer threads
+        records = queue.SimpleQueue()
+        _writer = LogWriter(records, handlers)
+        _writer.start()
+        atexit.register(_writer.stop)
+        logger.addHandler(LazyQueueHandler(records))
 
     return logger
 
@@ -1,63 +1,113 @@
+import itertools
 import queue as Queue
 import threading
 import time
+from concurrent.futures import Future, wait
 
-class WorkManager:
-    def __init__(self, thread_num=2):
-        self.work_queue = Queue.Queue()
-        self.threads = []
-        self.__init_thread_pool(thread_num)
+class PriorityExecutor:
+    """ 常驻线程池：按优先级执行任务，返回 Future
 
-    def __init_thread_pool(self,thread_num):
-        """ 初始化线程 """
-        for _ in range(thread_num):
-            self.threads.append(Work(self.work_queue))
+    - Workers live until shutdown(), so jobs submitted at any time are run
+    - Lower `priority` runs first, equal priorities run in submit order
+    - With `max_queue` > 0, submit() blocks while the queue is full (backpressure)
+    - Results and exceptions of a job are delivered through its Future
+    """
 
-    def add_job(self, job):
-        """ 添加一项工作入队 """
-        self.work_queue.put(job) #任务入队，Queue内部实现了同步机制
+    def __init__(self, max_workers=2, max_queue=0, name='fsync-worker'):
+        self.work_queue = Queue.PriorityQueue(max_queue)
+        self.threads = []
+        self.__seq = itertools.count()
+        self.__shutdown = False
+        self.__lock = threading.Lock()
+        for i in range(max_workers):
+            thread = threading.Thread(target=self.__worker, name='%s-%d' % (name, i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
 
-    def wait_allcomplete(self):
-        """ 等待所有线程运行完毕 """
-        for item in self.threads:
-            item.start()
-        for item in self.threads:
-            if item.isAlive():item.join()
-
-class Work(threading.Thread):
-    def __init__(self, work_queue):
-        threading.Thread.__init__(self)
-        self.work_queue = work_queue
-
-    def run(self):
-        #死循环，从而让创建的线程在一定条件下关闭退出
+    def submit(self, fn, *args, priority=0, **kwargs):
+        """ 提交一项任务，返回其 Future """
+        with self.__lock:
+            if self.__shutdown:
+                raise RuntimeError('cannot submit after shutdown')
+        future = Future()
+        self.work_queue.put((priority, next(self.__seq), (future, fn, args, kwargs)))
+        return future
+
+    def __worker(self):
         while True:
+            _, _, item = self.work_queue.get()
             try:
-                job = self.work_queue.get(block=False) #任务异步出队，Queue内部实现了同步机制
-                job.execute()
-                self.work_queue.task_done() #通知系统任务完成
-            except:
-                break
+                if item is None:
+                    return
+                future, fn, args, kwargs = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            finally:
+                self.work_queue.task_done()
 
+    def shutdown(self, wait=True, cancel_futures=False):
+        """ 停止接收任务；已排队的任务执行完（或取消）后线程退出 """
+        with self.__lock:
+            if self.__shutdown:
+                return
+            self.__shutdown = True
+        if cancel_futures:
+            while True:
+                try:
+                    _, _, item = self.work_queue.get(block=False)
+                except Queue.Empty:
+                    break
+                item[0].cancel()
+                self.work_queue.task_done()
+        for _ in self.threads:
+            # sentinels sort after every real job
+            self.work_queue.put((float('inf'), next(self.__seq), None))
+        if wait:
+            for thread in self.threads:
+                thread.join()
 
+    def __enter__(self):
+        return self
 
-if __name__ == '__main__':
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        return False
 
-    class do_job:
-        def __init__(self, num):
-            self.num = num
-            pass
-    
-        def execute(self):
-            time.sleep(0.1) #模拟处理时间
-            print(threading.current_thread(), self.num)
+class WorkManager:
+    """ 兼容旧接口：job 对象提供 execute()，由 PriorityExecutor 执行 """
 
-    start = time.time()
-    work_manager =  WorkManager(10)
+    def __init__(self, thread_num=2):
+        self.executor = PriorityExecutor(thread_num)
+        self.threads = self.executor.threads
+        self.futures = []
+
+    def add_job(self, job, priority=0):
+        """ 添加一项工作入队 """
+        self.futures.append(self.executor.submit(job.execute, priority=priority))
+
+    def wait_allcomplete(self):
+        """ 等待所有任务完成，关闭线程池；返回出错的任务异常列表 """
+        wait(self.futures)
+        self.executor.shutdown()
+        return [f.exception() for f in self.futures if not f.cancelled() and f.exception() is not None]
 
-    for i in range(100):
-        work_manager.add_job(do_job(i))
 
-    work_manager.wait_allcomplete()
+if __name__ == '__main__':
+
+    def do_job(num):
+        time.sleep(0.1) #模拟处理时间
+        print(threading.current_thread(), num)
+        return num
+
+    start = time.time()
+    with PriorityExecutor(10, max_queue=20) as executor:
+        futures = [executor.submit(do_job, i, priority=i % 3) for i in range(100)]
     end = time.time()
+    print(sum(f.result() for f in futures))
     print("cost all time: %s" % (end-start))
@@ -1,12 +1,106 @@
+import asyncio
+import heapq
 import pycurl
+import select
 import traceback
+import threading
 import time
-import os
-from urllib.parse import urlencode
-from fcntl import LOCK_EX, LOCK_SH, LOCK_NB, LOCK_UN, flock, lockf
+from urllib.parse import parse_qs, urlencode, urlsplit
+from fcntl import LOCK_SH, LOCK_UN, flock
 
 from fsync.common.log import logger
+from fsync.bandwidth import get_limiter
 from fsync.conf import SynConfig
+from fsync.fileio import FileWriter, map_range
+from fsync.metrics import PHASES, get_metrics
+from fsync.retry import OK, FATAL, RETRY, THROTTLE, RetryPolicy, get_breaker, parse_retry_after
+from fsync.stages import compressed_size, make_transfer_stage, upload_compression
+
+# byte counts and speeds of an attempt; the non-_T options are deprecated in newer pycurl
+_SIZE_UPLOAD = getattr(pycurl, 'SIZE_UPLOAD_T', pycurl.SIZE_UPLOAD)
+_SIZE_DOWNLOAD = getattr(pycurl, 'SIZE_DOWNLOAD_T', pycurl.SIZE_DOWNLOAD)
+_SPEED_UPLOAD = getattr(pycurl, 'SPEED_UPLOAD_T', pycurl.SPEED_UPLOAD)
+_SPEED_DOWNLOAD = getattr(pycurl, 'SPEED_DOWNLOAD_T', pycurl.SPEED_DOWNLOAD)
+
+class CurlPool:
+    """ Keep-alive pycurl handles shared by all SynCurl requests, keyed by host.
+
+    A handle keeps its connection (and the TLS session) open after perform(),
+    so handing the same handle to the next request for that host skips the
+    TCP and TLS handshakes. Each thread of the transfer executor holds at
+    most one handle at a time, so by default as many are kept per host.
+    """
+
+    def __init__(self, maxsize=None, idletimeout=None, maxrequests=None):
+        if maxsize is None:
+            # the size of baidupcsapi.get_executor()
+            maxsize = SynConfig.config.get('poolsize', SynConfig.config.get('maxthreadnumber', SynConfig.config['threadnumber'] * 4))
+        if idletimeout is None:
+            idletimeout = SynConfig.config.get('poolidletimeout', 60)
+        if maxrequests is None:
+            maxrequests = SynConfig.config.get('poolmaxrequests', 1000)
+        self.maxsize = max(int(maxsize), 1)
+        self.idletimeout = idletimeout
+        self.maxrequests = maxrequests
+        self.__lock = threading.Lock()
+        self.__idle = {}
+        self.__requests = {}
+
+    @staticmethod
+    def hostkey(url):
+        parts = urlsplit(url)
+        return parts.scheme, parts.netloc
+
+    @staticmethod
+    def alive(sock):
+        """False when the kept connection `sock` was closed by the server or has unexpected data waiting."""
+        if sock < 0:
+            # no connection kept, the handle connects anew
+            return True
+        poll = select.poll()
+        poll.register(sock, select.POLLIN | select.POLLPRI)
+        return not poll.poll(0)
+
+    def acquire(self, host):
+        """Take an idle handle for `host` whose connection is still usable, or create a new one."""
+        now = time.time()
+        with self.__lock:
+            handles = self.__idle.get(host, [])
+            while handles:
+                curl, lastused, sock = handles.pop()
+                if now - lastused <= self.idletimeout and self.alive(sock):
+                    return curl
+                self.__discard(curl)
+        curl = pycurl.Curl()
+        with self.__lock:
+            self.__requests[id(curl)] = 0
+        return curl
+
+    def release(self, host, curl, healthy=True):
+        """Return a handle; close it when it failed at the transport level, is worn out or the pool is full."""
+        with self.__lock:
+            self.__requests[id(curl)] = self.__requests.get(id(curl), 0) + 1
+            handles = self.__idle.setdefault(host, [])
+            if not healthy or self.__requests[id(curl)] >= self.maxrequests or len(handles) >= self.maxsize:
+                self.__discard(curl)
+                return
+            try:
+                sock = curl.getinfo(pycurl.ACTIVESOCKET)
+            except pycurl.error:
+                sock = -1
+            curl.reset()
+            handles.append((curl, time.time(), sock))
+
+    def clear(self):
+        with self.__lock:
+            for handles in self.__idle.values():
+                for curl, _, _ in handles:
+                    self.__discard(curl)
+            self.__idle = {}
+
+    def __discard(self, curl):
+        self.__requests.pop(id(curl), None)
+        curl.close()
 
 class SynCurl:
     Normal = 0
@@ -19,136 +113,610 @@ class SynCurl:
         self.__fd = None
         self.__startpos = 0
         self.__endpos = None
-        self.__buffer = ''
+        self.__writer = None
+        self.__ownwriter = False
+        self.__map = None
+        self.__curl = None
+        self.__ulnow = 0
+        self.__dlnow = 0
+        # engines that cannot sleep in a callback set this to pause the handle instead
+        self.on_throttle = None
+        # compression method (see stages.compression_for) of a whole-file transfer
+        self.compress = None
+        self.__stage = None
+        self.__buffer = bytearray()
+        self.__bufpos = 0
+        self.__readpos = 0
+        self.__readend = None
+        self.__flushed = False
+        self.__outpos = 0
+        self.__rdata = None
+        self.__host = None
+        self.__apimethod = ''
+        self.__status = 0
+        self.__headers = {}
 
-    @staticmethod
-    def __init_cipher(crypt, key):
-        if crypt == '1':
-            return ARC4.new(key)
-        elif crypt == '2':
-            return Blowfish.new(key, Blowfish.MODE_CFB, segment_size=8)
-        elif crypt == '3':
-            return AES.new(key.ljust(32, '.')[0:32], AES.MODE_CFB, segment_size=8)
-        else:
-            return None
+    pool = None
+    # the RetryPolicy used by every engine; replace it to change the retry rules
+    policy = None
+
+    @classmethod
+    def get_pool(cls):
+        if cls.pool is None:
+            cls.pool = CurlPool()
+        return cls.pool
+
+    @classmethod
+    def get_policy(cls):
+        if cls.policy is None:
+            cls.policy = RetryPolicy()
+        return cls.policy
+
+    def __pending(self):
+        return self.__stage.pending if self.__stage is not None else 0
+
+    def __write_inflated(self, rsp):
+        # positions count the compressed bytes received; __outpos the bytes written out
+        data = rsp[:max(self.__endpos - self.__startpos + 1, 0)]
+        self.__startpos += len(data)
+        try:
+            output = self.__stage.process(data)
+            if self.__startpos > self.__endpos:
+                output += self.__stage.flush()
+        except ValueError as e:
+            logger.error('Decompress download "%s" failed: %s.' % (self.__writer.filepath, e))
+            return 0
+        self.__writer.write(self.__outpos, output)
+        self.__outpos += len(output)
+        return len(rsp) if len(data) == len(rsp) else 0
 
     def __write_data(self, rsp):
-        if self.__op == SynCurl.Download:
-            if self.__startpos + len(self.__buffer) + len(rsp) - 1 > self.__endpos:
-                return 0
-            if SynConfig.config['encryption'] == '0':
-                self.__fd.write(rsp)
-                self.__startpos += len(rsp)
+        if self.__op == SynCurl.Download and self.__status < 400 and self.compress is not None:
+            return self.__write_inflated(rsp)
+        if self.__op == SynCurl.Download and self.__status < 400:
+            remain = max(self.__endpos - self.__startpos - self.__pending() + 1, 0)
+            data = rsp if len(rsp) <= remain else rsp[:remain]
+            if self.__stage is None:
+                self.__writer.write(self.__startpos, data)
+                self.__startpos += len(data)
             else:
-                self.__buffer += rsp
-                while len(self.__buffer) >= 4096 or self.__startpos + len(self.__buffer) - 1 == self.__endpos:
-                    cipher = self.__init_cipher(SynConfig.config['encryption'], SynConfig.config['encryptkey'])
-                    self.__fd.write(cipher.decrypt(self.__buffer[0:4096]))
-                    self.__startpos += 4096
-                    self.__buffer = self.__buffer[4096:]
+                output = self.__stage.process(data)
+                if self.__startpos + len(output) + self.__stage.pending - 1 == self.__endpos:
+                    output += self.__stage.flush()
+                self.__writer.write(self.__startpos, output)
+                self.__startpos += len(output)
+            if len(data) < len(rsp):
+                return 0
         else:
-            self.__response += rsp.decode('utf-8')
+            self.__response += rsp.decode('utf-8', 'replace')
         return len(rsp)
 
     def __read_data(self, size):
         if self.__startpos > self.__endpos:
-            return ''
+            return b''
         elif self.__startpos + size - 1 > self.__endpos:
             size = self.__endpos - self.__startpos + 1
 
-        if SynConfig.config['encryption'] == '0':
+        if self.__stage is None:
             self.__startpos += size
             return self.__fd.read(size)
-        else:
-            while len(self.__buffer) < size:
-                rst = self.__fd.read(4096)
-                if rst:
-                    cipher = self.__init_cipher(SynConfig.config['encryption'], SynConfig.config['encryptkey'])
-                    self.__buffer += cipher.encrypt(rst)
-                else:
-                    break
-            rst = self.__buffer[0:size]
-            self.__buffer = self.__buffer[size:]
-            self.__startpos += size
-            return rst
+        if len(self.__buffer) - self.__bufpos < size:
+            del self.__buffer[0:self.__bufpos]
+            self.__bufpos = 0
+            while len(self.__buffer) < size and not self.__flushed:
+                if self.__readpos <= self.__readend:
+                    rst = self.__fd.read(min(self.__stage.blocksize * 16, self.__readend - self.__readpos + 1))
+                    if not rst:
+                        break
+                    self.__readpos += len(rst)
+                    self.__buffer += self.__stage.process(rst)
+                if self.__readpos > self.__readend:
+                    self.__buffer += self.__stage.flush()
+                    self.__flushed = True
+        view = memoryview(self.__buffer)
+        rst = bytes(view[self.__bufpos:self.__bufpos + size])
+        view.release()
+        self.__bufpos += len(rst)
+        self.__startpos += len(rst)
+        return rst
 
-    @staticmethod
-    def __write_header(rsp):
-        return len(rsp)
+    def __progress(self, dltotal, dlnow, ultotal, ulnow):
+        delay = get_limiter().throttle(ulnow - self.__ulnow, dlnow - self.__dlnow)
+        self.__ulnow, self.__dlnow = ulnow, dlnow
+        if delay > 0:
+            if self.on_throttle is None:
+                time.sleep(delay)
+            else:
+                self.on_throttle(self.__curl, delay)
+        return 0
 
-    def request(self, url, querydata, rdata, method='POST', rtype=0, fnname=''):
-        retrycnt = -1
-        self.__op = rtype
+    def __write_header(self, line):
+        if line.startswith(b'HTTP/'):
+            # a new response (after a redirect or 100-continue) starts over
+            parts = line.split()
+            self.__status = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+            self.__headers = {}
+        elif b':' in line:
+            name, value = line.split(b':', 1)
+            self.__headers[name.strip().lower().decode('latin-1')] = value.strip().decode('latin-1')
+        return len(line)
+
+    @property
+    def retry_after(self):
+        """Seconds the server asked us to wait (Retry-After) in its last response, or None."""
+        return parse_retry_after(self.__headers.get('retry-after'))
+
+    @property
+    def position(self):
+        return self.__startpos
+
+    @property
+    def endpos(self):
+        return self.__endpos
+
+    def shrink(self, endpos):
+        """Stop a running download after `endpos`, so another transfer can take the tail.
+
+        Returns False when the transfer has already written past `endpos`.
+        """
+        if self.__op != SynCurl.Download or self.__endpos is None or endpos >= self.__endpos:
+            return False
+        if self.__startpos + self.__pending() > endpos + 1:
+            return False
+        self.__endpos = endpos
+        return True
+
+    def range_done(self):
+        """True once a download has written its whole (possibly shrunk) range."""
+        return self.__op == SynCurl.Download and self.compress is None and self.__endpos is not None and self.__startpos > self.__endpos
+
+    @staticmethod
+    def build_url(url, querydata):
         if querydata:
             if 'path' in querydata:
                 querydata['path'] = querydata['path'].encode('utf-8')
-        while retrycnt < SynConfig.config['retrytimes']:
+            url += '?%s' % urlencode(querydata)
+        return url
+
+    def prepare(self, curl, url, rdata, method='POST', rtype=0, fnname='', writer=None):
+        """Set up `curl` for one attempt and open the local file of a transfer.
+
+        A download writes through `writer` when one is given (a FileWriter
+        shared with other ranges, synced by its owner), otherwise through its
+        own FileWriter on `fnname`, synced once when the range completes.
+        """
+        self.__op = rtype
+        if self.__op == SynCurl.Download and rdata == self.__rdata and self.__startpos <= self.__endpos and self.compress is None:
+            # retry of the same download: carry on after the bytes already written
+            startpos = self.__startpos
+        elif self.__op != SynCurl.Normal:
+            startpos, self.__endpos = rdata.split('-', 1)
+            startpos = self.__startpos = int(startpos)
+            self.__endpos = int(self.__endpos)
+            self.__rdata = rdata
+        self.__response = ''
+        self.__host = CurlPool.hostkey(url)
+        self.__apimethod = parse_qs(urlsplit(url).query).get('method', [''])[0]
+        self.__status = 0
+        self.__headers = {}
+        self.__stage = None
+        if self.__op != SynCurl.Normal:
+            self.__readend = self.__endpos
+            compress = self.compress
+            if compress is not None and self.__op == SynCurl.Upload:
+                # the body is the compressed file, so the range counts compressed bytes
+                compress = upload_compression(fnname, compress)
+                startpos = self.__startpos = 0
+                self.__endpos = compressed_size(fnname, compress) - 1
+            self.__stage = make_transfer_stage(self.__op == SynCurl.Upload, compress, self.__readend + 1)
+            self.__buffer = bytearray()
+            self.__bufpos = 0
+            self.__readpos = startpos
+            self.__flushed = False
+            self.__outpos = 0
+        curl.setopt(pycurl.URL, url)
+        curl.setopt(pycurl.SSL_VERIFYPEER, 0)
+        curl.setopt(pycurl.SSL_VERIFYHOST, 0)
+        curl.setopt(pycurl.FOLLOWLOCATION, 1)
+        curl.setopt(pycurl.CONNECTTIMEOUT, 15)
+        curl.setopt(pycurl.LOW_SPEED_LIMIT, 1)
+        curl.setopt(pycurl.LOW_SPEED_TIME, 30)
+        curl.setopt(pycurl.USERAGENT, '')
+        curl.setopt(pycurl.HEADER, 0)
+        curl.setopt(pycurl.NOSIGNAL, 1)
+        curl.setopt(pycurl.TCP_KEEPALIVE, 1)
+        curl.setopt(pycurl.WRITEFUNCTION, self.__write_data)
+        curl.setopt(pycurl.HEADERFUNCTION, self.__write_header)
+
+        if get_limiter().configured:
+            self.__curl = curl
+            self.__ulnow = self.__dlnow = 0
+            curl.setopt(pycurl.NOPROGRESS, 0)
+            curl.setopt(pycurl.XFERINFOFUNCTION, self.__progress)
+        if self.__op == SynCurl.Upload:
+            curl.setopt(pycurl.UPLOAD, 1)
+            curl.setopt(pycurl.INFILESIZE, self.__endpos - startpos + 1)
+            self.__fd = open(fnname, 'rb')
+            self.__fd.seek(startpos)
+            flock(self.__fd, LOCK_SH)
+            if self.__stage is None and self.__endpos >= startpos:
+                # plain data: pycurl calls read() of the mapped range, no callback of our own per chunk
+                self.__map = map_range(self.__fd.fileno(), startpos, self.__endpos)
+                curl.setopt(pycurl.READDATA, self.__map)
+            else:
+                curl.setopt(pycurl.READFUNCTION, self.__read_data)
+        elif self.__op == SynCurl.Download:
+            curl.setopt(pycurl.RANGE, '%d-%d' % (startpos, self.__endpos))
+            self.__ownwriter = writer is None
+            if self.compress is not None and writer is None:
+                # every attempt decompresses from the start, into an empty file
+                with open(fnname, 'wb'):
+                    pass
+            self.__writer = writer if writer is not None else FileWriter(fnname)
+        else:
+            curl.setopt(pycurl.CUSTOMREQUEST, method)
+            if method == 'POST':
+                curl.setopt(pycurl.POSTFIELDS, urlencode(rdata))
+
+    def close(self, completed=True):
+        """Release the local file opened by prepare()."""
+        if self.__writer is not None:
+            writer, self.__writer = self.__writer, None
+            if self.__ownwriter:
+                writer.close(completed)
+        if self.__map is not None:
+            if completed:
+                self.__startpos = self.__endpos + 1
+            self.__map.close()
+            self.__map = None
+        if self.__fd is None:
+            return
+        try:
+            flock(self.__fd, LOCK_UN)
+        finally:
+            self.__fd.close()
+            self.__fd = None
+
+    def __record(self, curl, status, retried):
+        timings = dict((phase, curl.getinfo(getattr(pycurl, phase.upper() + '_TIME'))) for phase in PHASES)
+        get_metrics().record(self.__apimethod, status, timings, curl.getinfo(_SIZE_UPLOAD), curl.getinfo(_SIZE_DOWNLOAD),
+                             max(curl.getinfo(_SPEED_UPLOAD), curl.getinfo(_SPEED_DOWNLOAD)), retried)
+
+    def finish(self, curl, retrycnt, errno=None, errstr=None):
+        """Classify a finished attempt of `curl` with the RetryPolicy and record it.
+
+        `errno`/`errstr` is the curl error of an attempt that failed below
+        HTTP. The attempt is reported to the host's CircuitBreaker and to the
+        transfer metrics. Returns (done, retcode, response, seconds to wait
+        before the next attempt).
+        """
+        policy = self.get_policy()
+        breaker = get_breaker(self.__host)
+        if errno is not None:
+            retcode = errno
+            self.__response = '{"error_code":%d,"error_msg":"%s"}' % (errno, errstr)
+        else:
+            retcode = curl.getinfo(pycurl.HTTP_CODE)
+        verdict = policy.classify(retcode, self.__response, errno)
+        delay = 0
+        if verdict in (RETRY, THROTTLE):
+            retryafter = self.retry_after
+            delay = policy.delay(retrycnt, retryafter)
+            breaker.failure(delay if verdict == THROTTLE or retryafter is not None else 0)
+        elif errno is None:
+            breaker.success()
+        done = verdict in (OK, FATAL) or retrycnt >= policy.retries
+        self.__record(curl, retcode if errno is None else 'E%d' % errno, not done)
+        if done:
+            if retcode != 200 and retcode != 206 and self.__response == '':
+                self.__response = '{"error_code":%d,"error_msg":"Returned by the server is not in the expected results."}' % retcode
+            return True, retcode, self.__response, delay
+        logger.debug('Retry curl request(%s) in %.1fs after status %d.', self.__rdata, delay, retcode)
+        return False, retcode, self.__response, delay
+
+    def request(self, url, querydata, rdata, method='POST', rtype=0, fnname='', writer=None):
+        retrycnt = -1
+        url = self.build_url(url, querydata)
+        pool = self.get_pool()
+        host = pool.hostkey(url)
+        breaker = get_breaker(host)
+        while retrycnt < self.get_policy().retries:
             retrycnt += 1
-            logger.debug('Start curl request(%s) %d times for %s.' % (rdata, retrycnt, fnname))
-            if self.__op != SynCurl.Normal:
-                startpos, self.__endpos = rdata.split('-', 1)
-                startpos = self.__startpos = int(startpos)
-                self.__endpos = int(self.__endpos)
-            self.__response = ''
-            curl = pycurl.Curl()
+            wait = breaker.before()
+            while wait > 0:
+                time.sleep(wait)
+                wait = breaker.before()
+            logger.debug('Start curl request(%s) %d times for %s.', rdata, retrycnt, fnname)
+            curl = pool.acquire(host)
+            healthy = True
             try:
-                if querydata:
-                    url += '?%s' % urlencode(querydata)
-                curl.setopt(pycurl.URL, url)
-                curl.setopt(pycurl.SSL_VERIFYPEER, 0)
-                curl.setopt(pycurl.SSL_VERIFYHOST, 0)
-                curl.setopt(pycurl.FOLLOWLOCATION, 1)
-                curl.setopt(pycurl.CONNECTTIMEOUT, 15)
-                curl.setopt(pycurl.LOW_SPEED_LIMIT, 1)
-                curl.setopt(pycurl.LOW_SPEED_TIME, 30)
-                curl.setopt(pycurl.USERAGENT, '')
-                curl.setopt(pycurl.HEADER, 0)
-                curl.setopt(pycurl.NOSIGNAL, 1)
-                curl.setopt(pycurl.WRITEFUNCTION, self.__write_data)
-
-                starthour, endhour = SynConfig.config['speedlimitperiod'].split('-', 1)
-                starthour = int(starthour)
-                endhour = int(endhour)
-                curhour = time.localtime().tm_hour
-                if (endhour > starthour and starthour <= curhour < endhour) or (endhour < starthour and (curhour < starthour or curhour >= endhour)):
-                    curl.setopt(pycurl.MAX_SEND_SPEED_LARGE, SynConfig.config['maxsendspeed'] / SynConfig.config['tasknumber'] / SynConfig.config['threadnumber'])
-                    curl.setopt(pycurl.MAX_RECV_SPEED_LARGE, SynConfig.config['maxrecvspeed'] / SynConfig.config['tasknumber'] / SynConfig.config['threadnumber'])
-                if self.__op == SynCurl.Upload:
-                    curl.setopt(pycurl.UPLOAD, 1)
-                    curl.setopt(pycurl.READFUNCTION, self.__read_data)
-                    curl.setopt(pycurl.INFILESIZE, self.__endpos - startpos + 1)
-                    with open(fnname, 'rb') as self.__fd:
-                        self.__fd.seek(startpos)
-                        flock(self.__fd, LOCK_SH)
-                        curl.perform()
-                        flock(self.__fd, LOCK_UN)
-                elif self.__op == SynCurl.Download:
-                    curl.setopt(pycurl.RANGE, rdata)
-                    with open(fnname, 'rb+') as self.__fd:
-                        self.__fd.seek(startpos)
-                        lockf(self.__fd, LOCK_EX, self.__endpos - startpos + 1, startpos, 0)
-                        curl.perform()
-                        self.__fd.flush()
-                        os.fsync(self.__fd.fileno())
-                        lockf(self.__fd, LOCK_UN, self.__endpos - startpos + 1, startpos, 0)
-                else:
-                    curl.setopt(pycurl.CUSTOMREQUEST, method)
-                    if method == 'POST':
-                        curl.setopt(pycurl.POSTFIELDS, urlencode(rdata))
+                self.prepare(curl, url, rdata, method, rtype, fnname, writer)
+                errno = errstr = None
+                try:
                     curl.perform()
-                retcode = curl.getinfo(pycurl.HTTP_CODE)
-                if retcode < 400 or retcode == 404 or retrycnt == SynConfig.config['retrytimes']:
-                    if retcode != 200 and retcode != 206 and self.__response == '':
-                        self.__response = '{"error_code":%d,"error_msg":"Returned by the server is not in the expected results."}' % retcode
-                    return retcode, self.__response
-                else:
-                    time.sleep(SynConfig.config['retrydelay'])
-            except pycurl.error as error:
-                if retrycnt == SynConfig.config['retrytimes']:
-                    (errno, errstr) = error
-                    return errno, '{"error_code":%d,"error_msg":"%s"}' % (errno, errstr)
+                except pycurl.error as error:
+                    # a range cut short by shrink() ends with the write callback refusing data
+                    if error.args[0] != pycurl.E_WRITE_ERROR or not self.range_done():
+                        healthy = False
+                        errno, errstr = error.args
+                self.close(healthy)
+                done, retcode, response, delay = self.finish(curl, retrycnt, errno, errstr)
+                if done:
+                    return retcode, response
             except Exception as e:
+                healthy = False
+                self.close(False)
                 return -1, '{"error_code":%d,"error_msg":"%s"}' % (-1, traceback.format_exc().replace('\n', '\\n').replace('"', '\''))
             finally:
-                curl.close()
-                logger.debug('Complete curl request(%s) %d times for %s.' % (rdata, retrycnt, fnname))
+                pool.release(host, curl, healthy)
+                logger.debug('Complete curl request(%s) %d times for %s.', rdata, retrycnt, fnname)
+            time.sleep(delay)
+
+
+class SynCurlMulti:
+    """ Run many SynCurl transfers from a single thread on top of pycurl.CurlMulti.
+
+    Transfers are queued with add() and driven by run(); each one gets the
+    same options, range handling and retry rules as SynCurl.request, and its
+    callback is called with (retcode, response) once it is done.
+    """
+
+    def __init__(self, maxtransfers=256):
+        self.maxtransfers = maxtransfers
+        self.__multi = pycurl.CurlMulti()
+        self.__pending = []
+        self.__active = {}
+        self.__paused = []
+        self.__seq = 0
+
+    def add(self, url, querydata, rdata, method='POST', rtype=0, fnname='', callback=None, writer=None):
+        transfer = {
+                'sycurl'  : SynCurl(),
+                'url'     : SynCurl.build_url(url, querydata),
+                'rdata'   : rdata,
+                'method'  : method,
+                'rtype'   : rtype,
+                'fnname'  : fnname,
+                'writer'  : writer,
+                'callback': callback,
+                'retrycnt': -1,
+                }
+        transfer['host'] = SynCurl.get_pool().hostkey(transfer['url'])
+        self.__schedule(transfer, 0)
+        return transfer
+
+    def __schedule(self, transfer, delay):
+        self.__seq += 1
+        heapq.heappush(self.__pending, (time.time() + delay, self.__seq, transfer))
+
+    def __start(self, transfer):
+        wait = get_breaker(transfer['host']).before()
+        if wait > 0:
+            self.__schedule(transfer, wait)
+            return
+        transfer['retrycnt'] += 1
+        logger.debug('Start curl request(%s) %d times for %s.', transfer['rdata'], transfer['retrycnt'], transfer['fnname'])
+        curl = SynCurl.get_pool().acquire(transfer['host'])
+        try:
+            transfer['sycurl'].prepare(curl, transfer['url'], transfer['rdata'], transfer['method'], transfer['rtype'], transfer['fnname'], transfer['writer'])
+        except Exception:
+            transfer['sycurl'].close(False)
+            SynCurl.get_pool().release(transfer['host'], curl, False)
+            self.__complete(transfer, -1, '{"error_code":%d,"error_msg":"%s"}' % (-1, traceback.format_exc().replace('\n', '\\n').replace('"', '\'')))
+            return
+        transfer['sycurl'].on_throttle = self.__pause
+        self.__active[curl] = transfer
+        self.__multi.add_handle(curl)
+
+    def __pause(self, curl, delay):
+        curl.pause(pycurl.PAUSE_ALL)
+        self.__seq += 1
+        heapq.heappush(self.__paused, (time.time() + delay, self.__seq, curl))
+
+    def __resume(self, now):
+        while self.__paused and self.__paused[0][0] <= now:
+            curl = heapq.heappop(self.__paused)[2]
+            if curl in self.__active:
+                curl.pause(pycurl.PAUSE_CONT)
+
+    def __done(self, curl, errno=None, errstr=None):
+        transfer = self.__active.pop(curl)
+        self.__multi.remove_handle(curl)
+        sycurl = transfer['sycurl']
+        if errno == pycurl.E_WRITE_ERROR and sycurl.range_done():
+            errno = None
+        logger.debug('Complete curl request(%s) %d times for %s.', transfer['rdata'], transfer['retrycnt'], transfer['fnname'])
+        try:
+            sycurl.close(errno is None)
+            done, retcode, response, delay = sycurl.finish(curl, transfer['retrycnt'], errno, errstr)
+        except Exception:
+            done = True
+            retcode, response = -1, '{"error_code":%d,"error_msg":"%s"}' % (-1, traceback.format_exc().replace('\n', '\\n').replace('"', '\''))
+        SynCurl.get_pool().release(transfer['host'], curl, errno is None)
+        if done:
+            self.__complete(transfer, retcode, response)
+        else:
+            self.__schedule(transfer, delay)
+
+    @staticmethod
+    def __complete(transfer, retcode, response):
+        transfer['retcode'] = retcode
+        transfer['response'] = response
+        if transfer['callback'] is not None:
+            try:
+                transfer['callback'](retcode, response)
+            except Exception as e:
+                logger.error('Callback of curl request(%s) for %s failed: %s.\n%s' % (transfer['rdata'], transfer['fnname'], e, traceback.format_exc()))
+
+    def run(self):
+        """Drive all queued transfers, including ones added by callbacks, to completion."""
+        while self.__pending or self.__active:
+            now = time.time()
+            while self.__pending and self.__pending[0][0] <= now and len(self.__active) < self.maxtransfers:
+                self.__start(heapq.heappop(self.__pending)[2])
+            if not self.__active:
+                if self.__pending:
+                    time.sleep(max(self.__pending[0][0] - time.time(), 0))
+                continue
+            while True:
+                ret, _ = self.__multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+            while True:
+                queued, succeeded, failed = self.__multi.info_read()
+                for curl in succeeded:
+                    self.__done(curl)
+                for curl, errno, errstr in failed:
+                    self.__done(curl, errno, errstr)
+                if queued == 0:
+                    break
+            if self.__active:
+                timeout = 1.0
+                for waiting in (self.__pending, self.__paused):
+                    if waiting:
+                        timeout = min(max(waiting[0][0] - time.time(), 0), timeout)
+                self.__multi.select(timeout)
+                self.__resume(time.time())
+
+    def close(self):
+        for curl in list(self.__active):
+            self.__multi.remove_handle(curl)
+            self.__active[curl]['sycurl'].close(False)
+            SynCurl.get_pool().release(self.__active.pop(curl)['host'], curl, False)
+        self.__pending = []
+        self.__paused = []
+        self.__multi.close()
+
+
+class AsyncSynCurl:
+    """ Awaitable SynCurl requests whose sockets are watched by an asyncio loop.
+
+    The CurlMulti socket and timer callbacks are mapped onto add_reader(),
+    add_writer() and call_later(), so any number of requests can be in flight
+    on the loop without a thread per request.
+    """
+
+    def __init__(self, loop=None):
+        self.__loop = loop
+        self.__multi = pycurl.CurlMulti()
+        self.__multi.setopt(pycurl.M_SOCKETFUNCTION, self.__on_socket)
+        self.__multi.setopt(pycurl.M_TIMERFUNCTION, self.__on_timer)
+        self.__active = {}
+        self.__sockets = {}
+        self.__timer = None
+
+    def __get_loop(self):
+        if self.__loop is None:
+            self.__loop = asyncio.get_running_loop()
+        return self.__loop
+
+    def __on_socket(self, event, sock, multi, data):
+        loop = self.__get_loop()
+        if sock in self.__sockets:
+            loop.remove_reader(sock)
+            loop.remove_writer(sock)
+            del self.__sockets[sock]
+        if event == pycurl.POLL_REMOVE:
+            return
+        if event in (pycurl.POLL_IN, pycurl.POLL_INOUT):
+            loop.add_reader(sock, self.__on_action, sock, pycurl.CSELECT_IN)
+        if event in (pycurl.POLL_OUT, pycurl.POLL_INOUT):
+            loop.add_writer(sock, self.__on_action, sock, pycurl.CSELECT_OUT)
+        self.__sockets[sock] = event
+
+    def __on_timer(self, timeout):
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        if timeout >= 0:
+            self.__timer = self.__get_loop().call_later(timeout / 1000.0, self.__on_action, pycurl.SOCKET_TIMEOUT, 0)
+
+    def __on_action(self, sock, event):
+        if sock == pycurl.SOCKET_TIMEOUT:
+            self.__timer = None
+        while True:
+            ret, _ = self.__multi.socket_action(sock, event)
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+        while True:
+            queued, succeeded, failed = self.__multi.info_read()
+            for curl in succeeded:
+                self.__done(curl, None, None)
+            for curl, errno, errstr in failed:
+                self.__done(curl, errno, errstr)
+            if queued == 0:
+                break
+
+    def __done(self, curl, errno, errstr):
+        self.__multi.remove_handle(curl)
+        future = self.__active.pop(curl)
+        if not future.done():
+            future.set_result((errno, errstr))
+
+    def __pause(self, curl, delay):
+        curl.pause(pycurl.PAUSE_ALL)
+        self.__get_loop().call_later(delay, self.__resume, curl)
+
+    def __resume(self, curl):
+        if curl in self.__active:
+            curl.pause(pycurl.PAUSE_CONT)
+
+    async def __perform(self, curl):
+        future = self.__get_loop().create_future()
+        self.__active[curl] = future
+        self.__multi.add_handle(curl)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if self.__active.pop(curl, None) is not None:
+                self.__multi.remove_handle(curl)
+            raise
+
+    async def request(self, url, querydata, rdata, method='POST', rtype=0, fnname='', writer=None, compress=None):
+        retrycnt = -1
+        sycurl = SynCurl()
+        sycurl.on_throttle = self.__pause
+        sycurl.compress = compress
+        url = SynCurl.build_url(url, querydata)
+        pool = SynCurl.get_pool()
+        host = pool.hostkey(url)
+        breaker = get_breaker(host)
+        while retrycnt < SynCurl.get_policy().retries:
+            retrycnt += 1
+            wait = breaker.before()
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = breaker.before()
+            logger.debug('Start curl request(%s) %d times for %s.', rdata, retrycnt, fnname)
+            curl = pool.acquire(host)
+            healthy = False
+            try:
+                sycurl.prepare(curl, url, rdata, method, rtype, fnname, writer)
+                errno, errstr = await self.__perform(curl)
+                if errno == pycurl.E_WRITE_ERROR and sycurl.range_done():
+                    errno = None
+                sycurl.close(errno is None)
+                healthy = errno is None
+                done, retcode, response, delay = sycurl.finish(curl, retrycnt, errno, errstr)
+                if done:
+                    return retcode, response
+            except asyncio.CancelledError:
+                sycurl.close(False)
+                raise
+            except Exception as e:
+                sycurl.close(False)
+                return -1, '{"error_code":%d,"error_msg":"%s"}' % (-1, traceback.format_exc().replace('\n', '\\n').replace('"', '\''))
+            finally:
+                pool.release(host, curl, healthy)
+                logger.debug('Complete curl request(%s) %d times for %s.', rdata, retrycnt, fnname)
+            await asyncio.sleep(delay)
+
+    def close(self):
+        for curl, future in list(self.__active.items()):
+            self.__multi.remove_handle(curl)
+            future.cancel()
+        self.__active = {}
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        self.__multi.close()
@@ -0,0 +1,73 @@
+import io
+import mmap
+import os
+
+def preallocate(fd, size):
+    """Reserve `size` bytes for a file so range writes do not fragment or run out of space midway."""
+    if size <= 0:
+        return
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            # e.g. EOPNOTSUPP on filesystems without fallocate
+            pass
+    if os.fstat(fd).st_size < size:
+        os.ftruncate(fd, size)
+
+def map_range(fd, startpos, endpos):
+    """Map bytes startpos..endpos (inclusive) of a file read-only.
+
+    The map ends right after `endpos` and is positioned at `startpos`, so its
+    read() method hands out exactly the range and then returns b'', which is
+    what curl's READDATA needs. pycurl still calls that read() from Python for
+    every chunk; what it saves is our own READFUNCTION callback, with its
+    range bookkeeping and its read() system call. An empty range
+    (endpos < startpos), which mmap cannot map, gives an empty BytesIO.
+    """
+    if endpos < startpos:
+        return io.BytesIO()
+    offset = startpos // mmap.ALLOCATIONGRANULARITY * mmap.ALLOCATIONGRANULARITY
+    mm = mmap.mmap(fd, endpos + 1 - offset, access=mmap.ACCESS_READ, offset=offset)
+    mm.seek(startpos - offset)
+    if hasattr(mm, 'madvise'):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    return mm
+
+class FileWriter:
+    """ Positional (pwrite) writer for downloaded data.
+
+    Every write goes to an absolute offset, so any number of ranges can write
+    into one shared writer without seeking or range locks; durability is one
+    fsync in sync()/close() instead of one per range.
+    """
+
+    def __init__(self, filepath, size=None):
+        self.filepath = filepath
+        self.__fd = os.open(filepath, os.O_RDWR | os.O_CREAT, 0o644)
+        if size is not None:
+            preallocate(self.__fd, size)
+
+    def write(self, offset, data):
+        view = memoryview(data)
+        try:
+            while view:
+                written = os.pwrite(self.__fd, view, offset)
+                offset += written
+                view = view[written:]
+        finally:
+            view.release()
+
+    def sync(self):
+        os.fsync(self.__fd)
+
+    def close(self, sync=True):
+        if self.__fd is None:
+            return
+        try:
+            if sync:
+                self.sync()
+        finally:
+            os.close(self.__fd)
+            self.__fd = None
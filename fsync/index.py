@@ -0,0 +1,84 @@
+import os
+import sqlite3
+import threading
+
+from fsync.conf import SynConfig
+
+class FileIndex:
+    """ Local record of what has been synced, one row per path.
+
+    Each row holds the local size, mtime (nanoseconds) and content MD5 seen at
+    the last sync together with the remote fs_id and mtime, so a run can work
+    out what changed without asking PCS about every file.
+    """
+
+    fields = ('path', 'size', 'mtime', 'md5', 'fs_id', 'remote_mtime')
+
+    def __init__(self, dbpath=None):
+        if dbpath is None:
+            statedir = SynConfig.config.get('statedir', os.path.join(os.path.expanduser('~'), '.fsync'))
+            dbpath = SynConfig.config.get('indexfile', os.path.join(statedir, 'index.db'))
+        if os.path.dirname(dbpath):
+            os.makedirs(os.path.dirname(dbpath), exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(dbpath, check_same_thread=False)
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        self.__db.execute('PRAGMA synchronous=NORMAL')
+        self.__db.execute('CREATE TABLE IF NOT EXISTS files ('
+                          'path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, md5 TEXT, '
+                          'fs_id INTEGER, remote_mtime INTEGER)')
+        self.__db.commit()
+
+    @staticmethod
+    def __prefix_range(dirpath):
+        # every path below dirpath sorts between 'dirpath/' and 'dirpath0' ('0' follows '/')
+        dirpath = dirpath.rstrip('/')
+        return dirpath + '/', dirpath + '0'
+
+    def get(self, path):
+        with self.__lock:
+            row = self.__db.execute('SELECT * FROM files WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(self.fields, row))
+
+    def update(self, records):
+        """Insert or replace many records (dicts keyed by `fields`) in one transaction."""
+        with self.__lock, self.__db:
+            self.__db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                                  ((r['path'], r.get('size'), r.get('mtime'), r.get('md5'), r.get('fs_id'), r.get('remote_mtime')) for r in records))
+
+    def delete(self, paths):
+        with self.__lock, self.__db:
+            self.__db.executemany('DELETE FROM files WHERE path = ?', ((path,) for path in paths))
+
+    def delete_dir(self, dirpath):
+        """Forget a directory and everything below it."""
+        start, end = self.__prefix_range(dirpath)
+        with self.__lock, self.__db:
+            self.__db.execute('DELETE FROM files WHERE path = ? OR (path >= ? AND path < ?)', (dirpath.rstrip('/'), start, end))
+
+    def list_dir(self, dirpath, recursive=True):
+        """Return the records below `dirpath`, ordered by path."""
+        start, end = self.__prefix_range(dirpath)
+        with self.__lock:
+            rows = self.__db.execute('SELECT * FROM files WHERE path >= ? AND path < ? ORDER BY path', (start, end)).fetchall()
+        records = [dict(zip(self.fields, row)) for row in rows]
+        if not recursive:
+            records = [r for r in records if '/' not in r['path'][len(start):]]
+        return records
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_index():
+    """The process-wide FileIndex at the configured indexfile."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = FileIndex()
+        return _index
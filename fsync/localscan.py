@@ -0,0 +1,75 @@
+import os
+import queue
+import threading
+
+from fsync.common.log import logger
+from fsync.common.threadpool import PriorityExecutor
+from fsync.conf import SynConfig
+
+def scan_local(root, workers=None, maxqueue=10000):
+    """Recursively list a local tree with os.scandir, scanning directories concurrently.
+
+    Yields (relpath, isdir, size, mtime_ns) for every file and directory
+    below `root`, in no particular order; `relpath` uses '/' as separator.
+    Like os.walk, symlinks to directories are listed but not descended and
+    unreadable directories are skipped with a warning. At most `maxqueue`
+    records wait for the caller before the scanning threads block.
+    """
+    if workers is None:
+        workers = SynConfig.config['threadnumber']
+    records = queue.Queue(maxsize=maxqueue)
+    stopped = threading.Event()
+    lock = threading.Lock()
+    state = {'pending': 1}
+    done = object()
+    executor = PriorityExecutor(workers, name='fsync-scan')
+
+    def put(record):
+        while not stopped.is_set():
+            try:
+                records.put(record, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def scan(dirpath, reldir, depth):
+        try:
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    if stopped.is_set():
+                        break
+                    relpath = reldir + entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            with lock:
+                                state['pending'] += 1
+                            # deeper directories first, so the queue of directories stays short
+                            executor.submit(scan, entry.path, relpath + '/', depth + 1, priority=-depth - 1)
+                            put((relpath, True, 0, entry.stat(follow_symlinks=False).st_mtime_ns))
+                        elif entry.is_dir():
+                            put((relpath, True, 0, entry.stat().st_mtime_ns))
+                        elif entry.is_file():
+                            st = entry.stat()
+                            put((relpath, False, st.st_size, st.st_mtime_ns))
+                    except OSError:
+                        # removed while we were looking at it
+                        continue
+        except OSError as e:
+            logger.warning('Scan local directory "%s" failed: %s.' % (dirpath, e))
+        finally:
+            with lock:
+                state['pending'] -= 1
+                finished = state['pending'] == 0
+            if finished:
+                put(done)
+
+    executor.submit(scan, root, '', 0)
+    try:
+        while True:
+            record = records.get()
+            if record is done:
+                break
+            yield record
+    finally:
+        stopped.set()
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,314 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+from fsync.baidupcsapi import BaiduPcsApi
+from fsync.checksum import get_checksums
+from fsync.common.log import logger
+from fsync.conf import SynConfig
+from fsync.index import get_index
+from fsync.localscan import scan_local
+from fsync.planner import execute_plan, indexed_state, local_state, make_plan, remote_state
+from fsync.snapshot import walk_remote
+
+# inotify(7) event masks
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+EVENT = struct.Struct('iIII')
+
+def _join(parent, name):
+    return parent + '/' + name if parent else name
+
+def coalesce(relpaths):
+    """Drop every path whose ancestor directory is also in `relpaths`; '' stands for the root."""
+    result = []
+    for relpath in sorted(set(relpaths)):
+        if result and (result[-1] == '' or relpath.startswith(result[-1] + '/')):
+            continue
+        result.append(relpath)
+    return result
+
+class DirtySet(object):
+    """ Changed paths waiting to be synced.
+
+    A path is handed out by take() once it has been quiet for `delay` seconds,
+    so a file being written is uploaded once, after the writer is done. A path
+    that keeps changing is handed out anyway `maxdelay` seconds after its first
+    change.
+    """
+    def __init__(self, delay=2, maxdelay=30):
+        self.delay = delay
+        self.maxdelay = maxdelay
+        self.__paths = {}
+
+    def __len__(self):
+        return len(self.__paths)
+
+    def add(self, relpath, now=None):
+        if now is None:
+            now = time.time()
+        first, last = self.__paths.get(relpath, (now, now))
+        self.__paths[relpath] = (first, now)
+
+    def take(self, now=None):
+        """Remove and return the paths that are ready, without paths below another returned directory."""
+        if now is None:
+            now = time.time()
+        ready = [relpath for relpath, (first, last) in self.__paths.items()
+                 if now - last >= self.delay or now - first >= self.maxdelay]
+        for relpath in ready:
+            del self.__paths[relpath]
+        return coalesce(ready)
+
+    def timeout(self, now=None):
+        """Seconds until take() may return something, None while nothing is waiting."""
+        if not self.__paths:
+            return None
+        if now is None:
+            now = time.time()
+        return max(0, min(min(last + self.delay, first + self.maxdelay) for first, last in self.__paths.values()) - now)
+
+class InotifyWatcher(object):
+    """ Recursive inotify watch of a local tree (Linux only).
+
+    read() returns the paths, relative to `root`, that changed since the last
+    call. New directories are watched as they appear; '' is returned when the
+    kernel dropped events and the whole tree has to be looked at again.
+    """
+    def __init__(self, root):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+        self.root = root
+        self.__libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.__fd = self.__libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.__fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.__watches = {}
+        self.add_watch('')
+        for subpath, isdir, size, mtime in scan_local(root):
+            if isdir:
+                self.add_watch(subpath)
+
+    def fileno(self):
+        return self.__fd
+
+    def close(self):
+        if self.__fd >= 0:
+            os.close(self.__fd)
+            self.__fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_watch(self, relpath):
+        path = os.path.join(self.root, *relpath.split('/')) if relpath else self.root
+        wd = self.__libc.inotify_add_watch(self.__fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e == errno.ENOSPC:
+                logger.error('Watch local directory "%s" failed, raise fs.inotify.max_user_watches.' % (path))
+            elif e not in (errno.ENOENT, errno.ENOTDIR):
+                logger.error('Watch local directory "%s" failed: %s.' % (path, os.strerror(e)))
+            return
+        self.__watches[wd] = relpath
+
+    def add_tree(self, relpath):
+        """Watch `relpath` and every directory below it.
+
+        New directories show up one event at a time, so they are walked right
+        here instead of starting scanning threads for each one.
+        """
+        stack = [relpath]
+        while stack:
+            dirpath = stack.pop()
+            self.add_watch(dirpath)
+            try:
+                with os.scandir(os.path.join(self.root, *dirpath.split('/'))) as entries:
+                    stack.extend(_join(dirpath, entry.name) for entry in entries if entry.is_dir(follow_symlinks=False))
+            except OSError:
+                continue
+
+    def remove_tree(self, relpath):
+        """Forget the watches of `relpath` and everything below it, e.g. after it was moved away."""
+        for wd, watched in list(self.__watches.items()):
+            if watched == relpath or watched.startswith(relpath + '/'):
+                self.__libc.inotify_rm_watch(self.__fd, wd)
+                del self.__watches[wd]
+
+    def read(self, timeout=None):
+        poll = select.poll()
+        poll.register(self.__fd, select.POLLIN)
+        if not poll.poll(None if timeout is None else timeout * 1000):
+            return []
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.__fd, 1 << 16)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, namelen = EVENT.unpack_from(data, pos)
+                name = data[pos + EVENT.size:pos + EVENT.size + namelen].rstrip(b'\0')
+                pos += EVENT.size + namelen
+                if mask & IN_Q_OVERFLOW:
+                    logger.warning('Inotify event queue overflowed, rescan "%s".' % (self.root))
+                    changed.add('')
+                    continue
+                if mask & IN_IGNORED:
+                    self.__watches.pop(wd, None)
+                    continue
+                parent = self.__watches.get(wd)
+                if parent is None or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    # reported through the event of the parent directory
+                    continue
+                relpath = _join(parent, os.fsdecode(name)) if name else parent
+                if mask & IN_ISDIR:
+                    if mask & IN_MOVED_FROM:
+                        self.remove_tree(relpath)
+                    elif mask & (IN_CREATE | IN_MOVED_TO):
+                        self.add_tree(relpath)
+                changed.add(relpath)
+        return sorted(changed)
+
+def _reindex(index, remoteroot, records, remote, local, localroot):
+    """Bring the index of `remoteroot` in line with a listing of it.
+
+    Rows of files that are gone or were replaced behind our back are
+    dropped. Files whose listing matches the local content are recorded, so
+    the next sync can do without listing the tree.
+    """
+    stale = set(row['path'] for row in index.list_dir(remoteroot))
+    fresh = []
+    prefix = remoteroot + '/'
+    for path, isdir, size, mtime, md5, fs_id in records:
+        relpath = path[len(prefix):]
+        row = index.get(path)
+        if row is not None and row['fs_id'] == fs_id and row['remote_mtime'] in (None, mtime):
+            stale.discard(path)
+        elif relpath in local and local[relpath] == {'size': remote[relpath]['size'], 'md5': remote[relpath]['md5']}:
+            try:
+                st = os.stat(os.path.join(localroot, *relpath.split('/')))
+            except OSError:
+                continue
+            stale.discard(path)
+            fresh.append({'path': path, 'size': local[relpath]['size'], 'mtime': st.st_mtime_ns, 'md5': local[relpath]['md5'],
+                          'fs_id': fs_id, 'remote_mtime': mtime})
+    index.delete(sorted(stale))
+    index.update(fresh)
+
+def full_sync(localroot, remoteroot, delete=True, index=None, rescan=False):
+    """Sync the whole of `localroot` to `remoteroot`; returns the number of failed operations.
+
+    The remote side comes from the FileIndex. The remote tree is only listed
+    when the index knows nothing below `remoteroot` yet, or with `rescan`,
+    and the index is then brought up to date with the listing.
+    """
+    if index is None:
+        index = get_index()
+    remoteroot = remoteroot.rstrip('/')
+    local = local_state(localroot)
+    remote = indexed_state(index, remoteroot)
+    if rescan or not remote:
+        BaiduPcsApi.check_create_pcsdir(remoteroot)
+        records = [record for record in walk_remote(remoteroot) if not record[1]]
+        remote = remote_state(records, remoteroot, index)
+        _reindex(index, remoteroot, records, remote, local, localroot)
+    return execute_plan(make_plan(local, remote, delete), localroot, remoteroot, index)
+
+def sync_paths(localroot, remoteroot, relpaths, delete=True, index=None):
+    """Sync just `relpaths` (files or directories below the roots); returns the number of failed operations.
+
+    The remote side of the paths is taken from the FileIndex, so the cost
+    follows the number of changes and no PCS lookups are needed. Everything
+    the index holds below a dirty directory takes part, which turns a renamed
+    directory into moves of its files.
+    """
+    if index is None:
+        index = get_index()
+    remoteroot = remoteroot.rstrip('/')
+    local = {}
+    remote = {}
+    removed = []
+    for relpath in relpaths:
+        localpath = os.path.join(localroot, *relpath.split('/'))
+        pcspath = remoteroot + '/' + relpath
+        row = index.get(pcspath)
+        if row is not None:
+            remote[relpath] = {'size': row['size'], 'md5': row['md5'], 'fs_id': row['fs_id']}
+        rows = index.list_dir(pcspath)
+        for row in rows:
+            remote[row['path'][len(remoteroot) + 1:]] = {'size': row['size'], 'md5': row['md5'], 'fs_id': row['fs_id']}
+        try:
+            if os.path.isdir(localpath):
+                for subpath, isdir, size, mtime in scan_local(localpath):
+                    if not isdir:
+                        checksums = get_checksums(os.path.join(localpath, *subpath.split('/')))
+                        local[relpath + '/' + subpath] = {'size': checksums['size'], 'md5': checksums['md5']}
+            elif os.path.isfile(localpath):
+                checksums = get_checksums(localpath)
+                local[relpath] = {'size': checksums['size'], 'md5': checksums['md5']}
+            elif rows:
+                # a whole directory went away
+                removed.append(pcspath)
+        except OSError:
+            # changed again while hashing, the next event brings it back
+            continue
+
+    failed = execute_plan(make_plan(local, remote, delete), localroot, remoteroot, index)
+    if delete and removed:
+        rets = BaiduPcsApi.rm_pcsfiles(removed, True)
+        failed += sum(ret != 0 for ret in rets)
+        for pcspath, ret in zip(removed, rets):
+            if ret == 0:
+                index.delete_dir(pcspath)
+    return failed
+
+def watch(localroot, remoteroot, delete=True, stop=None, index=None):
+    """Sync `localroot` to `remoteroot` once, then keep uploading local changes until `stop` (an Event) is set.
+
+    Changes are picked up with inotify and debounced by a DirtySet configured
+    with the watchdelay and watchmaxdelay settings, in seconds. When inotify
+    drops events the whole local tree is compared with the index again.
+    """
+    if index is None:
+        index = get_index()
+    dirty = DirtySet(SynConfig.config.get('watchdelay', 2), SynConfig.config.get('watchmaxdelay', 30))
+    # watch before the first sync, so nothing changed during it gets lost
+    with InotifyWatcher(localroot) as watcher:
+        full_sync(localroot, remoteroot, delete, index)
+        while stop is None or not stop.is_set():
+            timeout = dirty.timeout()
+            for relpath in watcher.read(1 if timeout is None else min(timeout, 1)):
+                dirty.add(relpath)
+            batch = dirty.take()
+            if not batch:
+                continue
+            logger.info('Sync %d changed local paths.' % (len(batch)))
+            if batch == ['']:
+                full_sync(localroot, remoteroot, delete, index)
+            else:
+                sync_paths(localroot, remoteroot, batch, delete, index)
+    return 0
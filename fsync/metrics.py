@@ -0,0 +1,134 @@
+import bisect
+import json
+import threading
+
+# curl getinfo() names of the timings recorded for every attempt, all measured from the start of the request
+PHASES = ('namelookup', 'connect', 'appconnect', 'starttransfer', 'total')
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SPEED_BUCKETS = tuple(65536 * 2 ** i for i in range(12))
+
+class Histogram:
+    """ Fixed-bucket histogram; counts[i] holds the observations <= buckets[i], the last one the rest. """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (None above the last bucket)."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def to_dict(self):
+        return {'buckets': list(self.buckets), 'counts': list(self.counts), 'sum': self.sum, 'count': self.count}
+
+class TransferMetrics:
+    """ In-process counters and histograms of the curl requests, labelled by PCS API method.
+
+    SynCurl records every attempt: its status (HTTP code, or 'E<errno>' for
+    a curl error), the curl phase timings, the upload/download speed and
+    bytes, and whether it was retried. snapshot() returns everything as a
+    dict; to_json() and to_prometheus() format it for export.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.requests = {}
+            self.retries = {}
+            self.bytes = {}
+            self.latency = {}
+            self.speed = {}
+
+    def record(self, method, status, timings, sent=0, received=0, speed=0, retried=False):
+        """Account one attempt; `timings` maps PHASES names to seconds."""
+        with self.__lock:
+            key = (method, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            if retried:
+                self.retries[method] = self.retries.get(method, 0) + 1
+            for direction, size in (('sent', sent), ('received', received)):
+                self.bytes[(method, direction)] = self.bytes.get((method, direction), 0) + size
+            for phase in PHASES:
+                if phase in timings:
+                    histogram = self.latency.get((method, phase))
+                    if histogram is None:
+                        histogram = self.latency[(method, phase)] = Histogram(LATENCY_BUCKETS)
+                    histogram.observe(timings[phase])
+            if speed > 0:
+                if method not in self.speed:
+                    self.speed[method] = Histogram(SPEED_BUCKETS)
+                self.speed[method].observe(speed)
+
+    def snapshot(self):
+        with self.__lock:
+            return {
+                    'requests': [{'method': method, 'status': status, 'count': count} for (method, status), count in sorted(self.requests.items())],
+                    'retries': dict(sorted(self.retries.items())),
+                    'bytes': [{'method': method, 'direction': direction, 'bytes': size} for (method, direction), size in sorted(self.bytes.items())],
+                    'latency': [dict(method=method, phase=phase, p50=histogram.quantile(0.5), p99=histogram.quantile(0.99), **histogram.to_dict())
+                                for (method, phase), histogram in sorted(self.latency.items())],
+                    'speed': [dict(method=method, **histogram.to_dict()) for method, histogram in sorted(self.speed.items())],
+                    }
+
+    def to_json(self):
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self):
+        """The metrics in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = ['# HELP fsync_requests_total Curl request attempts by PCS method and status.',
+                 '# TYPE fsync_requests_total counter']
+        for item in snapshot['requests']:
+            lines.append('fsync_requests_total{method="%s",status="%s"} %d' % (item['method'], item['status'], item['count']))
+        lines += ['# HELP fsync_retries_total Attempts that were followed by a retry.',
+                  '# TYPE fsync_retries_total counter']
+        for method, count in snapshot['retries'].items():
+            lines.append('fsync_retries_total{method="%s"} %d' % (method, count))
+        lines += ['# HELP fsync_transfer_bytes_total Bytes sent and received.',
+                  '# TYPE fsync_transfer_bytes_total counter']
+        for item in snapshot['bytes']:
+            lines.append('fsync_transfer_bytes_total{method="%s",direction="%s"} %d' % (item['method'], item['direction'], item['bytes']))
+        lines += ['# HELP fsync_request_seconds Time from the start of a request to the end of each curl phase.',
+                  '# TYPE fsync_request_seconds histogram']
+        for item in snapshot['latency']:
+            lines += _histogram_lines('fsync_request_seconds', 'method="%s",phase="%s"' % (item['method'], item['phase']), item)
+        lines += ['# HELP fsync_transfer_speed_bytes Average speed of an attempt in bytes per second.',
+                  '# TYPE fsync_transfer_speed_bytes histogram']
+        for item in snapshot['speed']:
+            lines += _histogram_lines('fsync_transfer_speed_bytes', 'method="%s"' % (item['method']), item)
+        return '\n'.join(lines) + '\n'
+
+def _histogram_lines(name, labels, item):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(item['buckets'], item['counts']):
+        cumulative += count
+        lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, repr(float(bound)), cumulative))
+    lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, item['count']))
+    lines.append('%s_sum{%s} %s' % (name, labels, repr(item['sum'])))
+    lines.append('%s_count{%s} %d' % (name, labels, item['count']))
+    return lines
+
+_metrics = TransferMetrics()
+
+def get_metrics():
+    """The process-wide TransferMetrics every SynCurl request is recorded in."""
+    return _metrics
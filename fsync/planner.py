@@ -0,0 +1,192 @@
+import itertools
+import os
+import posixpath
+
+from fsync.baidupcsapi import BaiduPcsApi
+from fsync.checksum import SLICE_SIZE, get_checksums
+from fsync.common.log import logger
+from fsync.conf import SynConfig
+from fsync.index import get_index
+from fsync.localscan import scan_local
+from fsync.stages import compression_for
+
+# Operations of a plan, in the order execute_plan() runs them:
+#   ('copy', src, dst)    cp_pcsfiles, the remote already holds the content
+#   ('move', src, dst)    mv_pcsfiles, a renamed or moved file
+#   ('replace', path)     remote file changed: overwrite it, big files incrementally
+#   ('upload', path)      new file: rapid upload first, real upload if that fails
+#   ('delete', path)      remote file no longer present locally
+# Paths are relative to the synced roots and use '/' as separator.
+OP_ORDER = ('copy', 'move', 'replace', 'upload', 'delete')
+
+def local_state(localroot):
+    """Map every local file below `localroot` to its size and content MD5 (checksum cache backed)."""
+    state = {}
+    for relpath, isdir, size, mtime in scan_local(localroot):
+        if isdir:
+            continue
+        checksums = get_checksums(os.path.join(localroot, *relpath.split('/')))
+        state[relpath] = {'size': checksums['size'], 'md5': checksums['md5']}
+    return state
+
+def remote_state(records, remoteroot, index=None):
+    """Map walk_remote()/load_snapshot() file records below `remoteroot` to size and MD5.
+
+    The server's MD5 is of the stored bytes, which are not the local bytes
+    once encryption or compression is on. A file the `index` recorded when
+    uploading it, and which is still the same remote file (fs_id and mtime),
+    is described by the size and MD5 of the local content instead.
+    """
+    state = {}
+    prefix = remoteroot.rstrip('/') + '/'
+    for path, isdir, size, mtime, md5, fs_id in records:
+        if isdir or not path.startswith(prefix):
+            continue
+        row = index.get(path) if index is not None else None
+        if row is not None and row['fs_id'] == fs_id and row['remote_mtime'] in (None, mtime):
+            size, md5 = row['size'], row['md5']
+        state[path[len(prefix):]] = {'size': size, 'md5': md5, 'fs_id': fs_id}
+    return state
+
+def indexed_state(index, remoteroot):
+    """remote_state() of `remoteroot` as recorded in the index, without asking PCS."""
+    prefix = remoteroot.rstrip('/') + '/'
+    return dict((row['path'][len(prefix):], {'size': row['size'], 'md5': row['md5'], 'fs_id': row['fs_id']})
+                for row in index.list_dir(remoteroot))
+
+def make_plan(local, remote, delete=True):
+    """Work out the operations that make `remote` match `local`.
+
+    Files with the same path, size and MD5 are left alone. A new local file
+    whose size and MD5 match a remote file that disappeared locally becomes a
+    move; one that matches any other remote file becomes a server side copy.
+    Everything else is uploaded.
+    """
+    plan = []
+    remote_only = sorted(set(remote) - set(local))
+    bycontent = {}
+    for path in sorted(remote):
+        if path in local and local[path]['md5'] == remote[path]['md5'] and local[path]['size'] == remote[path]['size']:
+            bycontent.setdefault((remote[path]['size'], remote[path]['md5']), path)
+    vanished = {}
+    for path in remote_only:
+        vanished.setdefault((remote[path]['size'], remote[path]['md5']), []).append(path)
+
+    moved = set()
+    for path in sorted(local):
+        key = (local[path]['size'], local[path]['md5'])
+        if path in remote:
+            if key != (remote[path]['size'], remote[path]['md5']):
+                plan.append(('replace', path))
+            continue
+        candidates = vanished.get(key)
+        if candidates:
+            # prefer a candidate with the same file name, i.e. a move between directories
+            same = [c for c in candidates if posixpath.basename(c) == posixpath.basename(path)]
+            src = (same or candidates)[0]
+            candidates.remove(src)
+            moved.add(src)
+            plan.append(('move', src, path))
+            bycontent.setdefault(key, src)
+        elif key in bycontent:
+            plan.append(('copy', bycontent[key], path))
+        else:
+            plan.append(('upload', path))
+    if delete:
+        for path in remote_only:
+            if path not in moved:
+                plan.append(('delete', path))
+    plan.sort(key=lambda op: OP_ORDER.index(op[0]))
+    return plan
+
+def _stored_alike(plan, remoteroot):
+    """Turn copies and moves between paths stored differently (see compression_for) into uploads.
+
+    The server copies the stored bytes, which would end up at a path
+    downloads read with another method.
+    """
+    result = []
+    for op in plan:
+        if op[0] in ('copy', 'move') and compression_for(remoteroot + '/' + op[1]) != compression_for(remoteroot + '/' + op[2]):
+            result.append(('upload', op[2]))
+            if op[0] == 'move':
+                result.append(('delete', op[1]))
+        else:
+            result.append(op)
+    result.sort(key=lambda op: OP_ORDER.index(op[0]))
+    return result
+
+def _upload(localpath, pcspath):
+    # overwrite in place: the old remote copy stays until the new one is complete
+    filesize = os.stat(localpath).st_size
+    if filesize > SLICE_SIZE and BaiduPcsApi.rapid_uploadfile(localpath, pcspath, 'overwrite') == 0:
+        return 0
+    if filesize > SynConfig.config.get('slicesize', 4 * 1024 * 1024):
+        return BaiduPcsApi.parallel_upload(localpath, pcspath, ondup='overwrite')
+    return BaiduPcsApi.upload_file(localpath, pcspath, 'overwrite')
+
+def _local_record(localroot, relpath):
+    localpath = os.path.join(localroot, *relpath.split('/'))
+    try:
+        st = os.stat(localpath)
+        checksums = get_checksums(localpath)
+    except OSError:
+        return None
+    return {'size': checksums['size'], 'mtime': st.st_mtime_ns, 'md5': checksums['md5']}
+
+def _record(index, records):
+    """Store `records` (pcspath -> local size, mtime and MD5) with the fs_id and mtime of the remote files."""
+    if not records:
+        return
+    pcspaths = sorted(records)
+    for pcspath, (ret, meta) in zip(pcspaths, BaiduPcsApi.get_pcs_filemeta_batch(pcspaths, True)):
+        records[pcspath]['path'] = pcspath
+        records[pcspath]['fs_id'] = meta.get('fs_id') if ret == 0 else None
+        records[pcspath]['remote_mtime'] = meta.get('mtime') if ret == 0 else None
+    index.update([records[pcspath] for pcspath in pcspaths])
+
+def execute_plan(plan, localroot, remoteroot, index=None):
+    """Run a make_plan() plan through BaiduPcsApi; returns the number of failed operations.
+
+    Each remote file written is recorded in the FileIndex with the size and
+    MD5 of the local content it was made from, taken before the operation.
+    """
+    if index is None:
+        index = get_index()
+    failed = 0
+    remoteroot = remoteroot.rstrip('/')
+    plan = _stored_alike(plan, remoteroot)
+    for optype, ops in itertools.groupby(plan, key=lambda op: op[0]):
+        ops = list(ops)
+        # the local content each operation puts on the remote side
+        before = dict((op[-1], _local_record(localroot, op[-1])) for op in ops if optype != 'delete')
+        # copies, moves and deletes of a plan never depend on each other, so each run of them is batched
+        if optype == 'copy':
+            rets = BaiduPcsApi.cp_pcsfiles([(remoteroot + '/' + op[1], remoteroot + '/' + op[2]) for op in ops])
+        elif optype == 'move':
+            rets = BaiduPcsApi.mv_pcsfiles([(remoteroot + '/' + op[1], remoteroot + '/' + op[2]) for op in ops])
+        elif optype == 'delete':
+            rets = BaiduPcsApi.rm_pcsfiles([remoteroot + '/' + op[1] for op in ops])
+        else:
+            rets = []
+            for op in ops:
+                localpath = os.path.join(localroot, *op[1].split('/'))
+                if op[0] == 'replace' and os.stat(localpath).st_size > SynConfig.config.get('slicesize', 4 * 1024 * 1024):
+                    # big files are rewritten in place, sending only the blocks that changed
+                    rets.append(BaiduPcsApi.incremental_upload(localpath, remoteroot + '/' + op[1]))
+                    continue
+                rets.append(_upload(localpath, remoteroot + '/' + op[1]))
+        records = {}
+        removed = []
+        for op, ret in zip(ops, rets):
+            if ret != 0:
+                logger.error('Sync operation %s failed.' % (str(op)))
+                failed += 1
+                continue
+            if optype in ('move', 'delete'):
+                removed.append(remoteroot + '/' + op[1])
+            if optype != 'delete' and before[op[-1]] is not None:
+                records[remoteroot + '/' + op[-1]] = before[op[-1]]
+        index.delete(removed)
+        _record(index, records)
+    return failed
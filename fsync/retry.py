@@ -0,0 +1,148 @@
+import json
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import pycurl
+
+from fsync.conf import SynConfig
+
+OK = 0
+FATAL = 1
+RETRY = 2
+THROTTLE = 3
+
+def _curl_errors(*names):
+    return frozenset(getattr(pycurl, name) for name in names if hasattr(pycurl, name))
+
+def parse_retry_after(value, now=None):
+    """Seconds to wait from a Retry-After header (delta seconds or HTTP date); None if unusable."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+    return max(when - (time.time() if now is None else now), 0.0)
+
+class RetryPolicy:
+    """ Decides whether a failed attempt is worth repeating and how long to wait first.
+
+    Curl errors of the network kind (DNS, connect, timeouts, dropped
+    connections) and HTTP 408/5xx are retried; throttling (HTTP 429/503 or
+    a PCS "hit frequence limit" error) is retried and also reported to the
+    host's CircuitBreaker. Anything else, e.g. a bad parameter or a missing
+    file, fails at once. Waits grow exponentially with full jitter, and a
+    Retry-After given by the server is never undercut. Subclass it and set
+    SynCurl.policy to change the rules.
+    """
+
+    retryable_curl_errors = _curl_errors('E_COULDNT_RESOLVE_PROXY', 'E_COULDNT_RESOLVE_HOST', 'E_COULDNT_CONNECT',
+                                         'E_PARTIAL_FILE', 'E_OPERATION_TIMEDOUT', 'E_SSL_CONNECT_ERROR',
+                                         'E_GOT_NOTHING', 'E_SEND_ERROR', 'E_RECV_ERROR', 'E_HTTP2',
+                                         'E_HTTP2_STREAM', 'E_HTTP3', 'E_QUIC_CONNECT_ERROR')
+    retryable_http = frozenset([408, 500, 502, 504])
+    throttle_http = frozenset([429, 503])
+    # 31001/31002: database errors, 31021/31022: PCS internal network errors
+    retryable_pcs_errors = frozenset([31001, 31002, 31021, 31022])
+    # hit frequence limit
+    throttle_pcs_errors = frozenset([31034])
+
+    def __init__(self, retries=None, basedelay=None, maxdelay=None):
+        self.retries = SynConfig.config['retrytimes'] if retries is None else retries
+        self.basedelay = SynConfig.config['retrydelay'] if basedelay is None else basedelay
+        self.maxdelay = SynConfig.config.get('retrymaxdelay', 60) if maxdelay is None else maxdelay
+
+    def classify(self, status=0, response='', errno=None):
+        """OK, FATAL, RETRY or THROTTLE for one attempt."""
+        if errno is not None:
+            return RETRY if errno in self.retryable_curl_errors else FATAL
+        if status < 400:
+            return OK
+        try:
+            error_code = json.loads(response).get('error_code')
+        except (ValueError, AttributeError):
+            error_code = None
+        if status in self.throttle_http or error_code in self.throttle_pcs_errors:
+            return THROTTLE
+        if status in self.retryable_http or error_code in self.retryable_pcs_errors or status > 504:
+            return RETRY
+        return FATAL
+
+    def delay(self, attempt, retryafter=None):
+        """Seconds to wait before attempt `attempt + 1`."""
+        delay = random.uniform(0, min(self.maxdelay, self.basedelay * 2 ** attempt))
+        if retryafter is not None:
+            delay = max(delay, min(retryafter, self.maxdelay))
+        return delay
+
+class CircuitBreaker:
+    """ Shared back-off state of one host.
+
+    After `threshold` failures in a row, or as soon as the server throttles
+    us, the breaker opens and every request to the host waits until it
+    closes again, instead of each thread hammering the host on its own
+    schedule. Then a single probe request is let through; its success closes
+    the breaker and its failure opens it again.
+    """
+
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.__lock = threading.Lock()
+        self.__failures = 0
+        self.__openuntil = 0
+        self.__probe = None
+
+    @property
+    def closed(self):
+        with self.__lock:
+            return self.__openuntil == 0
+
+    def before(self, now=None):
+        """Seconds the caller has to wait before sending; 0 means go ahead."""
+        if now is None:
+            now = time.time()
+        with self.__lock:
+            if self.__openuntil == 0:
+                return 0
+            if now < self.__openuntil:
+                return self.__openuntil - now
+            # a probe that never reported back does not block the host forever
+            if self.__probe is not None and now - self.__probe < self.cooldown:
+                return min(1.0, self.cooldown)
+            self.__probe = now
+            return 0
+
+    def success(self):
+        with self.__lock:
+            self.__failures = 0
+            self.__openuntil = 0
+            self.__probe = None
+
+    def failure(self, delay=0, now=None):
+        """Count a failed attempt; `delay` > 0 (a throttle) opens the breaker for at least that long."""
+        if now is None:
+            now = time.time()
+        with self.__lock:
+            self.__failures += 1
+            if self.__probe is not None or self.__failures >= self.threshold:
+                delay = max(delay, self.cooldown)
+            if delay > 0:
+                self.__openuntil = max(self.__openuntil, now + delay)
+                self.__probe = None
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(host):
+    """The CircuitBreaker shared by every request to `host`."""
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(SynConfig.config.get('breakerthreshold', 5),
+                                             SynConfig.config.get('breakercooldown', 30))
+        return _breakers[host]
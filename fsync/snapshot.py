@@ -0,0 +1,127 @@
+import gzip
+import json
+import os
+import queue
+import threading
+
+from fsync.baidupcsapi import BaiduPcsApi, PcsError
+from fsync.common.log import logger
+from fsync.conf import SynConfig
+
+SNAPSHOT_VERSION = 1
+
+def walk_remote(root, workers=None, page_size=1000, maxqueue=10000, maxdirs=1000):
+    """Recursively list a remote tree, crawling subdirectories concurrently.
+
+    Yields (path, isdir, size, mtime, md5, fs_id) for every entry below
+    `root`, in no particular order. At most `maxqueue` records wait for the
+    caller before the crawler threads block. Subdirectories found are queued
+    for the other crawler threads, at most `maxdirs` of them; past that the
+    crawler lists them itself, depth first, before going on with the
+    directory it was on. A directory that cannot be listed raises PcsError.
+    """
+    if workers is None:
+        workers = SynConfig.config['threadnumber']
+    records = queue.Queue(maxsize=maxqueue)
+    # room for the done markers of the workers too
+    dirs = queue.LifoQueue(maxsize=maxdirs + workers)
+    stopped = threading.Event()
+    lock = threading.Lock()
+    state = {'pending': 1, 'error': None}
+    done = object()
+
+    def put(record):
+        while not stopped.is_set():
+            try:
+                records.put(record, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def list_dir(pcspath):
+        # pages are requested right here, one at a time, no prefetch thread per directory
+        startindex = 0
+        while not stopped.is_set():
+            ret, filelist = BaiduPcsApi.get_pcs_filelist(pcspath, startindex, startindex + page_size)
+            if ret == 31066:
+                return
+            if ret != 0:
+                raise PcsError(ret, 'Get PCS file list of "%s" failed.' % (pcspath))
+            for entry in filelist:
+                isdir = entry['isdir'] == 1
+                put((entry['path'], isdir, entry['size'], entry['mtime'], entry.get('md5', ''), entry['fs_id']))
+                if isdir:
+                    with lock:
+                        queued = dirs.qsize() < maxdirs
+                        if queued:
+                            state['pending'] += 1
+                            dirs.put_nowait(entry['path'])
+                    if not queued:
+                        list_dir(entry['path'])
+            if len(filelist) < page_size:
+                return
+            startindex += page_size
+
+    def crawl():
+        while not stopped.is_set():
+            try:
+                pcspath = dirs.get(timeout=1)
+            except queue.Empty:
+                continue
+            if pcspath is done:
+                return
+            try:
+                list_dir(pcspath)
+            except Exception as e:
+                logger.error('Walk remote directory "%s" failed: %s.' % (pcspath, e))
+                with lock:
+                    if state['error'] is None:
+                        state['error'] = e
+                stopped.set()
+            with lock:
+                state['pending'] -= 1
+                finished = state['pending'] == 0
+            if finished:
+                for _ in range(workers):
+                    dirs.put(done)
+                put(done)
+
+    dirs.put(root)
+    threads = [threading.Thread(target=crawl, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            try:
+                record = records.get(timeout=1)
+            except queue.Empty:
+                if stopped.is_set():
+                    break
+                continue
+            if record is done:
+                break
+            yield record
+        if state['error'] is not None:
+            raise state['error'] if isinstance(state['error'], PcsError) else PcsError(1, str(state['error']))
+    finally:
+        stopped.set()
+
+def save_snapshot(records, filename, root=''):
+    """Write walk_remote() records to a gzip'd JSON-lines snapshot; returns the record count."""
+    count = 0
+    with gzip.open(filename + '.tmp', 'wt', encoding='utf-8') as fh:
+        fh.write(json.dumps({'version': SNAPSHOT_VERSION, 'root': root}) + '\n')
+        for record in records:
+            fh.write(json.dumps(record, separators=(',', ':'), ensure_ascii=False) + '\n')
+            count += 1
+    os.replace(filename + '.tmp', filename)
+    return count
+
+def load_snapshot(filename):
+    """Yield the (path, isdir, size, mtime, md5, fs_id) records of a snapshot."""
+    with gzip.open(filename, 'rt', encoding='utf-8') as fh:
+        header = json.loads(fh.readline())
+        if header.get('version') != SNAPSHOT_VERSION:
+            raise ValueError('Unsupported snapshot version of "%s": %s.' % (filename, header.get('version')))
+        for line in fh:
+            yield tuple(json.loads(line))
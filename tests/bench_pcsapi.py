@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+""" Benchmarks of BaiduPcsApi against the local PCS stand-in (tests/pcsstub.py).
+
+Every scenario reports requests/s seen by the server, MB/s of file data and
+the p50/p99 latency of one operation:
+
+    python3 tests/bench_pcsapi.py --latency 0.02 --bandwidth 20971520 --size 64
+    python3 tests/bench_pcsapi.py --scenario meta-batch --count 100000 --json
+
+Run it on the same machine and settings before and after a change to see
+whether the change made fsync faster or slower.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fsync.baidupcsapi import AsyncBaiduPcsApi, BaiduPcsApi
+from fsync.common.threadpool import PriorityExecutor
+from fsync.conf import SynConfig
+from fsync.metrics import get_metrics
+from pcsstub import PcsStub
+
+ROOT = '/apps/fsync/bench'
+MB = 1024 * 1024
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+def timed(fn, *args):
+    starttime = time.time()
+    ret = fn(*args)
+    return ret, time.time() - starttime
+
+def make_files(stub, count):
+    """Put `count` small files straight into the stand-in's tree."""
+    for i in range(count):
+        data = b'%d' % i
+        stub.files['%s/meta/%06d' % (ROOT, i)] = {'data': data, 'md5': hashlib.md5(data).hexdigest(),
+                                                  'blocks': [hashlib.md5(data).hexdigest()], 'fs_id': i, 'mtime': 0}
+    stub.dirs.update([ROOT, ROOT + '/meta', '/apps', '/apps/fsync'])
+    return ['%s/meta/%06d' % (ROOT, i) for i in range(count)]
+
+def bench_meta(stub, args):
+    paths = make_files(stub, args.count)
+    with PriorityExecutor(args.workers) as executor:
+        futures = [executor.submit(timed, BaiduPcsApi.get_pcs_filemeta, pcspath) for pcspath in paths]
+    results = [future.result() for future in futures]
+    return len(paths), 0, [seconds for (ret, _), seconds in results], sum(ret != 0 for (ret, _), _ in results)
+
+def bench_meta_async(stub, args):
+    paths = make_files(stub, args.count)
+
+    async def run():
+        api = AsyncBaiduPcsApi(args.workers)
+
+        async def meta(pcspath):
+            starttime = time.time()
+            ret, _ = await api.get_pcs_filemeta(pcspath)
+            return ret, time.time() - starttime
+
+        semaphore = asyncio.Semaphore(args.workers)
+
+        async def limited(pcspath):
+            async with semaphore:
+                return await meta(pcspath)
+
+        try:
+            return await asyncio.gather(*[limited(pcspath) for pcspath in paths])
+        finally:
+            api.close()
+
+    results = asyncio.run(run())
+    return len(paths), 0, [seconds for _, seconds in results], sum(ret != 0 for ret, _ in results)
+
+def bench_meta_batch(stub, args):
+    paths = make_files(stub, args.count)
+    results, seconds = timed(BaiduPcsApi.get_pcs_filemeta_batch, paths)
+    return len(paths), 0, [seconds], sum(ret != 0 for ret, _ in results)
+
+def bench_upload(stub, args):
+    latencies, failed = [], 0
+    for i in range(args.repeat):
+        ret, seconds = timed(BaiduPcsApi.parallel_upload, args.file, '%s/upload-%d' % (ROOT, i), args.slice * MB, args.workers)
+        latencies.append(seconds)
+        failed += ret != 0
+    return args.repeat, args.size * MB * args.repeat, latencies, failed
+
+def bench_download(stub, args):
+    with open(args.file, 'rb') as f:
+        data = f.read()
+    stub.files[ROOT + '/download'] = {'data': data, 'md5': hashlib.md5(data).hexdigest(), 'blocks': [], 'fs_id': 1, 'mtime': 0}
+    latencies, failed = [], 0
+    for i in range(args.repeat):
+        dest = args.file + '.download'
+        ret, seconds = timed(BaiduPcsApi.parallel_download, dest, ROOT + '/download', args.workers)
+        latencies.append(seconds)
+        failed += ret != 0
+        os.remove(dest)
+    return args.repeat, args.size * MB * args.repeat, latencies, failed
+
+def bench_encrypted(stub, args):
+    saved = SynConfig.config['encryption'], SynConfig.config['encryptkey']
+    SynConfig.config['encryption'], SynConfig.config['encryptkey'] = '3', 'benchmark-key'
+    try:
+        latencies, failed = [], 0
+        for i in range(args.repeat):
+            pcspath = '%s/encrypted-%d' % (ROOT, i)
+            dest = args.file + '.decrypted'
+            ret, upload = timed(BaiduPcsApi.parallel_upload, args.file, pcspath, args.slice * MB, args.workers)
+            ret2, download = timed(BaiduPcsApi.parallel_download, dest, pcspath, args.workers)
+            latencies += [upload, download]
+            with open(dest, 'rb') as f, open(args.file, 'rb') as g:
+                failed += ret != 0 or ret2 != 0 or f.read() != g.read()
+            os.remove(dest)
+        return args.repeat * 2, args.size * MB * args.repeat * 2, latencies, failed
+    finally:
+        SynConfig.config['encryption'], SynConfig.config['encryptkey'] = saved
+
+SCENARIOS = [
+        ('meta', bench_meta),
+        ('meta-async', bench_meta_async),
+        ('meta-batch', bench_meta_batch),
+        ('upload', bench_upload),
+        ('download', bench_download),
+        ('encrypted', bench_encrypted),
+        ]
+
+def run(args):
+    reports = []
+    for name, bench in SCENARIOS:
+        if args.scenario not in ('all', name):
+            continue
+        with PcsStub(args.latency, args.bandwidth, args.errorrate, seed=1) as stub:
+            get_metrics().reset()
+            starttime = time.time()
+            ops, size, latencies, failed = bench(stub, args)
+            elapsed = time.time() - starttime
+            requests = sum(stub.requests.values())
+        reports.append({
+                'scenario': name,
+                'ops': ops,
+                'failed': int(failed),
+                'seconds': round(elapsed, 3),
+                'requests': requests,
+                'req/s': round(requests / elapsed, 1),
+                'MB/s': round(size / MB / elapsed, 2),
+                'p50': round(percentile(latencies, 0.5), 4),
+                'p99': round(percentile(latencies, 0.99), 4),
+                'metrics': get_metrics().snapshot() if args.json else None,
+                })
+    return reports
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark BaiduPcsApi against a local PCS stand-in.')
+    parser.add_argument('--scenario', default='all', choices=['all'] + [name for name, _ in SCENARIOS])
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every request')
+    parser.add_argument('--bandwidth', type=int, default=0, help='bytes per second per connection, 0 for unlimited')
+    parser.add_argument('--errorrate', type=float, default=0, help='fraction of requests failing with 503')
+    parser.add_argument('--count', type=int, default=2000, help='paths of the metadata scenarios')
+    parser.add_argument('--workers', type=int, default=8, help='threads, in-flight requests or segments')
+    parser.add_argument('--size', type=int, default=32, help='MB of the transfer scenarios')
+    parser.add_argument('--slice', type=int, default=4, help='MB per upload slice')
+    parser.add_argument('--repeat', type=int, default=3, help='transfers per transfer scenario')
+    parser.add_argument('--json', action='store_true', help='print JSON, including the curl metrics')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        args.file = os.path.join(tmpdir, 'bench.bin')
+        with open(args.file, 'wb') as f:
+            for _ in range(args.size):
+                f.write(os.urandom(MB))
+        reports = run(args)
+    if args.json:
+        print(json.dumps(reports, indent=2))
+        return
+    print('%-12s %8s %7s %9s %10s %9s %9s %9s' % ('scenario', 'ops', 'failed', 'seconds', 'req/s', 'MB/s', 'p50', 'p99'))
+    for report in reports:
+        print('%-12s %8d %7d %9.3f %10.1f %9.2f %9.4f %9.4f' % (report['scenario'], report['ops'], report['failed'], report['seconds'],
+                                                               report['req/s'], report['MB/s'], report['p50'], report['p99']))
+
+if __name__ == '__main__':
+    main()
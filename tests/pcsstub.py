@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+""" A local stand-in for the PCS REST API, for offline tests and benchmarks.
+
+It implements the endpoints BaiduPcsApi uses (quota, list, meta, mkdir,
+delete, move, copy, upload, tmpfile upload, createsuperfile, rapidupload and
+range download) on an in-memory file tree, with optional per-request
+latency, per-connection bandwidth and random error injection:
+
+    with PcsStub(latency=0.02, bandwidth=10 * 1024 * 1024) as stub:
+        BaiduPcsApi.upload_file('aaa.txt', '/apps/fsync/aaa.txt')
+"""
+
+import hashlib
+import http.server
+import json
+import posixpath
+import random
+import ssl
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from fsync.baidupcsapi import BaiduPcsApi
+
+class PcsStubError(Exception):
+    def __init__(self, status, errno, message):
+        Exception.__init__(self, message)
+        self.status = status
+        self.errno = errno
+
+def _normalize(pcspath):
+    return posixpath.normpath('/' + pcspath.strip('/'))
+
+class PcsStubServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # clients drop connections on purpose, e.g. a download range taken over by another segment
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            http.server.ThreadingHTTPServer.handle_error(self, request, client_address)
+
+class PcsStubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out as separate writes; without this every reply waits for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.__handle()
+
+    def do_POST(self):
+        self.__handle()
+
+    def do_PUT(self):
+        self.__handle()
+
+    def __read_body(self):
+        size = int(self.headers.get('Content-Length', 0))
+        chunks = []
+        while size > 0:
+            chunk = self.rfile.read(min(size, 65536))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+            self.server.stub.throttle(len(chunk))
+        return b''.join(chunks)
+
+    def __handle(self):
+        stub = self.server.stub
+        parts = urlsplit(self.path)
+        query = dict((key, values[0]) for key, values in parse_qs(parts.query).items())
+        body = self.__read_body()
+        if stub.latency > 0:
+            time.sleep(stub.latency)
+        stub.count(query.get('method', ''))
+        if stub.errorrate > 0 and stub.random.random() < stub.errorrate:
+            headers = {'Retry-After': str(stub.retryafter)} if stub.retryafter is not None else {}
+            return self.__reply(stub.errorstatus, {'error_code': 31034, 'error_msg': 'hit frequence limit'}, headers)
+        try:
+            if parts.path.endswith('/quota'):
+                return self.__reply(200, stub.quota())
+            method = getattr(stub, 'op_' + query.get('method', ''), None)
+            if method is None:
+                raise PcsStubError(400, 3, 'Unsupported openapi method')
+            if query['method'] == 'download':
+                return self.__send_range(method(query))
+            form = {}
+            if query['method'] not in ('upload',):
+                form = dict((key, values[0]) for key, values in parse_qs(body.decode('utf-8')).items())
+            return self.__reply(200, method(query, form, body))
+        except PcsStubError as e:
+            return self.__reply(e.status, {'error_code': e.errno, 'error_msg': str(e)})
+
+    def __reply(self, status, obj, headers=None):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __send_range(self, data):
+        start, end = 0, len(data) - 1
+        status = 200
+        if 'Range' in self.headers:
+            first, last = self.headers['Range'].split('=', 1)[1].split('-', 1)
+            start, end = int(first), min(int(last) if last else len(data) - 1, len(data) - 1)
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(max(end - start + 1, 0)))
+        self.end_headers()
+        pos = start
+        while pos <= end:
+            chunk = data[pos:min(pos + 65536, end + 1)]
+            self.wfile.write(chunk)
+            pos += len(chunk)
+            self.server.stub.throttle(len(chunk), self.server.stub.slowranges.get(start))
+
+class PcsStub:
+    """ The stand-in server and its file tree.
+
+    `latency` seconds are added to every request, bodies move at most
+    `bandwidth` bytes per second per connection (0 for unlimited), and a
+    `errorrate` fraction of the requests fails with `errorstatus` and PCS
+    error 31034, with a Retry-After header when `retryafter` is set.
+    `slowranges` maps the start of a download range to a bandwidth of its
+    own, to stall one segment, and listing a directory in `unlistable`
+    fails. Passing `certfile`/`keyfile` serves HTTPS.
+    install() points BaiduPcsApi at it; using it as a context manager
+    starts, installs and stops it.
+    """
+
+    def __init__(self, latency=0, bandwidth=0, errorrate=0, errorstatus=503, retryafter=None,
+                 host='127.0.0.1', port=0, certfile=None, keyfile=None, seed=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.errorrate = errorrate
+        self.errorstatus = errorstatus
+        self.retryafter = retryafter
+        self.random = random.Random(seed)
+        self.requests = {}
+        self.files = {}
+        self.dirs = set(['/'])
+        self.tmpfiles = {}
+        self.slowranges = {}
+        self.unlistable = set()
+        self.__lock = threading.RLock()
+        self.__fsid = 0
+        self.__saved = None
+        self.server = PcsStubServer((host, port), PcsStubHandler)
+        self.server.stub = self
+        scheme = 'http'
+        if certfile is not None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+            scheme = 'https'
+        self.url = '%s://%s:%d' % (scheme, host, self.server.server_address[1])
+        self.__thread = None
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def install(self):
+        self.__saved = (BaiduPcsApi.pcs_url, BaiduPcsApi.upload_url, BaiduPcsApi.download_url)
+        BaiduPcsApi.pcs_url = BaiduPcsApi.upload_url = BaiduPcsApi.download_url = self.url + '/rest/2.0/pcs'
+        BaiduPcsApi.dircache.clear()
+
+    def uninstall(self):
+        if self.__saved is not None:
+            BaiduPcsApi.pcs_url, BaiduPcsApi.upload_url, BaiduPcsApi.download_url = self.__saved
+            self.__saved = None
+        BaiduPcsApi.dircache.clear()
+
+    def __enter__(self):
+        self.start()
+        self.install()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+        self.stop()
+        return False
+
+    def count(self, method):
+        with self.__lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+    def throttle(self, size, bandwidth=None):
+        if bandwidth is None:
+            bandwidth = self.bandwidth
+        if bandwidth > 0:
+            time.sleep(size / float(bandwidth))
+
+    # file tree
+
+    def __entry(self, pcspath, withblocks=False):
+        if pcspath in self.dirs:
+            entry = {'fs_id': abs(hash(pcspath)) % 10 ** 12, 'path': pcspath, 'ctime': 0, 'mtime': 0, 'size': 0, 'isdir': 1}
+        else:
+            f = self.files[pcspath]
+            entry = {'fs_id': f['fs_id'], 'path': pcspath, 'ctime': f['mtime'], 'mtime': f['mtime'],
+                     'md5': f['md5'], 'size': len(f['data']), 'isdir': 0}
+            if withblocks:
+                entry['block_list'] = json.dumps(f['blocks'])
+        return entry
+
+    def __exists(self, pcspath):
+        return pcspath in self.dirs or pcspath in self.files
+
+    def __require(self, pcspath):
+        if not self.__exists(pcspath):
+            raise PcsStubError(404, 31066, 'file does not exist')
+
+    def __mkdirs(self, pcspath):
+        while pcspath not in self.dirs:
+            if pcspath in self.files:
+                raise PcsStubError(400, 31061, 'file already exists')
+            self.dirs.add(pcspath)
+            pcspath = posixpath.dirname(pcspath)
+
+    def __target(self, pcspath, ondup):
+        """The path a new file is stored at, following ondup like PCS does."""
+        if not self.__exists(pcspath) or ondup == 'overwrite':
+            return pcspath
+        root, ext = posixpath.splitext(pcspath)
+        return '%s_%s_%d%s' % (root, time.strftime('%Y%m%d%H%M%S'), self.__fsid + 1, ext)
+
+    def __store(self, pcspath, data, blocks, ondup='overwrite'):
+        pcspath = self.__target(pcspath, ondup)
+        if pcspath in self.dirs:
+            raise PcsStubError(400, 31061, 'file already exists')
+        self.__mkdirs(posixpath.dirname(pcspath))
+        self.__fsid += 1
+        self.files[pcspath] = {'data': data, 'md5': hashlib.md5(data).hexdigest(), 'blocks': blocks,
+                               'fs_id': self.__fsid, 'mtime': int(time.time())}
+        return self.__entry(pcspath)
+
+    def __subtree(self, pcspath):
+        prefix = pcspath.rstrip('/') + '/'
+        return ([path for path in self.dirs if path == pcspath or path.startswith(prefix)],
+                [path for path in self.files if path == pcspath or path.startswith(prefix)])
+
+    def __transfer(self, src, dest, move):
+        self.__require(src)
+        if self.__exists(dest):
+            raise PcsStubError(400, 31061, 'file already exists')
+        dirs, files = self.__subtree(src)
+        self.__mkdirs(posixpath.dirname(dest))
+        for path in dirs:
+            self.dirs.add(dest + path[len(src):])
+        for path in files:
+            self.files[dest + path[len(src):]] = dict(self.files[path])
+        if move:
+            for path in dirs:
+                self.dirs.discard(path)
+            for path in files:
+                del self.files[path]
+
+    @staticmethod
+    def __items(query, form, keys):
+        if 'param' in form:
+            return [tuple(_normalize(item[key]) for key in keys) for item in json.loads(form['param'])['list']]
+        return [tuple(_normalize(query[key]) for key in keys)]
+
+    def quota(self):
+        with self.__lock:
+            return {'quota': 2 * 1024 ** 4, 'used': sum(len(f['data']) for f in self.files.values())}
+
+    # endpoints, named after the PCS method
+
+    def op_list(self, query, form, body):
+        with self.__lock:
+            pcspath = _normalize(query['path'])
+            if pcspath not in self.dirs:
+                raise PcsStubError(404, 31066, 'file does not exist')
+            if pcspath in self.unlistable:
+                raise PcsStubError(403, 31064, 'file is not authorized')
+            prefix = pcspath.rstrip('/') + '/'
+            children = sorted(path for path in list(self.dirs) + list(self.files)
+                              if path != pcspath and path.startswith(prefix) and '/' not in path[len(prefix):])
+            start, end = 0, len(children)
+            if 'limit' in query:
+                start, end = [int(n) for n in query['limit'].split('-', 1)]
+            return {'list': [self.__entry(path) for path in children[start:end]]}
+
+    def op_meta(self, query, form, body):
+        with self.__lock:
+            paths = [item[0] for item in self.__items(query, form, ('path',))]
+            for pcspath in paths:
+                self.__require(pcspath)
+            return {'list': [self.__entry(pcspath, True) for pcspath in paths]}
+
+    def op_mkdir(self, query, form, body):
+        with self.__lock:
+            pcspath = _normalize(query['path'])
+            if self.__exists(pcspath):
+                raise PcsStubError(400, 31061, 'file already exists')
+            self.__mkdirs(pcspath)
+            return {'fs_id': 0, 'path': pcspath, 'ctime': 0, 'mtime': 0}
+
+    def op_delete(self, query, form, body):
+        with self.__lock:
+            paths = [item[0] for item in self.__items(query, form, ('path',))]
+            for pcspath in paths:
+                self.__require(pcspath)
+            for pcspath in paths:
+                dirs, files = self.__subtree(pcspath)
+                for path in dirs:
+                    self.dirs.discard(path)
+                for path in files:
+                    del self.files[path]
+            return {'request_id': self.random.randint(0, 2 ** 31)}
+
+    def op_move(self, query, form, body):
+        return self.__move_copy(query, form, True)
+
+    def op_copy(self, query, form, body):
+        return self.__move_copy(query, form, False)
+
+    def __move_copy(self, query, form, move):
+        with self.__lock:
+            done = []
+            for src, dest in self.__items(query, form, ('from', 'to')):
+                try:
+                    self.__transfer(src, dest, move)
+                    done.append({'from': src, 'to': dest})
+                except PcsStubError:
+                    if 'param' not in form:
+                        raise
+            return {'extra': {'list': done}}
+
+    def op_upload(self, query, form, body):
+        md5 = hashlib.md5(body).hexdigest()
+        with self.__lock:
+            # like the real server, uploaded content stays usable as a superfile block
+            self.tmpfiles[md5] = body
+            if query.get('type') == 'tmpfile':
+                return {'md5': md5}
+            return self.__store(_normalize(query['path']), body, [md5], query.get('ondup', 'overwrite'))
+
+    def op_createsuperfile(self, query, form, body):
+        blocks = json.loads(form['param'])['block_list']
+        with self.__lock:
+            if any(md5 not in self.tmpfiles for md5 in blocks):
+                raise PcsStubError(400, 31363, 'block miss in superfile2')
+            data = b''.join(self.tmpfiles[md5] for md5 in blocks)
+            return self.__store(_normalize(query['path']), data, blocks, query.get('ondup', 'overwrite'))
+
+    def op_rapidupload(self, query, form, body):
+        with self.__lock:
+            for f in list(self.files.values()):
+                if f['md5'] == query['content-md5'] and len(f['data']) == int(query['content-length']):
+                    return self.__store(_normalize(query['path']), f['data'], f['blocks'], query.get('ondup', 'overwrite'))
+            raise PcsStubError(404, 31079, 'file md5 not found, you should use upload API.')
+
+    def op_download(self, query):
+        with self.__lock:
+            pcspath = _normalize(query['path'])
+            if pcspath not in self.files:
+                raise PcsStubError(404, 31066, 'file does not exist')
+            return self.files[pcspath]['data']
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve a local PCS stand-in until interrupted.')
+    parser.add_argument('--port', type=int, default=8088)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--bandwidth', type=int, default=0)
+    parser.add_argument('--errorrate', type=float, default=0)
+    parser.add_argument('--certfile')
+    parser.add_argument('--keyfile')
+    args = parser.parse_args()
+    stub = PcsStub(args.latency, args.bandwidth, args.errorrate, port=args.port, certfile=args.certfile, keyfile=args.keyfile).start()
+    print('PCS stand-in listening on %s/rest/2.0/pcs' % (stub.url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stub.stop()
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+
+from fsync.autotune import AdaptiveController
+
+def test_error_halves_limit_and_slice():
+    controller = AdaptiveController(maxworkers=16, workers=8, slicesize=8 * 1024 * 1024, cooldown=60)
+    controller.record(0, 1, False)
+    assert controller.limit == 4
+    assert controller.slicesize == 4 * 1024 * 1024
+    # a burst of errors within the cooldown only counts once
+    controller.record(0, 1, False)
+    assert controller.limit == 4
+
+def test_success_ramps_up():
+    controller = AdaptiveController(maxworkers=4, workers=1, slicesize=1024 * 1024, target=30)
+    for _ in range(10):
+        controller.record(controller.slicesize, 1, True)
+    assert controller.limit == 4
+    assert controller.slicesize > 1024 * 1024
+
+def test_slow_slices_shrink():
+    controller = AdaptiveController(slicesize=8 * 1024 * 1024, target=10)
+    controller.record(8 * 1024 * 1024, 100, True)
+    assert controller.slicesize == 4 * 1024 * 1024
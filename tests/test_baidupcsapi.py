@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 
-from fsync.baidupcsapi import BaiduPcsApi
+from fsync.baidupcsapi import BaiduPcsApi, AsyncBaiduPcsApi, PcsDirCache, batch_param, batch_results
 from fsync.conf import SynConfig
+import asyncio
 import json
 import hashlib
 import os
@@ -39,6 +40,59 @@ def test_mkdir_cp_mv_rm():
     r = baidu.rm_pcsfile(testdir+"/aa")
     assert r == 0
 
+def test_batch_results():
+    assert batch_param('move', [('/a', '/b')]) == {'list': [{'from': '/a', 'to': '/b'}]}
+    assert batch_param('delete', ['/a']) == {'list': [{'path': '/a'}]}
+    r = batch_results('meta', ['/a', '/b'], 200, {'list': [{'path': '/b', 'isdir': 1}]})
+    assert r == [(1, {}), (0, {'path': '/b', 'isdir': 1})]
+    r = batch_results('move', [('/a', '/b'), ('/c', '/d')], 200, {'extra': {'list': [{'from': '/c', 'to': '/d'}]}})
+    assert r == [1, 0]
+    assert batch_results('delete', ['/a', '/b'], 200, {'request_id': 1}) == [0, 0]
+    assert batch_results('delete', ['/a', '/b'], 404, {'error_code': 31066, 'error_msg': 'file does not exist'}) is None
+    assert batch_results('delete', ['/a'], 404, {'error_code': 31066, 'error_msg': 'file does not exist'}) == [1]
+    assert batch_results('copy', ['/a', '/b'], 500, {'error_code': 31021, 'error_msg': 'network error'}) == [1, 1]
+
+def test_batch_cp_mv_rm():
+    baidu = BaiduPcsApi()
+    names = ["aa", "bb", "cc"]
+    for name in names:
+        r = baidu.check_create_pcsdir(testdir+"/"+name)
+        assert r == 0
+    r = baidu.cp_pcsfiles([(testdir+"/"+name, testdir+"/"+name+"1") for name in names])
+    assert r == [0, 0, 0]
+    r = baidu.mv_pcsfiles([(testdir+"/"+name, testdir+"/"+name+"2") for name in names])
+    assert r == [0, 0, 0]
+    metas = baidu.get_pcs_filemeta_batch([testdir+"/aa1", testdir+"/notexist", testdir+"/cc2"])
+    assert [m[0] for m in metas] == [0, 1, 0]
+    assert metas[2][1]["path"] == testdir+"/cc2"
+    r = baidu.rm_pcsfiles([testdir+"/"+name+suffix for name in names for suffix in ["1", "2"]])
+    assert r == [0] * 6
+
+def test_pcsdircache():
+    cache = PcsDirCache()
+    cache.add("/apps/fsync/a/b/")
+    assert cache.known("/apps/fsync/a") and cache.known("/apps/fsync/a/b")
+    cache.invalidate("/apps/fsync/a")
+    assert not cache.known("/apps/fsync/a/b") and cache.known("/apps/fsync")
+    owned, waiting = cache.claim(["/x", "/apps/fsync"])
+    assert owned == ["/x"] and waiting == []
+    again, waiting = cache.claim(["/x"])
+    assert again == [] and len(waiting) == 1 and not waiting[0].is_set()
+    cache.release(owned)
+    assert waiting[0].is_set()
+
+def test_ensure_pcsdirs():
+    baidu = BaiduPcsApi()
+    r = baidu.ensure_pcsdirs([testdir+"/aa/x", testdir+"/aa", testdir+"/bb"])
+    assert r == 0
+    assert baidu.dircache.known(testdir+"/aa")
+    filemeta = baidu.get_pcs_filemeta(testdir+"/aa/x")
+    assert filemeta[0] == 0
+    assert filemeta[1]["isdir"] == 1
+    r = baidu.rm_pcsfiles([testdir+"/aa", testdir+"/bb"])
+    assert r == [0, 0]
+    assert not baidu.dircache.known(testdir+"/aa/x")
+
 def test_get_filemeta():
     baidu = BaiduPcsApi()
     r = baidu.check_create_pcsdir(testdir)
@@ -64,6 +118,18 @@ def test_get_filelist():
     r = baidu.rm_pcsfile(testdir+"/aa")
     assert r == 0
 
+def test_iter_filelist():
+    baidu = BaiduPcsApi()
+    for name in ["aa", "bb", "cc"]:
+        r = baidu.check_create_pcsdir(testdir+"/"+name)
+        assert r == 0
+    paths = [entry["path"] for entry in baidu.iter_pcs_filelist(testdir, 2)]
+    assert paths == [testdir+"/aa", testdir+"/bb", testdir+"/cc"]
+    assert list(baidu.iter_pcs_filelist(testdir+"/notexist")) == []
+    for name in ["aa", "bb", "cc"]:
+        r = baidu.rm_pcsfile(testdir+"/"+name)
+        assert r == 0
+
 def test_upload_file():
     baidu = BaiduPcsApi()
     r = baidu.check_create_pcsdir(testdir)
@@ -135,6 +201,49 @@ def test_sclie_uploadfile():
     r = baidu.slice_upload_createsuperfile(testdir+"/aaa.txt", param)
     assert r == 0
 
+def test_parallel_upload():
+    baidu = BaiduPcsApi()
+    r = baidu.check_create_pcsdir(testdir)
+    assert r == 0
+    filesize = os.stat("./tests/aaa.txt").st_size
+    r = baidu.parallel_upload("./tests/aaa.txt", testdir+"/aaa.txt", max(filesize//3, 1), 3)
+    assert r == 0
+    filemeta = baidu.get_pcs_filemeta(testdir+"/aaa.txt")
+    assert filemeta[0] == 0
+    assert filemeta[1]["size"] == filesize
+    r = baidu.rm_pcsfile(testdir+"/aaa.txt")
+    assert r == 0
+
+def test_parallel_download():
+    baidu = BaiduPcsApi()
+    r = baidu.check_create_pcsdir(testdir)
+    assert r == 0
+    r = baidu.upload_file('./tests/aaa.txt', testdir+"/aaa.txt")
+    assert r == 0
+    r = baidu.parallel_download('./tests/bbb.txt', testdir+"/aaa.txt", 3)
+    assert r == 0
+    assert md5sum("./tests/bbb.txt") == md5sum("./tests/aaa.txt")
+    r = baidu.rm_pcsfile(testdir+"/aaa.txt")
+    assert r == 0
+    os.remove("./tests/bbb.txt")
+
+def test_async_gather_meta():
+    async def gather():
+        baidu = AsyncBaiduPcsApi()
+        r = await baidu.check_create_pcsdir(testdir+"/aa")
+        assert r == 0
+        r = await baidu.check_create_pcsdir(testdir+"/bb")
+        assert r == 0
+        metas = await baidu.gather_meta([testdir+"/aa", testdir+"/bb"], 2)
+        assert [m[0] for m in metas] == [0, 0]
+        assert [m[1]["path"] for m in metas] == [testdir+"/aa", testdir+"/bb"]
+        r = await baidu.rm_pcsfile(testdir+"/aa")
+        assert r == 0
+        r = await baidu.rm_pcsfile(testdir+"/bb")
+        assert r == 0
+        baidu.close()
+    asyncio.run(gather())
+
 if __name__ == "__main__":
     test_quota()
     test_mkdir_cp_mv_rm()
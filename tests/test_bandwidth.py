@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+from fsync import bandwidth
+from fsync.bandwidth import BandwidthLimiter, TokenBucket, parse_schedule
+from fsync.baidupcsapi import BaiduPcsApi
+from pcsstub import PcsStub
+import os
+import threading
+import time
+
+def test_parse_schedule():
+    assert parse_schedule('8-18', 100, 200) == [(8, 18, 100, 200)]
+    assert parse_schedule('8-12, 22-6@10/20', 100, 200) == [(8, 12, 100, 200), (22, 6, 10, 20)]
+    assert parse_schedule('', 100, 200) == []
+
+def test_token_bucket():
+    bucket = TokenBucket(1000)
+    assert bucket.consume(500) > 0
+    assert TokenBucket(0).consume(10 ** 9) == 0
+
+def test_limiter_follows_schedule():
+    now = time.time()
+    hour = time.localtime(now).tm_hour
+    limiter = BandwidthLimiter([((hour + 1) % 24, (hour + 2) % 24, 100, 200)])
+    limiter.refresh(now)
+    assert limiter.configured
+    assert limiter.send.rate == 0 and limiter.recv.rate == 0
+    limiter.refresh(now + 3600)
+    assert limiter.send.rate == 100 and limiter.recv.rate == 200
+
+def test_schedule_change_reaches_running_transfer(tmp_path, monkeypatch):
+    data = os.urandom(1024 * 1024)
+    src = str(tmp_path / 'src')
+    dest = str(tmp_path / 'dest')
+    with open(src, 'wb') as f:
+        f.write(data)
+    with PcsStub():
+        assert BaiduPcsApi.upload_file(src, '/apps/fsync/limited') == 0
+        limiter = BandwidthLimiter([(0, 24, 0, 128 * 1024)])
+        monkeypatch.setattr(bandwidth, '_limiter', limiter)
+        results = []
+        started = time.time()
+        thread = threading.Thread(target=lambda: results.append(
+            BaiduPcsApi.download_file(dest, '/apps/fsync/limited', '0-%d' % (len(data) - 1))))
+        thread.start()
+        time.sleep(1.5)
+        # 1MB at 128KB/s takes 8s; well under half of it may have arrived
+        assert os.path.getsize(dest) < 512 * 1024
+        # the window closes: the running download goes on unlimited
+        limiter.windows = [(0, 24, 0, 0)]
+        thread.join(30)
+        elapsed = time.time() - started
+    assert results == [0]
+    assert elapsed < 5
+    with open(dest, 'rb') as f:
+        assert f.read() == data
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+from fsync.checksum import BLOCK_SIZE, ChecksumCache, compute_checksums, get_checksums
+import binascii
+import hashlib
+import os
+
+def write_file(filename, size):
+    with open(filename, 'wb') as f:
+        f.write(os.urandom(size))
+
+def test_compute_checksums(tmp_path):
+    filename = str(tmp_path / 'data')
+    write_file(filename, 2 * BLOCK_SIZE + 12345)
+    with open(filename, 'rb') as f:
+        data = f.read()
+    checksums = compute_checksums(filename)
+    assert checksums['size'] == len(data)
+    assert checksums['md5'] == hashlib.md5(data).hexdigest()
+    assert checksums['crc32'] == '%x' % (binascii.crc32(data) & 0xffffffff)
+    assert checksums['slicemd5'] == hashlib.md5(data[:262144]).hexdigest()
+    assert checksums['blocks'] == [hashlib.md5(data[i:i + BLOCK_SIZE]).hexdigest() for i in range(0, len(data), BLOCK_SIZE)]
+
+def test_compute_checksums_empty(tmp_path):
+    filename = str(tmp_path / 'empty')
+    write_file(filename, 0)
+    checksums = compute_checksums(filename)
+    assert checksums['size'] == 0
+    assert checksums['md5'] == hashlib.md5(b'').hexdigest()
+    assert checksums['blocks'] == []
+
+def test_checksum_cache(tmp_path):
+    filename = str(tmp_path / 'data')
+    write_file(filename, 300000)
+    cache = ChecksumCache(str(tmp_path / 'checksum.db'))
+    assert cache.get(os.stat(filename)) is None
+    checksums = get_checksums(filename, cache)
+    assert cache.get(os.stat(filename)) == checksums
+    write_file(filename, 300001)
+    assert cache.get(os.stat(filename)) is None
+    assert get_checksums(filename, cache)['size'] == 300001
+    cache.close()
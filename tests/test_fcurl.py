@@ -0,0 +1,166 @@
+import json
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from fsync import bandwidth
+from fsync.baidupcsapi import BaiduPcsApi
+from fsync.conf import SynConfig
+from fsync.fcurl import CurlPool, SynCurl, SynCurlMulti
+from fsync.fileio import FileWriter
+from fsync.retry import RetryPolicy
+from pcsstub import PcsStub
+
+def meta_query(pcspath):
+    return {'method': 'meta', 'access_token': SynConfig.token['access_token'], 'path': pcspath}
+
+def download_query(pcspath):
+    return {'method': 'download', 'access_token': SynConfig.token['access_token'], 'path': pcspath}
+
+def put_file(tmp_path, pcspath, data):
+    src = str(tmp_path / 'src')
+    with open(src, 'wb') as f:
+        f.write(data)
+    assert BaiduPcsApi.upload_file(src, pcspath) == 0
+
+def test_pool_reuse_expiry_and_recycling(monkeypatch):
+    host = ('http', 'example.com')
+    pool = CurlPool(maxsize=2, idletimeout=0.2, maxrequests=2)
+    curl = pool.acquire(host)
+    pool.release(host, curl)
+    assert pool.acquire(host) is curl
+    # the second request wears it out
+    pool.release(host, curl)
+    other = pool.acquire(host)
+    assert other is not curl
+    pool.release(host, other)
+    time.sleep(0.3)
+    assert pool.acquire(host) is not other
+    # a transport error drops the handle
+    curl = pool.acquire(host)
+    pool.release(host, curl, False)
+    assert pool.acquire(host) is not curl
+    # by default the pool keeps a handle for every transfer thread
+    monkeypatch.setitem(SynConfig.config, 'maxthreadnumber', 24)
+    assert CurlPool().maxsize == 24
+
+def serve_once(listener):
+    conn, _ = listener.accept()
+    conn.recv(65536)
+    conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+    # the server drops the kept-alive connection right after answering
+    time.sleep(0.1)
+    conn.close()
+
+def test_pool_health_check():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    url = 'http://127.0.0.1:%d/' % listener.getsockname()[1]
+    host = CurlPool.hostkey(url)
+    server = threading.Thread(target=serve_once, args=(listener,), daemon=True)
+    server.start()
+    pool = CurlPool(maxsize=2, idletimeout=60, maxrequests=100)
+    curl = pool.acquire(host)
+    curl.setopt(curl.URL, url)
+    curl.setopt(curl.WRITEFUNCTION, lambda data: None)
+    curl.perform()
+    pool.release(host, curl)
+    server.join()
+    listener.close()
+    time.sleep(0.1)
+    assert pool.acquire(host) is not curl
+
+@pytest.fixture
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(SynCurl, 'policy', RetryPolicy(retries=20, basedelay=0.01, maxdelay=0.05))
+    monkeypatch.setitem(SynConfig.config, 'breakerthreshold', 1000)
+    monkeypatch.setitem(SynConfig.config, 'breakercooldown', 0.05)
+
+def test_multi_retries_injected_errors(tmp_path, fast_retries):
+    with PcsStub(seed=7) as stub:
+        for i in range(20):
+            put_file(tmp_path, '/apps/fsync/m/%d' % i, b'%d' % i)
+        stub.requests.clear()
+        stub.errorrate = 0.3
+        multi = SynCurlMulti(maxtransfers=8)
+        transfers = [multi.add(BaiduPcsApi.pcs_url + '/file', meta_query('/apps/fsync/m/%d' % i), '', 'GET') for i in range(20)]
+        multi.run()
+        multi.close()
+        for i, transfer in enumerate(transfers):
+            assert transfer['retcode'] == 200
+            assert json.loads(transfer['response'])['list'][0]['path'] == '/apps/fsync/m/%d' % i
+        assert stub.requests['meta'] > 20
+
+def test_multi_ranges_into_shared_writer(tmp_path):
+    data = os.urandom(1024 * 1024 + 123)
+    dest = str(tmp_path / 'dest')
+    with PcsStub():
+        put_file(tmp_path, '/apps/fsync/big', data)
+        writer = FileWriter(dest, len(data))
+        multi = SynCurlMulti()
+        step = 100 * 1024
+        transfers = [multi.add(BaiduPcsApi.download_url + '/file', download_query('/apps/fsync/big'),
+                               '%d-%d' % (start, min(start + step, len(data)) - 1), 'GET', SynCurl.Download, dest, writer=writer)
+                     for start in range(0, len(data), step)]
+        multi.run()
+        multi.close()
+        writer.close()
+    assert all(transfer['retcode'] == 206 for transfer in transfers)
+    with open(dest, 'rb') as f:
+        assert f.read() == data
+
+def test_multi_callbacks(tmp_path):
+    with PcsStub():
+        for name in ('a', 'b'):
+            put_file(tmp_path, '/apps/fsync/c/' + name, name.encode())
+        multi = SynCurlMulti()
+        results = {}
+
+        def done(name, then=None):
+            def callback(retcode, response):
+                results[name] = (retcode, json.loads(response).get('list', [{}])[0].get('path'))
+                if then is not None:
+                    # a transfer queued from a callback still runs before run() returns
+                    multi.add(BaiduPcsApi.pcs_url + '/file', meta_query('/apps/fsync/c/' + then), '', 'GET', callback=done(then))
+                if name == 'missing':
+                    raise RuntimeError('callbacks failing must not stop the others')
+            return callback
+
+        multi.add(BaiduPcsApi.pcs_url + '/file', meta_query('/apps/fsync/c/a'), '', 'GET', callback=done('a', then='b'))
+        multi.add(BaiduPcsApi.pcs_url + '/file', meta_query('/apps/fsync/c/missing'), '', 'GET', callback=done('missing'))
+        multi.run()
+        multi.close()
+    assert results == {'a': (200, '/apps/fsync/c/a'), 'b': (200, '/apps/fsync/c/b'), 'missing': (404, None)}
+
+def test_multi_throttled_handle_resumes(tmp_path, monkeypatch):
+    data = os.urandom(512 * 1024)
+    dest = str(tmp_path / 'dest')
+    pauses = []
+    pause = SynCurlMulti._SynCurlMulti__pause
+
+    def counting_pause(self, curl, delay):
+        pauses.append(delay)
+        pause(self, curl, delay)
+
+    monkeypatch.setattr(SynCurlMulti, '_SynCurlMulti__pause', counting_pause)
+    with PcsStub():
+        put_file(tmp_path, '/apps/fsync/slow', data)
+        # created now, so no tokens are saved up while the stub starts
+        monkeypatch.setattr(bandwidth, '_limiter', bandwidth.BandwidthLimiter([(0, 24, 0, 256 * 1024)]))
+        multi = SynCurlMulti()
+        started = time.time()
+        transfer = multi.add(BaiduPcsApi.download_url + '/file', download_query('/apps/fsync/slow'),
+                             '0-%d' % (len(data) - 1), 'GET', SynCurl.Download, dest)
+        multi.run()
+        elapsed = time.time() - started
+        multi.close()
+    assert transfer['retcode'] == 206
+    assert pauses
+    # 512KB at 256KB/s, the first second's burst is not saved up yet
+    assert 1.5 <= elapsed < 10
+    with open(dest, 'rb') as f:
+        assert f.read() == data
@@ -0,0 +1,71 @@
+import mmap
+import os
+
+from fsync import fileio
+from fsync.fileio import FileWriter, map_range, preallocate
+
+def test_writer_out_of_order(tmp_path):
+    data = os.urandom(10000)
+    filepath = str(tmp_path / 'out')
+    writer = FileWriter(filepath, len(data))
+    for start in (7000, 0, 9000, 3000, 5000):
+        writer.write(start, data[start:start + 2000])
+    writer.write(2000, memoryview(data)[2000:3000])
+    writer.close()
+    with open(filepath, 'rb') as f:
+        assert f.read() == data
+
+def test_preallocate(tmp_path):
+    filepath = str(tmp_path / 'out')
+    fd = os.open(filepath, os.O_RDWR | os.O_CREAT)
+    try:
+        preallocate(fd, 0)
+        assert os.fstat(fd).st_size == 0
+        preallocate(fd, 123456)
+        assert os.fstat(fd).st_size == 123456
+        # never shrinks a longer file
+        preallocate(fd, 1000)
+        assert os.fstat(fd).st_size == 123456
+    finally:
+        os.close(fd)
+
+def test_preallocate_without_fallocate(tmp_path, monkeypatch):
+    def unsupported(fd, offset, size):
+        raise OSError(95, 'Operation not supported')
+
+    filepath = str(tmp_path / 'out')
+    for fallocate in (unsupported, None):
+        if fallocate is None:
+            monkeypatch.delattr(fileio.os, 'posix_fallocate', raising=False)
+        else:
+            monkeypatch.setattr(fileio.os, 'posix_fallocate', fallocate, raising=False)
+        writer = FileWriter(filepath, 5000)
+        assert os.path.getsize(filepath) == 5000
+        writer.write(4990, b'0123456789')
+        writer.close()
+        with open(filepath, 'rb') as f:
+            assert f.read()[4990:] == b'0123456789'
+        os.remove(filepath)
+
+def test_map_range(tmp_path):
+    granularity = mmap.ALLOCATIONGRANULARITY
+    data = os.urandom(3 * granularity + 1234)
+    filepath = str(tmp_path / 'in')
+    with open(filepath, 'wb') as f:
+        f.write(data)
+    with open(filepath, 'rb') as f:
+        fd = f.fileno()
+        # unaligned starts and ends, across and inside granularity pages, and the last partial slice
+        for startpos, endpos in ((0, 0), (1, 99), (granularity - 1, granularity), (granularity + 17, 2 * granularity + 5),
+                                 (3 * granularity, len(data) - 1), (len(data) - 1, len(data) - 1), (5, len(data) - 1)):
+            mm = map_range(fd, startpos, endpos)
+            chunks = []
+            while True:
+                chunk = mm.read(1000)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            mm.close()
+            assert b''.join(chunks) == data[startpos:endpos + 1]
+        empty = map_range(fd, 100, 99)
+        assert empty.read(1000) == b''
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+import hashlib
+
+from fsync.index import FileIndex
+from fsync.planner import execute_plan
+from pcsstub import PcsStub
+
+def record(path, size=1, md5='d41d8cd98f00b204e9800998ecf8427e'):
+    return {'path': path, 'size': size, 'mtime': 1000, 'md5': md5, 'fs_id': 1, 'remote_mtime': 2000}
+
+def test_update_get_delete(tmp_path):
+    index = FileIndex(str(tmp_path / 'index.db'))
+    index.update([record('/a/x'), record('/a/y', 2)])
+    assert index.get('/a/y')['size'] == 2
+    index.update([record('/a/y', 3)])
+    assert index.get('/a/y')['size'] == 3
+    index.delete(['/a/y'])
+    assert index.get('/a/y') is None
+    assert index.get('/a/x') is not None
+    index.close()
+
+def test_list_dir(tmp_path):
+    index = FileIndex(str(tmp_path / 'index.db'))
+    index.update([record(p) for p in ['/a/x', '/a/b/y', '/a0', '/ab/z', '/a/b/c/w']])
+    assert [r['path'] for r in index.list_dir('/a')] == ['/a/b/c/w', '/a/b/y', '/a/x']
+    assert [r['path'] for r in index.list_dir('/a/', recursive=False)] == ['/a/x']
+    index.delete_dir('/a/b')
+    assert [r['path'] for r in index.list_dir('/a')] == ['/a/x']
+    index.close()
+
+def test_execute_plan_records(tmp_path):
+    root = tmp_path / 'local'
+    root.mkdir()
+    (root / 'a').write_bytes(b'aaa')
+    (root / 'b').write_bytes(b'bbbb')
+    index = FileIndex(str(tmp_path / 'index.db'))
+    with PcsStub() as stub:
+        assert execute_plan([('upload', 'a'), ('upload', 'b')], str(root), '/apps/fsync/i', index) == 0
+        a = index.get('/apps/fsync/i/a')
+        assert (a['size'], a['md5']) == (3, hashlib.md5(b'aaa').hexdigest())
+        assert a['fs_id'] == stub.files['/apps/fsync/i/a']['fs_id']
+        (root / 'a').rename(root / 'c')
+        (root / 'b').unlink()
+        assert execute_plan([('move', 'a', 'c'), ('delete', 'b')], str(root), '/apps/fsync/i', index) == 0
+    assert [r['path'] for r in index.list_dir('/apps/fsync/i')] == ['/apps/fsync/i/c']
+    assert index.get('/apps/fsync/i/c')['md5'] == a['md5']
+    index.close()
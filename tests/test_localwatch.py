@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+
+import pytest
+
+from fsync.baidupcsapi import BaiduPcsApi
+from fsync.index import FileIndex
+from fsync.localscan import scan_local
+from fsync.localwatch import DirtySet, InotifyWatcher, coalesce, full_sync, sync_paths
+from pcsstub import PcsStub
+
+def make_tree(root, files):
+    for relpath, data in files.items():
+        path = os.path.join(root, *relpath.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+def test_scan_local(tmp_path):
+    root = str(tmp_path)
+    make_tree(root, {'a': b'1', 'd/b': b'22', 'd/e/c': b'333', 'f/g/h/i': b''})
+    os.symlink(os.path.join(root, 'd'), os.path.join(root, 'link'))
+    records = {relpath: (isdir, size) for relpath, isdir, size, mtime in scan_local(root, 3)}
+    assert records == {'a': (False, 1), 'd': (True, 0), 'd/b': (False, 2), 'd/e': (True, 0), 'd/e/c': (False, 3),
+                       'f': (True, 0), 'f/g': (True, 0), 'f/g/h': (True, 0), 'f/g/h/i': (False, 0), 'link': (True, 0)}
+
+def test_dirty_set_debounce():
+    dirty = DirtySet(delay=2, maxdelay=10)
+    dirty.add('a', now=0)
+    dirty.add('d/x', now=0)
+    dirty.add('d', now=1)
+    assert dirty.take(now=1.5) == []
+    assert dirty.timeout(now=1.5) == 0.5
+    assert dirty.take(now=3) == ['a', 'd']
+    assert len(dirty) == 0
+    for now in range(0, 12):
+        dirty.add('busy', now=now)
+        assert dirty.take(now=now) == (['busy'] if now == 10 else [])
+    assert coalesce(['a/b', 'a', 'ab', 'c/d']) == ['a', 'ab', 'c/d']
+    assert coalesce(['x', '']) == ['']
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='inotify is Linux only')
+def test_inotify_watcher(tmp_path):
+    root = str(tmp_path)
+    make_tree(root, {'d/a': b'1'})
+    with InotifyWatcher(root) as watcher:
+        make_tree(root, {'d/a': b'2', 'new/sub/b': b'3'})
+        assert watcher.read(1) == ['d/a', 'new']
+        make_tree(root, {'new/sub/c': b'4'})
+        os.rename(os.path.join(root, 'd'), os.path.join(root, 'e'))
+        assert watcher.read(1) == ['d', 'e', 'new/sub/c']
+        os.remove(os.path.join(root, 'e', 'a'))
+        time.sleep(0.1)
+        assert watcher.read(1) == ['e/a']
+
+def test_sync_paths(tmp_path):
+    root = str(tmp_path / 'local')
+    index = FileIndex(str(tmp_path / 'index.db'))
+    make_tree(root, {'a': b'1', 'd/b': b'22', 'd/c': b'333'})
+    with PcsStub() as stub:
+        assert sync_paths(root, '/apps/fsync/w', ['a', 'd'], index=index) == 0
+        assert sorted(stub.files) == ['/apps/fsync/w/a', '/apps/fsync/w/d/b', '/apps/fsync/w/d/c']
+        make_tree(root, {'a': b'changed'})
+        os.rename(os.path.join(root, 'd', 'b'), os.path.join(root, 'b'))
+        assert sync_paths(root, '/apps/fsync/w', ['a', 'b', 'd/b'], index=index) == 0
+        assert stub.files['/apps/fsync/w/a']['data'] == b'changed'
+        assert sorted(stub.files) == ['/apps/fsync/w/a', '/apps/fsync/w/b', '/apps/fsync/w/d/c']
+        assert stub.requests['move'] == 1
+        # a renamed directory moves its files
+        os.rename(os.path.join(root, 'd'), os.path.join(root, 'e'))
+        assert sync_paths(root, '/apps/fsync/w', ['d', 'e'], index=index) == 0
+        assert stub.requests['move'] == 2
+        assert sorted(stub.files) == ['/apps/fsync/w/a', '/apps/fsync/w/b', '/apps/fsync/w/e/c']
+        os.remove(os.path.join(root, 'e', 'c'))
+        os.rmdir(os.path.join(root, 'e'))
+        assert sync_paths(root, '/apps/fsync/w', ['e'], index=index) == 0
+        assert '/apps/fsync/w/e' not in stub.dirs
+        assert sorted(stub.files) == ['/apps/fsync/w/a', '/apps/fsync/w/b']
+        assert index.list_dir('/apps/fsync/w/e') == []
+        assert stub.requests.get('list', 0) == 0
+
+def test_full_sync_uses_index(tmp_path):
+    root = str(tmp_path / 'local')
+    index = FileIndex(str(tmp_path / 'index.db'))
+    make_tree(root, {'a': b'1', 'd/b': b'22'})
+    with PcsStub() as stub:
+        assert BaiduPcsApi.upload_file(os.path.join(root, 'd', 'b'), '/apps/fsync/w/d/b') == 0
+        stub.requests.clear()
+        assert full_sync(root, '/apps/fsync/w', index=index) == 0
+        assert sorted(stub.files) == ['/apps/fsync/w/a', '/apps/fsync/w/d/b']
+        # the file that was already there got indexed by the first listing
+        assert index.get('/apps/fsync/w/d/b')['md5'] is not None
+        listed = stub.requests['list']
+        stub.requests.clear()
+        assert full_sync(root, '/apps/fsync/w', index=index) == 0
+        assert stub.requests == {}
+        make_tree(root, {'a': b'changed'})
+        assert full_sync(root, '/apps/fsync/w', index=index) == 0
+        assert stub.files['/apps/fsync/w/a']['data'] == b'changed'
+        assert 'list' not in stub.requests
+        assert full_sync(root, '/apps/fsync/w', index=index, rescan=True) == 0
+        assert stub.requests['list'] == listed
@@ -0,0 +1,53 @@
+import io
+import logging
+import queue
+
+from fsync.common.log import ColouredHandler, LazyQueueHandler, LogWriter
+
+class CountingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+        self.flushes = 0
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+    def flush(self):
+        self.flushes += 1
+
+def test_queue_writer_batches_flushes():
+    records = queue.SimpleQueue()
+    handler = CountingHandler()
+    logger = logging.getLogger('test_queue_writer')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(LazyQueueHandler(records))
+    args = ['before']
+    for i in range(100):
+        logger.debug('message %d %s', i, args)
+    args.append('after')
+    writer = LogWriter(records, [handler])
+    writer.start()
+    writer.stop()
+    assert len(handler.messages) == 100
+    assert handler.messages[0] == "message 0 ['before']"
+    assert handler.flushes == 1
+
+def test_coloured_handler_caches_formatters():
+    stream = io.StringIO()
+    stream.isatty = lambda: True
+    handler = ColouredHandler(stream)
+    handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+    logger = logging.getLogger('test_coloured')
+    logger.propagate = False
+    logger.addHandler(handler)
+    logger.warning('one')
+    logger.warning('two')
+    assert len(handler._formatters) == 1
+    try:
+        raise RuntimeError('Opa!')
+    except RuntimeError:
+        logger.exception('failed')
+    output = stream.getvalue()
+    assert 'one' in output and 'two' in output and 'Opa!' in output
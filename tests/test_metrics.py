@@ -0,0 +1,33 @@
+import json
+
+from fsync.metrics import Histogram, TransferMetrics
+
+def test_histogram():
+    histogram = Histogram((1, 2, 4))
+    for value in [0.5, 1, 1.5, 3, 10]:
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1, 1]
+    assert histogram.count == 5
+    assert histogram.sum == 16
+    assert histogram.quantile(0.5) == 2
+    assert histogram.quantile(0.99) is None
+
+def test_record_and_export():
+    metrics = TransferMetrics()
+    timings = {'namelookup': 0.001, 'connect': 0.002, 'appconnect': 0.01, 'starttransfer': 0.05, 'total': 0.2}
+    metrics.record('meta', 200, timings, 100, 500, 2500)
+    metrics.record('meta', 503, timings, 100, 50, 0, retried=True)
+    metrics.record('download', 'E28', {'total': 30.0}, 0, 1024)
+    snapshot = json.loads(metrics.to_json())
+    assert {'method': 'meta', 'status': '200', 'count': 1} in snapshot['requests']
+    assert snapshot['retries'] == {'meta': 1}
+    assert {'method': 'meta', 'direction': 'received', 'bytes': 550} in snapshot['bytes']
+    total = [item for item in snapshot['latency'] if item['method'] == 'meta' and item['phase'] == 'total'][0]
+    assert total['count'] == 2 and total['p99'] == 0.25
+    text = metrics.to_prometheus()
+    assert 'fsync_requests_total{method="download",status="E28"} 1' in text
+    assert 'fsync_request_seconds_bucket{method="meta",phase="total",le="+Inf"} 2' in text
+    assert 'fsync_request_seconds_count{method="download",phase="total"} 1' in text
+    assert '# TYPE fsync_transfer_speed_bytes histogram' in text
+    metrics.reset()
+    assert metrics.snapshot()['requests'] == []
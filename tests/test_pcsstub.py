@@ -0,0 +1,239 @@
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import pytest
+
+from fsync import baidupcsapi
+from fsync.baidupcsapi import AsyncBaiduPcsApi, BaiduPcsApi
+from fsync.conf import SynConfig
+from fsync.fileio import FileWriter
+from fsync.stages import COMPRESS_HEADER
+from pcsstub import PcsStub
+
+def md5sum(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+def test_dirs_and_meta():
+    with PcsStub() as stub:
+        assert BaiduPcsApi.get_pcs_quota() == 0
+        assert BaiduPcsApi.ensure_pcsdirs(['/apps/fsync/a/x', '/apps/fsync/b']) == 0
+        assert stub.requests['mkdir'] == 2
+        ret, entries = BaiduPcsApi.get_pcs_filelist('/apps/fsync', 0, 100)
+        assert ret == 0
+        assert [entry['path'] for entry in entries] == ['/apps/fsync/a', '/apps/fsync/b']
+        metas = BaiduPcsApi.get_pcs_filemeta_batch(['/apps/fsync/a/x', '/apps/fsync/c'], True)
+        assert [meta[0] for meta in metas] == [0, 1]
+        assert BaiduPcsApi.mv_pcsfiles([('/apps/fsync/a', '/apps/fsync/c')]) == [0]
+        assert BaiduPcsApi.rm_pcsfiles(['/apps/fsync/b', '/apps/fsync/c']) == [0, 0]
+        assert stub.dirs == set(['/', '/apps', '/apps/fsync'])
+
+def test_rejected_batch_is_bisected():
+    paths = ['/apps/fsync/batch/%03d' % i for i in range(100)]
+    with PcsStub() as stub:
+        assert BaiduPcsApi.ensure_pcsdirs(paths) == 0
+        stub.requests.clear()
+        # one missing path makes PCS reject the whole batch
+        results = BaiduPcsApi.rm_pcsfiles(paths[:37] + ['/apps/fsync/missing'] + paths[37:70], True)
+        assert results == [0] * 37 + [1] + [0] * 33
+        assert 1 < stub.requests['delete'] <= 2 * 7 + 1
+        assert sorted(path for path in stub.dirs if path.startswith('/apps/fsync/batch/')) == paths[70:]
+
+        async def metas():
+            api = AsyncBaiduPcsApi()
+            try:
+                return await api.get_pcs_filemeta_batch(paths[70:80] + ['/apps/fsync/missing'] + paths[80:], True)
+            finally:
+                api.close()
+
+        stub.requests.clear()
+        assert [meta[0] for meta in asyncio.run(metas())] == [0] * 10 + [1] + [0] * 20
+        assert 1 < stub.requests['meta'] <= 2 * 5 + 1
+
+def test_upload_download(tmp_path):
+    src = str(tmp_path / 'src')
+    dest = str(tmp_path / 'dest')
+    with open(src, 'wb') as f:
+        f.write(os.urandom(3 * 1024 * 1024 + 123))
+    with PcsStub() as stub:
+        assert BaiduPcsApi.upload_file(src, '/apps/fsync/whole') == 0
+        assert BaiduPcsApi.parallel_upload(src, '/apps/fsync/sliced', 1024 * 1024, 3) == 0
+        assert stub.files['/apps/fsync/sliced']['md5'] == md5sum(src)
+        ret, meta = BaiduPcsApi.get_pcs_filemeta('/apps/fsync/sliced')
+        assert len(json.loads(meta['block_list'])) == 4
+        assert BaiduPcsApi.rapid_uploadfile(src, '/apps/fsync/rapid') == 0
+        assert BaiduPcsApi.parallel_download(dest, '/apps/fsync/whole', 4) == 0
+        assert md5sum(dest) == md5sum(src)
+
+def test_async_upload_download(tmp_path, monkeypatch):
+    monkeypatch.setitem(SynConfig.config, 'compress', 'zlib:*.log')
+    src = str(tmp_path / 'src')
+    dest = str(tmp_path / 'dest')
+    with open(src, 'wb') as f:
+        f.write(b''.join(b'%08d INFO request handled\n' % i for i in range(20000)))
+
+    async def transfer(pcspath):
+        api = AsyncBaiduPcsApi()
+        try:
+            # concurrent checks of one directory share its requests
+            assert await asyncio.gather(*[api.check_create_pcsdir('/apps/fsync/async') for _ in range(5)]) == [0] * 5
+            assert await api.upload_file(src, pcspath) == 0
+            ret, meta = await api.get_pcs_filemeta(pcspath)
+            assert ret == 0
+            assert await api.download_file(dest, pcspath, '0-%d' % (meta['size'] - 1)) == 0
+            return await api.download_file(dest, pcspath + '.missing', '0-0')
+        finally:
+            api.close()
+
+    with PcsStub() as stub:
+        assert asyncio.run(transfer('/apps/fsync/async/plain')) == 1
+        assert md5sum(dest) == md5sum(src)
+        assert stub.requests['mkdir'] == 1
+        stub.requests.clear()
+        # the directory is cached now, and the file goes up compressed
+        assert asyncio.run(transfer('/apps/fsync/async/app.log')) == 1
+        assert md5sum(dest) == md5sum(src)
+        assert 'mkdir' not in stub.requests and stub.requests['meta'] == 1
+        assert len(stub.files['/apps/fsync/async/app.log']['data']) < os.path.getsize(src) // 5
+
+def test_encrypted_unaligned_slices(tmp_path, monkeypatch):
+    monkeypatch.setitem(SynConfig.config, 'encryption', '1')
+    monkeypatch.setitem(SynConfig.config, 'encryptkey', 'secret')
+    monkeypatch.setitem(SynConfig.config, 'statedir', str(tmp_path / 'state'))
+    src = str(tmp_path / 'src')
+    dest = str(tmp_path / 'dest')
+    with open(src, 'wb') as f:
+        f.write(os.urandom(1024 * 1024 + 123))
+    with PcsStub():
+        # 100000 is no multiple of the 4096 byte cipher blocks
+        assert BaiduPcsApi.parallel_upload(src, '/apps/fsync/unaligned', 100000, 3) == 0
+        assert BaiduPcsApi.parallel_download(dest, '/apps/fsync/unaligned', 3) == 0
+        assert md5sum(dest) == md5sum(src)
+        # past maxslices slices, the size left over is spread over the slices still allowed
+        monkeypatch.setattr(baidupcsapi.SliceUploadState, 'maxslices', 4)
+        assert BaiduPcsApi.parallel_upload(src, '/apps/fsync/budget', 64 * 1024, 3) == 0
+        ret, meta = BaiduPcsApi.get_pcs_filemeta('/apps/fsync/budget')
+        assert len(json.loads(meta['block_list'])) <= 4
+        assert BaiduPcsApi.parallel_download(dest, '/apps/fsync/budget', 3) == 0
+        assert md5sum(dest) == md5sum(src)
+
+@pytest.mark.parametrize('encryption', ['0', '3'])
+def test_download_steals_slow_tail(tmp_path, monkeypatch, encryption):
+    monkeypatch.setitem(SynConfig.config, 'encryption', encryption)
+    monkeypatch.setitem(SynConfig.config, 'encryptkey', 'secret')
+    src = str(tmp_path / 'src')
+    dest = str(tmp_path / 'dest')
+    with open(src, 'wb') as f:
+        f.write(os.urandom(1024 * 1024))
+    writes = []
+
+    class RecordingWriter(FileWriter):
+        def write(self, offset, data):
+            writes.append((offset, len(data)))
+            FileWriter.write(self, offset, data)
+
+    monkeypatch.setattr(baidupcsapi, 'FileWriter', RecordingWriter)
+    with PcsStub() as stub:
+        assert BaiduPcsApi.upload_file(src, '/apps/fsync/stall') == 0
+        # the first of the two segments would take 4s on its own
+        stub.slowranges[0] = 128 * 1024
+        started = time.time()
+        assert BaiduPcsApi.parallel_download(dest, '/apps/fsync/stall', 2) == 0
+        elapsed = time.time() - started
+        assert stub.requests['download'] > 2
+    assert elapsed < 3
+    assert md5sum(dest) == md5sum(src)
+    # every byte written once: the shrunk segment stopped at its new end
+    covered = bytearray(1024 * 1024)
+    for offset, size in writes:
+        assert not any(covered[offset:offset + size])
+        covered[offset:offset + size] = b'\x01' * size
+    assert all(covered)
+
+def test_incremental_upload(tmp_path, monkeypatch):
+    monkeypatch.setitem(SynConfig.config, 'statedir', str(tmp_path / 'state'))
+    src = str(tmp_path / 'src')
+    with open(src, 'wb') as f:
+        f.write(os.urandom(10 * 1024 * 1024 + 5))
+    with PcsStub() as stub:
+        assert BaiduPcsApi.parallel_upload(src, '/apps/fsync/big', 1024 * 1024, 3) == 0
+        uploads = stub.requests['upload']
+        with open(src, 'r+b') as f:
+            f.seek(5 * 1024 * 1024 + 10)
+            f.write(b'changed')
+        assert BaiduPcsApi.incremental_upload(src, '/apps/fsync/big', 1024 * 1024, 3) == 0
+        assert stub.requests['upload'] - uploads == 1
+        assert list(stub.files) == ['/apps/fsync/big']
+        assert stub.files['/apps/fsync/big']['md5'] == md5sum(src)
+
+        # no recorded layout: evenly sized blocks are matched, encrypted too
+        monkeypatch.setitem(SynConfig.config, 'encryption', '3')
+        monkeypatch.setitem(SynConfig.config, 'encryptkey', 'incremental')
+        assert BaiduPcsApi.parallel_upload(src, '/apps/fsync/enc', 2 * 1024 * 1024, 2) == 0
+        shutil.rmtree(str(tmp_path / 'state'))
+        with open(src, 'ab') as f:
+            f.write(b'grown')
+        uploads = stub.requests['upload']
+        assert BaiduPcsApi.incremental_upload(src, '/apps/fsync/enc', 2 * 1024 * 1024, 2) == 0
+        assert stub.requests['upload'] - uploads == 1
+        dest = str(tmp_path / 'dest')
+        assert BaiduPcsApi.parallel_download(dest, '/apps/fsync/enc', 2) == 0
+        assert md5sum(dest) == md5sum(src)
+
+def test_incremental_upload_skips_unaligned_layout(tmp_path, monkeypatch):
+    monkeypatch.setitem(SynConfig.config, 'statedir', str(tmp_path / 'state'))
+    monkeypatch.setitem(SynConfig.config, 'encryption', '1')
+    monkeypatch.setitem(SynConfig.config, 'encryptkey', 'secret')
+    src = str(tmp_path / 'src')
+    dest = str(tmp_path / 'dest')
+    with open(src, 'wb') as f:
+        f.write(os.urandom(300000))
+    with PcsStub():
+        # uploaded and recorded in slices off the 4096 byte cipher blocks, as older versions could
+        layout = []
+        for startpos in (0, 100000, 200000):
+            ret, md5 = BaiduPcsApi.slice_upload_tmpfile(src, '%d-%d' % (startpos, startpos + 99999))
+            assert ret == 0
+            layout.append([startpos, startpos + 99999, md5])
+        assert BaiduPcsApi.slice_upload_createsuperfile('/apps/fsync/old', {'block_list': [md5 for _, _, md5 in layout]}) == 0
+        layoutfile = baidupcsapi.SliceUploadState.statepath('blocks', '/apps/fsync/old')
+        os.makedirs(os.path.dirname(layoutfile))
+        with open(layoutfile, 'w') as f:
+            json.dump({'pcspath': '/apps/fsync/old', 'slices': layout}, f)
+        with open(src, 'r+b') as f:
+            f.seek(250000)
+            f.write(b'changed')
+        assert BaiduPcsApi.unchanged_blocks(src, [tuple(block) for block in layout]) == []
+        assert BaiduPcsApi.incremental_upload(src, '/apps/fsync/old', 64 * 1024, 2) == 0
+        assert BaiduPcsApi.parallel_download(dest, '/apps/fsync/old', 2) == 0
+    assert md5sum(dest) == md5sum(src)
+
+def test_compressed_transfer(tmp_path, monkeypatch):
+    monkeypatch.setitem(SynConfig.config, 'compress', 'lzma:*.sql,zlib:*.log')
+    monkeypatch.setitem(SynConfig.config, 'encryption', '1')
+    monkeypatch.setitem(SynConfig.config, 'encryptkey', 'compressed')
+    src = str(tmp_path / 'src')
+    dest = str(tmp_path / 'dest')
+    with open(src, 'wb') as f:
+        f.write(b''.join(b'%08d INFO request handled\n' % i for i in range(200000)))
+    with open(dest, 'wb') as f:
+        f.write(b'x' * 20 * 1024 * 1024)
+    with PcsStub() as stub:
+        assert BaiduPcsApi.parallel_upload(src, '/apps/fsync/app.log', 1024 * 1024, 3) == 0
+        assert stub.requests['upload'] == 1
+        assert len(stub.files['/apps/fsync/app.log']['data']) < os.path.getsize(src) // 5
+        assert BaiduPcsApi.parallel_download(dest, '/apps/fsync/app.log', 4) == 0
+        assert md5sum(dest) == md5sum(src)
+        stub.files['/apps/fsync/broken.log'] = dict(stub.files['/apps/fsync/app.log'])
+        stub.files['/apps/fsync/broken.log']['data'] = stub.files['/apps/fsync/app.log']['data'][:-100]
+        assert BaiduPcsApi.parallel_download(dest, '/apps/fsync/broken.log', 4) == 1
+        # above compressmaxsize the file goes up stored, without a measuring pass
+        monkeypatch.setitem(SynConfig.config, 'compressmaxsize', 1024 * 1024)
+        assert BaiduPcsApi.upload_file(src, '/apps/fsync/big.sql') == 0
+        assert len(stub.files['/apps/fsync/big.sql']['data']) == os.path.getsize(src) + COMPRESS_HEADER.size
+        assert BaiduPcsApi.parallel_download(dest, '/apps/fsync/big.sql', 4) == 0
+        assert md5sum(dest) == md5sum(src)
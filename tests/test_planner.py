@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import os
+
+from fsync.baidupcsapi import BaiduPcsApi
+from fsync.conf import SynConfig
+from fsync.index import FileIndex
+from fsync.planner import execute_plan, indexed_state, local_state, make_plan, remote_state
+from fsync.snapshot import walk_remote
+from pcsstub import PcsStub
+
+def entry(size, md5):
+    return {'size': size, 'md5': md5}
+
+def test_unchanged_and_modified():
+    local = {'a': entry(1, 'x'), 'b': entry(2, 'y')}
+    remote = {'a': entry(1, 'x'), 'b': entry(2, 'z')}
+    assert make_plan(local, remote) == [('replace', 'b')]
+
+def test_rename_and_move():
+    local = {'new/a.bin': entry(10, 'x'), 'b2.txt': entry(20, 'y')}
+    remote = {'old/a.bin': entry(10, 'x'), 'b.txt': entry(20, 'y')}
+    assert make_plan(local, remote) == [('move', 'b.txt', 'b2.txt'), ('move', 'old/a.bin', 'new/a.bin')]
+
+def test_copy_upload_delete():
+    local = {'a': entry(10, 'x'), 'c': entry(10, 'x'), 'd': entry(30, 'w')}
+    remote = {'a': entry(10, 'x'), 'gone': entry(5, 'v')}
+    assert make_plan(local, remote) == [('copy', 'a', 'c'), ('upload', 'd'), ('delete', 'gone')]
+    assert make_plan(local, remote, delete=False) == [('copy', 'a', 'c'), ('upload', 'd')]
+
+def test_duplicate_renames():
+    local = {'x1': entry(10, 'x'), 'x2': entry(10, 'x')}
+    remote = {'old': entry(10, 'x')}
+    assert make_plan(local, remote) == [('copy', 'old', 'x2'), ('move', 'old', 'x1')]
+
+def test_encrypted_sync_never_rapid_uploads(tmp_path, monkeypatch):
+    monkeypatch.setitem(SynConfig.config, 'statedir', str(tmp_path / 'state'))
+    root = tmp_path / 'local'
+    root.mkdir()
+    data = os.urandom(600 * 1024)
+    (root / 'a.bin').write_bytes(data)
+    with PcsStub() as stub:
+        # the plain content is on the server already, under another name
+        assert BaiduPcsApi.upload_file(str(root / 'a.bin'), '/apps/fsync/plain.bin') == 0
+        monkeypatch.setitem(SynConfig.config, 'encryption', '3')
+        monkeypatch.setitem(SynConfig.config, 'encryptkey', 'secret')
+        BaiduPcsApi.check_create_pcsdir('/apps/fsync/enc')
+        plan = make_plan(local_state(str(root)), remote_state(walk_remote('/apps/fsync/enc'), '/apps/fsync/enc'))
+        assert execute_plan(plan, str(root), '/apps/fsync/enc', FileIndex(str(tmp_path / 'index.db'))) == 0
+        assert stub.requests.get('rapidupload', 0) == 0
+        assert stub.files['/apps/fsync/enc/a.bin']['data'] != data
+        dest = str(tmp_path / 'dest')
+        assert BaiduPcsApi.parallel_download(dest, '/apps/fsync/enc/a.bin', 2) == 0
+        with open(dest, 'rb') as f:
+            assert f.read() == data
+
+def test_failed_replace_keeps_remote_copy(tmp_path, monkeypatch):
+    root = tmp_path / 'local'
+    root.mkdir()
+    (root / 'a.txt').write_bytes(b'old')
+    index = FileIndex(str(tmp_path / 'index.db'))
+    with PcsStub() as stub:
+        assert execute_plan([('upload', 'a.txt')], str(root), '/apps/fsync/r', index) == 0
+        (root / 'a.txt').write_bytes(b'new content')
+        with monkeypatch.context() as m:
+            m.setattr(BaiduPcsApi, 'upload_file', staticmethod(lambda *args: 1))
+            assert execute_plan([('replace', 'a.txt')], str(root), '/apps/fsync/r', index) == 1
+        assert stub.files['/apps/fsync/r/a.txt']['data'] == b'old'
+        assert execute_plan([('replace', 'a.txt')], str(root), '/apps/fsync/r', index) == 0
+        assert list(stub.files) == ['/apps/fsync/r/a.txt']
+        assert stub.files['/apps/fsync/r/a.txt']['data'] == b'new content'
+        assert stub.requests.get('delete', 0) == 0
+
+def test_second_encrypted_sync_is_noop(tmp_path, monkeypatch):
+    monkeypatch.setitem(SynConfig.config, 'statedir', str(tmp_path / 'state'))
+    monkeypatch.setitem(SynConfig.config, 'encryption', '3')
+    monkeypatch.setitem(SynConfig.config, 'encryptkey', 'secret')
+    root = tmp_path / 'local'
+    root.mkdir()
+    (root / 'a.txt').write_bytes(b'a' * 1000)
+    (root / 'b.txt').write_bytes(b'b' * 2000)
+    index = FileIndex(str(tmp_path / 'index.db'))
+    with PcsStub() as stub:
+        BaiduPcsApi.check_create_pcsdir('/apps/fsync/enc')
+        for _ in range(2):
+            remote = remote_state(walk_remote('/apps/fsync/enc'), '/apps/fsync/enc', index)
+            plan = make_plan(local_state(str(root)), remote)
+            assert execute_plan(plan, str(root), '/apps/fsync/enc', index) == 0
+        assert plan == []
+        assert indexed_state(index, '/apps/fsync/enc') == remote
+        assert stub.requests['upload'] == 2
+        # a rename is still a move, not a delete and an upload
+        (root / 'a.txt').rename(root / 'c.txt')
+        assert make_plan(local_state(str(root)), indexed_state(index, '/apps/fsync/enc')) == [('move', 'a.txt', 'c.txt')]
+
+def test_second_compressed_sync_is_noop(tmp_path, monkeypatch):
+    monkeypatch.setitem(SynConfig.config, 'statedir', str(tmp_path / 'state'))
+    monkeypatch.setitem(SynConfig.config, 'compress', 'zlib:*.log')
+    root = tmp_path / 'local'
+    root.mkdir()
+    (root / 'a.log').write_bytes(b'INFO request handled\n' * 1000)
+    index = FileIndex(str(tmp_path / 'index.db'))
+    with PcsStub() as stub:
+        BaiduPcsApi.check_create_pcsdir('/apps/fsync/z')
+        for _ in range(2):
+            remote = remote_state(walk_remote('/apps/fsync/z'), '/apps/fsync/z', index)
+            plan = make_plan(local_state(str(root)), remote)
+            assert execute_plan(plan, str(root), '/apps/fsync/z', index) == 0
+        assert plan == []
+        assert stub.requests['upload'] == 1
+        # the server would move the compressed bytes to a path read as plain
+        (root / 'a.log').rename(root / 'a.txt')
+        plan = make_plan(local_state(str(root)), indexed_state(index, '/apps/fsync/z'))
+        assert plan == [('move', 'a.log', 'a.txt')]
+        assert execute_plan(plan, str(root), '/apps/fsync/z', index) == 0
+        assert stub.requests.get('move', 0) == 0
+        assert list(stub.files) == ['/apps/fsync/z/a.txt']
+        assert stub.files['/apps/fsync/z/a.txt']['data'] == b'INFO request handled\n' * 1000
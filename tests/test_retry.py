@@ -0,0 +1,48 @@
+import pycurl
+
+from fsync.retry import OK, FATAL, RETRY, THROTTLE, CircuitBreaker, RetryPolicy, parse_retry_after
+
+def test_classify():
+    policy = RetryPolicy(retries=3, basedelay=1, maxdelay=10)
+    assert policy.classify(200) == OK
+    assert policy.classify(206) == OK
+    assert policy.classify(404, '{"error_code":31066,"error_msg":"file does not exist"}') == FATAL
+    assert policy.classify(400, '{"error_code":31023,"error_msg":"param error"}') == FATAL
+    assert policy.classify(400, '{"error_code":31034,"error_msg":"hit frequence limit"}') == THROTTLE
+    assert policy.classify(429) == THROTTLE
+    assert policy.classify(503, 'not json') == THROTTLE
+    assert policy.classify(500) == RETRY
+    assert policy.classify(502) == RETRY
+    assert policy.classify(0, '', pycurl.E_OPERATION_TIMEDOUT) == RETRY
+    assert policy.classify(0, '', pycurl.E_COULDNT_CONNECT) == RETRY
+    assert policy.classify(0, '', pycurl.E_URL_MALFORMAT) == FATAL
+
+def test_delay():
+    policy = RetryPolicy(retries=5, basedelay=1, maxdelay=10)
+    for attempt in range(8):
+        assert 0 <= policy.delay(attempt) <= min(10, 2 ** attempt)
+    assert policy.delay(0, 5) >= 5
+    assert policy.delay(0, 100) <= 10
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('120') == 120
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT', now=1445412470) == 10
+    assert parse_retry_after('soon') is None
+
+def test_breaker():
+    breaker = CircuitBreaker(threshold=3, cooldown=10)
+    for _ in range(2):
+        breaker.failure(now=100)
+    assert breaker.before(now=100) == 0
+    breaker.failure(now=100)
+    assert breaker.before(now=105) == 5
+    # one probe once the cooldown is over, the others keep waiting
+    assert breaker.before(now=110) == 0
+    assert breaker.before(now=110) > 0
+    breaker.success()
+    assert breaker.closed
+    assert breaker.before(now=111) == 0
+    # a throttle opens the breaker at once
+    breaker.failure(30, now=200)
+    assert breaker.before(now=200) == 30
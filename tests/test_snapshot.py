@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+import pytest
+
+from fsync.baidupcsapi import BaiduPcsApi, PcsError
+from fsync.snapshot import load_snapshot, save_snapshot, walk_remote
+from pcsstub import PcsStub
+
+def test_save_load_snapshot(tmp_path):
+    records = [
+        ('/apps/fsync/a', True, 0, 1500000000, '', 1),
+        ('/apps/fsync/a/中文\tname', False, 1024, 1500000001, '0cc175b9c0f1b6a831c399e269772661', 2),
+    ]
+    filename = str(tmp_path / 'snapshot.gz')
+    assert save_snapshot(iter(records), filename, '/apps/fsync') == 2
+    assert list(load_snapshot(filename)) == records
+
+def test_walk_remote(tmp_path):
+    src = str(tmp_path / 'src')
+    with open(src, 'wb') as f:
+        f.write(b'x')
+    # 'full' holds exactly two pages of 4 entries, 'a/b/c' is three levels deep
+    paths = ['/apps/fsync/t/full/%d' % i for i in range(8)] + ['/apps/fsync/t/a/b/c/f', '/apps/fsync/t/top']
+    with PcsStub() as stub:
+        for pcspath in paths:
+            assert BaiduPcsApi.upload_file(src, pcspath) == 0
+        stub.requests.clear()
+        records = list(walk_remote('/apps/fsync/t', 3, page_size=4))
+        assert sorted(record[0] for record in records if not record[1]) == sorted(paths)
+        assert sorted(record[0] for record in records if record[1]) == ['/apps/fsync/t/a', '/apps/fsync/t/a/b',
+                                                                       '/apps/fsync/t/a/b/c', '/apps/fsync/t/full']
+        assert all(record[2] == 1 for record in records if not record[1])
+        # two full pages and an empty one for 'full', one page for each of the other 4 directories
+        assert stub.requests['list'] == 7
+        # with no room to queue subdirectories the crawler lists them itself
+        stub.requests.clear()
+        assert sorted(walk_remote('/apps/fsync/t', 3, page_size=4, maxdirs=0)) == sorted(records)
+        assert stub.requests['list'] == 7
+        stub.unlistable.add('/apps/fsync/t/a/b')
+        with pytest.raises(PcsError):
+            list(walk_remote('/apps/fsync/t', 3, page_size=4))
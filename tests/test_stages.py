@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+from fsync.stages import CipherStage, CompressStage, StageChain
+import os
+
+import pytest
+
+def run_stage(stage, data, chunksize):
+    output = b''.join([stage.process(data[pos:pos + chunksize]) for pos in range(0, len(data), chunksize)])
+    return output + stage.flush()
+
+def test_cipher_roundtrip():
+    data = os.urandom(4096 * 3 + 123)
+    for crypt in ['1', '2', '3']:
+        encrypted = run_stage(CipherStage(crypt, 'secret'), data, 1000)
+        assert encrypted != data
+        assert run_stage(CipherStage(crypt, 'secret', False), encrypted, 777) == data
+
+def test_cipher_blocks_are_independent():
+    data = os.urandom(4096 * 2)
+    for crypt in ['1', '2', '3']:
+        whole = run_stage(CipherStage(crypt, 'secret'), data, 4096)
+        tail = run_stage(CipherStage(crypt, 'secret'), data[4096:], 4096)
+        assert whole[4096:] == tail
+
+def test_compress_roundtrip():
+    data = b''.join(b'line %d of a log file\n' % i for i in range(20000))
+    for method in ['zlib', 'lzma']:
+        compressed = run_stage(CompressStage(method, True, len(data)), data, 1000)
+        assert len(compressed) < len(data) // 5
+        assert run_stage(CompressStage(method, False), compressed, 7) == data
+        with pytest.raises(ValueError):
+            run_stage(CompressStage(method, False), compressed[:-10], 1000)
+
+def test_compress_then_encrypt():
+    data = os.urandom(1000) * 50
+    upload = StageChain(CompressStage('zlib', True, len(data)), CipherStage('3', 'secret'))
+    stored = run_stage(upload, data, 4000)
+    download = StageChain(CipherStage('3', 'secret', False), CompressStage('zlib', False))
+    assert run_stage(download, stored, 3000) == data
+    with pytest.raises(ValueError):
+        run_stage(CompressStage('zlib', False), data, 1000)
@@ -0,0 +1,65 @@
+import threading
+import time
+
+from fsync.common.threadpool import PriorityExecutor, WorkManager
+
+def test_executor_futures():
+    with PriorityExecutor(4) as executor:
+        futures = [executor.submit(pow, i, 2) for i in range(20)]
+        failed = executor.submit(int, 'x')
+    assert [f.result() for f in futures] == [i * i for i in range(20)]
+    assert isinstance(failed.exception(), ValueError)
+
+def test_executor_priority():
+    order = []
+    gate = threading.Event()
+    with PriorityExecutor(1) as executor:
+        executor.submit(gate.wait)
+        for priority in [3, 1, 2, 1]:
+            executor.submit(order.append, priority, priority=priority)
+        gate.set()
+    assert order == [1, 1, 2, 3]
+
+def test_executor_cancel():
+    gate = threading.Event()
+    executor = PriorityExecutor(1)
+    running = executor.submit(gate.wait)
+    queued = [executor.submit(time.sleep, 0) for _ in range(5)]
+    assert queued[0].cancel()
+    while not running.running():
+        time.sleep(0.01)
+    executor.shutdown(wait=False, cancel_futures=True)
+    gate.set()
+    assert running.result() is True
+    assert all(f.cancelled() for f in queued)
+
+def test_executor_backpressure():
+    gate = threading.Event()
+    executor = PriorityExecutor(1, max_queue=1)
+    executor.submit(gate.wait)
+    time.sleep(0.1)
+    executor.submit(time.sleep, 0)
+    blocked = threading.Thread(target=executor.submit, args=(time.sleep, 0))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()
+    gate.set()
+    blocked.join(5)
+    assert not blocked.is_alive()
+    executor.shutdown()
+
+def test_workmanager_compat():
+    class Job:
+        results = []
+
+        def __init__(self, num):
+            self.num = num
+
+        def execute(self):
+            Job.results.append(self.num)
+
+    work_manager = WorkManager(3)
+    for i in range(10):
+        work_manager.add_job(Job(i))
+    assert work_manager.wait_allcomplete() == []
+    assert sorted(Job.results) == list(range(10))